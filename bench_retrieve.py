@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Retrieval benchmark for rag_retrieve_clustered.py — per-stage latency,
+throughput, per-config memory and quality (recall@k / MRR / nDCG@k) on a WSTG golden set.
+
+Golden set:
+ - Queries are WSTG test titles: numbered section titles ("4.5.4 Testing for Insecure
+   Direct Object References"), "Testing for ..." topics and the title next to a WSTG
+   id ("Testing for Browser Cache Weaknesses (WSTG-ATHN-06) ..."). Titles with fewer
+   than MIN_QUERY_WORDS content words are dropped ("Testing for HSTS").
+ - Expected ids = the chunks holding every item that opens with the title or carries
+   its WSTG id, i.e. the test's own section. The table of contents and a chapter's
+   list of its tests are never anchors; titles found only there are dropped.
+ - Sentence fragments copied word for word from the expected chunk are dropped too,
+   since BM25 finds them trivially.
+ - Knowledge items come from wstg-v4.2_knowledge.json (--knowledge) when
+   available, otherwise from the chunk texts themselves.
+ - Fewer than MIN_GOLDEN queries is an error (the metrics would be noise).
+ - Or pass a ready-made JSONL with --golden ({"query": ..., "expected": [...]}).
+
+Every configuration (dense, hybrid, +MMR, +rerank, multiquery/HyDE, ...) runs the
+same queries; results are written as JSON so runs can be compared over time
+(--compare previous.json prints the deltas).
+
+Memory per configuration (ru_maxrss is a process-wide high-water mark, so it is
+only reported once for the whole run):
+ - rss_delta_mb : RSS growth across the config incl. warmup (models / indexes it
+   loads first, e.g. the cross-encoder for the first +rerank config)
+ - peak_alloc_mb: peak Python + numpy allocations during one extra, untimed pass
+   over the queries under tracemalloc (kept out of the latency numbers)
+
+Example:
+  python bench_retrieve.py --chunks out/wstg_chunks.from_knowledge.jsonl \\
+    --faiss out/wstg_faiss.index --ids out/wstg_faiss_ids.json \\
+    --out bench_results/run.json --repeat 3
+"""
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import rag_retrieve_clustered as rag
+
+try:
+    import resource  # POSIX only
+except ImportError:
+    resource = None
+
+
+# =========================
+# Golden set
+# =========================
+WSTG_ID_RE = re.compile(r"\bWSTG-[A-Z]{4}-\d{2}\b")
+SECTION_RE = re.compile(r"\b4\.\d{1,2}\.\d{1,2}\s+((?:Test|Testing)[A-Za-z0-9 ()/,-]{5,80})")
+HEADING_RE = re.compile(r"^(Testing for [A-Z][A-Za-z0-9 ()/-]{3,70})$")
+# "Testing for <Title Case topic>" inside a sentence, up to punctuation or the verb that follows it
+TOPIC_RE = re.compile(
+    r"\bTesting for ((?:[A-Z][A-Za-z0-9/-]*|and|of|in|the|to|for)"
+    r"(?: (?:[A-Z][A-Za-z0-9/-]*|and|of|in|the|to|for|[a-z]+)){0,7}?)"
+    r"(?=[.,:;()]| (?:is|are|involves|aims|requires|includes|can|should|focuses|helps|ensures|checks|by|with|using)\b|$)"
+)
+# the Title Case test name an item opens with, e.g. "Test Upload of Unexpected File Types is denoted as ..."
+TITLE_RE = re.compile(
+    r"^Test(?:ing)?(?: for)?(?: (?:[A-Z][A-Za-z0-9/-]*|and|of|in|the|to|for|on))+"
+)
+# "- 4.5.2 Testing for ...": one entry of a chapter's list of tests
+LISTING_RE = re.compile(r"^\s*(?:[-*\u2022]\s*)?4\.\d{1,2}\.\d{1,2}\s")
+LISTING_RUN = 3  # consecutive items opening with a test title that make a list rather than a section
+ITEM_PREFIX_RE = re.compile(r"^\s*(?:[-*\u2022]\s*)?(?:4\.\d{1,2}(?:\.\d{1,2})?\s+)?")
+WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9/-]*")
+STOPWORDS = {"a", "an", "and", "for", "in", "of", "on", "the", "to", "id"}
+CONTENTS_RE = re.compile(r"\b(?:table of )?contents\b", re.I)
+CONTENTS_SEARCH_ITEMS = 50  # the table of contents is looked for in the first N items
+ANCHOR_PROBE_CHARS = 80  # leading characters of an anchor item looked up in the chunk texts
+MIN_QUERY_WORDS = 3  # "Testing for HSTS" / "WSTG-INPV-03 ID:" say too little to grade retrieval
+MIN_GOLDEN = 15
+
+
+def knowledge_items(chunks: Dict[str, Dict[str, Any]], knowledge_path: Optional[Path]) -> List[Dict[str, Any]]:
+    """[{"item": int, "text": str}] from the knowledge JSON, or reconstructed from chunk texts."""
+    if knowledge_path is not None and knowledge_path.exists():
+        data = rag.read_json(knowledge_path)
+        return [{"item": i, "text": t} for i, t in enumerate(data.get("knowledge", []))]
+    items = []
+    for obj in chunks.values():
+        start = obj.get("start_item")
+        if start is None:
+            continue
+        # items were joined with "\n"; line numbers are an approximation of item numbers
+        for j, line in enumerate((obj.get("text") or "").split("\n")):
+            items.append({"item": start + j, "text": line, "chunk": obj["id"]})
+    return items
+
+
+def chunks_for_item(chunks: Dict[str, Dict[str, Any]], item: int) -> List[str]:
+    return [cid for cid, obj in chunks.items()
+            if obj.get("start_item") is not None and obj["start_item"] <= item <= obj.get("end_item", -1)]
+
+
+def chunks_for_anchor(chunks: Dict[str, Dict[str, Any]], it: Dict[str, Any]) -> List[str]:
+    """Chunks holding the item's text (chunk windows can drift from the knowledge file's item
+    numbering), else the chunks whose item range covers it."""
+    if "chunk" in it:
+        return [it["chunk"]]
+    probe = it["text"].strip()[:ANCHOR_PROBE_CHARS]
+    found = [cid for cid, obj in chunks.items() if probe and probe in (obj.get("text") or "")]
+    return found or chunks_for_item(chunks, it["item"])
+
+
+def content_words(query: str) -> List[str]:
+    return [w for w in WORD_RE.findall(query) if w.lower() not in STOPWORDS]
+
+
+def is_title(query: str) -> bool:
+    """Every word is capitalised (or a stop word): a test name, not a sentence fragment."""
+    return all(w[0].isupper() or w[0].isdigit() for w in content_words(query))
+
+
+def item_title(text: str) -> Optional[str]:
+    m = TITLE_RE.match(ITEM_PREFIX_RE.sub("", text, count=1))
+    return m.group(0).strip() if m else None
+
+
+def item_queries(text: str, previous: str = "") -> List[str]:
+    """Test titles mentioned in an item. A WSTG id contributes the title next to it:
+    the one the item opens with, else the previous item's (a heading followed by "ID: WSTG-...")."""
+    text = text.strip().rstrip(".:")
+    queries = [m.group(1).strip() for m in SECTION_RE.finditer(text)]
+    m = HEADING_RE.match(text)
+    if m:
+        queries.append(m.group(1))
+    queries += [f"Testing for {m.group(1).strip()}" for m in TOPIC_RE.finditer(text)]
+    if WSTG_ID_RE.search(text):
+        title = item_title(text) or item_title(previous)
+        if title:
+            queries.append(title)
+    return [q for q in dict.fromkeys(queries) if len(content_words(q)) >= MIN_QUERY_WORDS]
+
+
+def contents_items(chunks: Dict[str, Dict[str, Any]], items: List[Dict[str, Any]]) -> set:
+    """Item numbers of the table of contents: every item of the chunk(s) holding the "Contents" mention."""
+    for it in items[:CONTENTS_SEARCH_ITEMS]:
+        if CONTENTS_RE.search(it["text"]):
+            toc_chunks = [it["chunk"]] if "chunk" in it else chunks_for_item(chunks, it["item"])
+            return {i for cid in toc_chunks
+                    for i in range(chunks[cid]["start_item"], chunks[cid].get("end_item", -1) + 1)}
+    return set()
+
+
+def listing_items(chunks: Dict[str, Dict[str, Any]], items: List[Dict[str, Any]]) -> set:
+    """The table of contents plus a chapter's list of its tests: runs of two or more numbered
+    entries ("- 4.5.2 Testing for ..."), or of LISTING_RUN items that each open with a test title."""
+    listed = contents_items(chunks, items)
+    numbered = [bool(LISTING_RE.match(it["text"])) for it in items]
+    titled = [item_title(it["text"]) is not None for it in items]
+    for flags, run in ((numbered, 2), (titled, LISTING_RUN)):
+        start = 0
+        for pos in range(len(items) + 1):
+            if pos < len(items) and flags[pos]:
+                continue
+            if pos - start >= run:
+                listed.update(it["item"] for it in items[start:pos])
+            start = pos + 1
+    return listed
+
+
+def build_golden_set(chunks: Dict[str, Dict[str, Any]], knowledge_path: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """One query per test title, expecting the chunks of every item that opens with that title or
+    carries its WSTG id (the test's own section), never a listing that only names it."""
+    items = knowledge_items(chunks, knowledge_path)
+    listed = listing_items(chunks, items)
+    titles: Dict[str, str] = {}  # lowercased title -> first spelling seen
+    id_items: Dict[str, List[Dict[str, Any]]] = {}
+    for pos, it in enumerate(items):
+        previous = items[pos - 1]["text"] if pos else ""
+        for q in item_queries(it["text"], previous):
+            titles.setdefault(q.lower(), q)
+        if WSTG_ID_RE.search(it["text"]) and it["item"] not in listed:
+            title = item_title(it["text"]) or item_title(previous)
+            if title:
+                id_items.setdefault(title.lower(), []).append(it)
+    golden = []
+    for key, query in titles.items():
+        anchors = list(id_items.get(key, []))
+        for it in items:
+            opening = ITEM_PREFIX_RE.sub("", it["text"], count=1).lower()
+            if it["item"] not in listed and opening.startswith(key) and not opening[len(key):len(key) + 1].isalnum():
+                anchors.append(it)
+        expected: List[str] = []
+        for anchor in anchors:
+            expected.extend(cid for cid in chunks_for_anchor(chunks, anchor) if cid not in expected and rag.is_indexed_chunk(chunks[cid]))
+        if not expected:
+            continue
+        # a sentence fragment copied from the expected chunk is found by BM25 trivially; titles are kept
+        if not is_title(query) and any(key in (chunks[cid].get("text") or "").lower() for cid in expected):
+            continue
+        golden.append({"query": query, "expected": expected})
+    return golden
+
+
+def read_golden(path: Path) -> List[Dict[str, Any]]:
+    with path.open("r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# =========================
+# Metrics
+# =========================
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    vals = sorted(values)
+    k = (len(vals) - 1) * p / 100.0
+    lo, hi = int(math.floor(k)), int(math.ceil(k))
+    return vals[lo] + (vals[hi] - vals[lo]) * (k - lo)
+
+
+def latency_summary(values_s: List[float]) -> Dict[str, float]:
+    ms = [v * 1000.0 for v in values_s]
+    return {
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": sum(ms) / len(ms) if ms else 0.0,
+    }
+
+
+def quality(top_ids: List[str], expected: List[str], k: int) -> Dict[str, float]:
+    exp = set(expected)
+    top = top_ids[:k]
+    hits = [1.0 if cid in exp else 0.0 for cid in top]
+    rr = next((1.0 / (i + 1) for i, h in enumerate(hits) if h), 0.0)
+    dcg = sum(h / math.log2(i + 2) for i, h in enumerate(hits))
+    idcg = sum(1.0 / math.log2(i + 2) for i in range(min(len(exp), k)))
+    return {
+        "recall": (sum(hits) / len(exp)) if exp else 0.0,
+        "mrr": rr,
+        "ndcg": (dcg / idcg) if idcg else 0.0,
+    }
+
+
+def current_rss_mb() -> Optional[float]:
+    """Resident set size right now (Linux /proc), unlike the ru_maxrss high-water mark."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+# =========================
+# Configurations
+# =========================
+CONFIGS: Dict[str, Dict[str, Any]] = {
+    "dense":             {},
+    "hybrid":            {"hybrid": True},
+    "dense+mmr":         {"mmr": True},
+    "hybrid+mmr":        {"hybrid": True, "mmr": True},
+    "hybrid+rerank":     {"hybrid": True, "rerank": True},
+    "hybrid+mmr+rerank": {"hybrid": True, "mmr": True, "rerank": True},
+    "multiquery6+hyde":  {"multiquery": 6, "hyde": True, "hybrid": True},
+}
+
+
+def run_config(res: rag.RetrievalResources, name: str, opts: Dict[str, Any],
+               golden: List[Dict[str, Any]], k: int, repeat: int) -> Dict[str, Any]:
+    o = rag.resolve_options({**opts, "deliver_to_llm": max(k, opts.get("deliver_to_llm") or 0)})
+    kwargs = res.retrieve_kwargs(o)
+
+    totals: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    metrics = {"recall": 0.0, "mrr": 0.0, "ndcg": 0.0}
+    t_start = time.perf_counter()
+    for rep in range(repeat):
+        for g in golden:
+            tracer = rag.Tracer()
+            _, top_ids = rag.retrieve(query=g["query"], tracer=tracer, **kwargs)
+            trace = tracer.finish()
+            total = trace["wall_ms"] / 1000.0
+            per_stage = {stage: ms / 1000.0 for stage, ms in tracer.stage_totals().items()}
+            per_stage["other"] = max(0.0, total - sum(per_stage.values()))
+            totals.append(total)
+            for stage, v in per_stage.items():
+                stages.setdefault(stage, []).append(v)
+            if rep == 0:
+                for key, v in quality(top_ids, g["expected"], k).items():
+                    metrics[key] += v
+    wall = time.perf_counter() - t_start
+    n = max(1, len(golden))
+    return {
+        "config": name,
+        "options": o,
+        "queries": len(golden) * repeat,
+        "latency": latency_summary(totals),
+        "stages": {stage: latency_summary(v) for stage, v in sorted(stages.items())},
+        "qps": (len(totals) / wall) if wall else 0.0,
+        f"recall@{k}": metrics["recall"] / n,
+        "mrr": metrics["mrr"] / n,
+        f"ndcg@{k}": metrics["ndcg"] / n,
+    }
+
+
+def peak_alloc_mb(res: rag.RetrievalResources, opts: Dict[str, Any], golden: List[Dict[str, Any]]) -> float:
+    """Peak traced allocations of one pass over the golden set (run separately: tracemalloc is slow)."""
+    tracemalloc.start()
+    try:
+        for g in golden:
+            res.run(g["query"], opts)
+        return tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+    finally:
+        tracemalloc.stop()
+
+
+def print_table(results: List[Dict[str, Any]], k: int) -> None:
+    print(f"{'config':22s} {'p50':>8s} {'p95':>8s} {'p99':>8s} {'qps':>8s} "
+          f"{'R@' + str(k):>6s} {'MRR':>6s} {'nDCG':>6s} {'dRSS MB':>8s} {'alloc MB':>8s}")
+    for r in results:
+        lat = r["latency"]
+        rss = r.get("rss_delta_mb")
+        alloc = r.get("peak_alloc_mb")
+        print(f"{r['config']:22s} {lat['p50_ms']:8.1f} {lat['p95_ms']:8.1f} {lat['p99_ms']:8.1f} "
+              f"{r['qps']:8.1f} {r[f'recall@{k}']:6.3f} {r['mrr']:6.3f} {r[f'ndcg@{k}']:6.3f} "
+              f"{(rss if rss is not None else float('nan')):8.1f} "
+              f"{(alloc if alloc is not None else float('nan')):8.2f}")
+        stages = ", ".join(f"{s}={v['p50_ms']:.1f}ms" for s, v in r["stages"].items())
+        print(f"{'':22s} stages p50: {stages}")
+
+
+def print_comparison(results: List[Dict[str, Any]], previous_path: Path, k: int) -> None:
+    prev = {r["config"]: r for r in rag.read_json(previous_path)["results"]}
+    print(f"\n==== vs {previous_path} ====")
+    for r in results:
+        p = prev.get(r["config"])
+        if p is None:
+            continue
+        d_p50 = r["latency"]["p50_ms"] - p["latency"]["p50_ms"]
+        d_p95 = r["latency"]["p95_ms"] - p["latency"]["p95_ms"]
+        d_rec = r[f"recall@{k}"] - p.get(f"recall@{k}", 0.0)
+        print(f"{r['config']:22s} p50 {d_p50:+8.1f} ms  p95 {d_p95:+8.1f} ms  recall@{k} {d_rec:+.3f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark retrieval latency / throughput / quality")
+    ap.add_argument("--chunks", required=True)
+    ap.add_argument("--faiss", required=True, dest="faiss_path")
+    ap.add_argument("--ids", required=True)
+    ap.add_argument("--embedder", default=None)
+    ap.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    ap.add_argument("--vectors", default=None, help="Optional .npy embedding matrix for MMR")
+    ap.add_argument("--knowledge", default="wstg-v4.2_knowledge.json",
+                    help="Knowledge JSON for the golden set (falls back to chunk texts)")
+    ap.add_argument("--golden", default=None, help="Golden set JSONL ({query, expected}); built if omitted")
+    ap.add_argument("--write-golden", default=None, help="Write the built golden set to this JSONL")
+    ap.add_argument("--configs", default=",".join(CONFIGS), help="Comma-separated config names")
+    ap.add_argument("--k", type=int, default=10, help="k for recall@k / nDCG@k")
+    ap.add_argument("--repeat", type=int, default=1, help="Passes over the query set (latency samples)")
+    ap.add_argument("--warmup", type=int, default=3, help="Untimed queries per config")
+    ap.add_argument("--out", default=None, help="Write results JSON here")
+    ap.add_argument("--compare", default=None, help="Previous results JSON to diff against")
+    ap.add_argument("--no-memory", action="store_true", help="Skip the extra tracemalloc pass per config")
+    args = ap.parse_args()
+
+    unknown = [c for c in args.configs.split(",") if c not in CONFIGS]
+    if unknown:
+        ap.error(f"unknown config(s): {unknown}; choose from {list(CONFIGS)}")
+
+    res = rag.RetrievalResources(
+        chunks_path=Path(args.chunks).expanduser().resolve(),
+        index_path=Path(args.faiss_path).expanduser().resolve(),
+        ids_path=Path(args.ids).expanduser().resolve(),
+        embedder_name=args.embedder,
+        reranker_name=args.reranker,
+        vectors_path=Path(args.vectors).expanduser().resolve() if args.vectors else None,
+        rerank_cache_size=0,  # no caching: measure the real per-query cost
+    )
+
+    if args.golden:
+        golden = read_golden(Path(args.golden))
+    else:
+        golden = build_golden_set(res.chunks, Path(args.knowledge))
+    if args.write_golden:
+        with Path(args.write_golden).open("w", encoding="utf-8") as f:
+            for g in golden:
+                f.write(json.dumps(g, ensure_ascii=False) + "\n")
+    if not golden:
+        raise SystemExit("Empty golden set.")
+    if not args.golden and len(golden) < MIN_GOLDEN:
+        raise SystemExit(f"Golden set has only {len(golden)} queries (< {MIN_GOLDEN}); "
+                         "pass --knowledge or a --golden file")
+    rag.eprint(f"[info] Golden set: {len(golden)} queries")
+
+    results = []
+    for name in args.configs.split(","):
+        opts = CONFIGS[name]
+        rss_before = current_rss_mb()
+        for g in golden[:args.warmup]:
+            res.run(g["query"], opts)
+        rag.eprint(f"[info] Running {name} ...")
+        result = run_config(res, name, opts, golden, args.k, max(1, args.repeat))
+        rss_after = current_rss_mb()
+        result["rss_delta_mb"] = (rss_after - rss_before) if rss_before is not None and rss_after is not None else None
+        result["peak_alloc_mb"] = None if args.no_memory else peak_alloc_mb(res, opts, golden)
+        results.append(result)
+
+    print_table(results, args.k)
+    if args.compare:
+        print_comparison(results, Path(args.compare), args.k)
+    if args.out:
+        out = Path(args.out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        payload = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "argv": sys.argv[1:],
+            "golden_size": len(golden),
+            "process_peak_rss_mb": peak_rss_mb(),
+            "startup_timings_s": rag.STARTUP_TIMINGS,
+            "results": results,
+        }
+        with out.open("w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2)
+        rag.eprint(f"[info] Wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Chia wstg-v4.2_knowledge.json (danh sách knowledge item từ read_books.py) thành chunks JSONL theo
+cấu trúc WSTG, cho embed.py + rag_retrieve_clustered.py.
+
+ - Nhận diện section: mỗi item được chấm điểm theo chương 4.1 .. 4.12 (keyword của
+   WSTG_CATEGORY_KEYWORDS, id WSTG-XXXX-NN và "Figure 4.x.y-n" tính nặng hơn), rồi Viterbi chọn
+   chuỗi chương không giảm (sách đi theo thứ tự chương; trước 4.1 là phần mở đầu). Trong một chương,
+   chỉ marker chắc chắn (WSTG-ATHN-06, Figure 4.4.6-1) mở section test 4.x.y; tiêu đề "4.4.6 Testing ..."
+   chỉ góp điểm cho chương, các dòng mục lục liền nhau (4.4.1, 4.4.2, ...) bị bỏ qua.
+ - Section test chỉ kéo dài (hai phía quanh marker) chừng nào còn bằng chứng: item chứa từ hiếm của
+   item marker (và của tiêu đề "Testing for ..." ngay trước nó). Section đóng khi gặp tiêu đề / marker
+   test khác, sau TEST_GAP_ITEMS item không còn từ nào của nó, hoặc khi dài quá TEST_MAX_ITEMS item;
+   phần còn lại thuộc chương "4.x" (không có wstg_id).
+ - Child: các item liên tiếp trong một section, tối đa --child-tokens token (một item dài hơn thì
+   đứng riêng) -> match dense / BM25 chính xác, cross-encoder và MMR rẻ hơn.
+ - Parent: các child liên tiếp cùng section, tối đa --parent-tokens token -> context đầy đủ khi
+   retriever mở rộng theo meta.parent_id. Parent có meta.level = "parent": embed.py và BM25 bỏ qua.
+
+Mỗi chunk giữ source / start_item / end_item (item cuối, tính cả) như chunks cũ; meta ghi hierarchy:
+level, parent_id (child), child_ids (parent), section ("front", "4.4" hoặc "4.4.6"), category,
+wstg_id. Id ổn định theo section: WSTGv4_2-4.4.6-p01 (parent), WSTGv4_2-4.4.6-p01-c03 (child); một section
+xuất hiện nhiều đoạn (chương 4.7 trước và sau section 4.7.3) đánh số parent tiếp, không trùng id.
+
+Knowledge JSON được đọc stream (hai lượt: chấm điểm, rồi ghi chunk), không load cả file.
+
+Example:
+  python chunk_knowledge.py --knowledge wstg-v4.2_knowledge.json --out out/wstg_chunks.from_knowledge.jsonl
+  python chunk_knowledge.py --child-tokens 96 --parent-tokens 1024 --child-overlap 1 --tokenizer tiktoken:cl100k_base
+"""
+import argparse
+import json
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from rag_common import WSTG_CATEGORY_KEYWORDS, WSTG_ID_RE, TokenCounter, category_hits
+
+CATEGORIES = list(WSTG_CATEGORY_KEYWORDS)  # thứ tự chương: INFO = 4.1 ... APIT = 4.12
+MARKER_WEIGHT = 10.0        # điểm của một id WSTG / Figure / tiêu đề 4.x.y so với một keyword
+SWITCH_PENALTY = 6.0        # điểm trừ mỗi lần sang chương mới (lớn hơn -> ít chương ngắn do nhiễu)
+FRONT_MATTER_SCORE = 0.1    # điểm mỗi item của phần mở đầu (chương 1-3 của sách, trước 4.1)
+
+FIGURE_RE = re.compile(r"\bFigure\s+4\.(\d{1,2})\.(\d{1,2})-\d+", re.IGNORECASE)
+SECTION_REF_RE = re.compile(r"(?:^[\s\-*•]*|\b(?:sub)?section\s+|```code\s+)4\.(\d{1,2})\.(\d{1,2})\b",
+                            re.IGNORECASE)
+TEST_HEADING_RE = re.compile(r"^\s*(?:Testing|Test)\s+(?:for\s+)?[A-Z][\w-]*\s+[A-Z]")  # "Testing for HTTP Verb ..."
+TERM_RE = re.compile(r"[a-z][a-z0-9]{3,}")
+TERM_SUFFIX_RE = re.compile(r"(?:ing|ed|es|e|s)$")
+TEST_TERM_MAX_DF = 0.01     # từ bằng chứng của section test: có trong <= 1% số item (từ hiếm)
+TEST_GAP_ITEMS = 4          # số item liền nhau không có từ bằng chứng thì đóng section test
+TEST_MAX_ITEMS = 80         # độ dài tối đa (item) của một section test
+
+
+# 1) Đọc knowledge items (stream)
+def iter_knowledge(path: Path, key: str = "knowledge", block: int = 1 << 16) -> Iterator[str]:
+    """Từng phần tử của mảng `key` ({"knowledge": [...]}, hoặc mảng gốc) mà không json.load cả file."""
+    decoder = json.JSONDecoder()
+    with path.open("r", encoding="utf-8") as f:
+        buf, pos = "", 0
+
+        def fill() -> bool:
+            nonlocal buf, pos
+            data = f.read(block)
+            buf, pos = buf[pos:] + data, 0
+            return bool(data)
+
+        # tìm '[' mở mảng
+        while True:
+            head = buf.lstrip()
+            if head.startswith("["):
+                pos = buf.index("[") + 1
+                break
+            m = re.search(r'"%s"\s*:\s*\[' % re.escape(key), buf)
+            if m:
+                pos = m.end()
+                break
+            if not fill():
+                raise ValueError(f"{path}: no '{key}' array")
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                if not fill():
+                    raise ValueError(f"{path}: unterminated '{key}' array")
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            pos = end
+            yield item
+
+
+# 2) Chấm điểm chương + marker section
+def item_terms(text: str) -> frozenset:
+    """Từ (chữ thường, bỏ đuôi ing / ed / es / e / s) của item, không tính id WSTG / số Figure."""
+    text = FIGURE_RE.sub(" ", WSTG_ID_RE.sub(" ", text)).lower()
+    return frozenset(TERM_SUFFIX_RE.sub("", w) if len(w) > 5 else w for w in TERM_RE.findall(text))
+
+
+def item_markers(text: str) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """(marker chắc chắn: id WSTG / Figure, tham chiếu 4.x.y dạng tiêu đề) dưới dạng (chương, số test)."""
+    strong = []
+    for m in WSTG_ID_RE.finditer(text):
+        if m.group(1) in CATEGORIES:
+            strong.append((CATEGORIES.index(m.group(1)) + 1, int(m.group(0).rsplit("-", 1)[1])))
+    strong += [(int(m.group(1)), int(m.group(2))) for m in FIGURE_RE.finditer(text)]
+    refs = [(int(m.group(1)), int(m.group(2))) for m in SECTION_REF_RE.finditer(text)]
+    valid = lambda pairs: [(c, t) for c, t in pairs if 1 <= c <= len(CATEGORIES) and t >= 1]
+    return valid(strong), valid(refs)
+
+
+def score_items(path: Path) -> Tuple[np.ndarray, List[List[Tuple[int, int]]], List[frozenset], List[bool]]:
+    """
+    Lượt 1: votes[i, c] = điểm của item i cho chương c (0 = phần mở đầu), các marker chắc chắn
+    (chương, test) của từng item, từ của item và item có phải tiêu đề "Testing for ..." không.
+    Tham chiếu 4.x.y chỉ góp điểm chương; nằm trong một dãy item liền nhau nhắc các section khác nhau
+    là mục lục / danh sách, không phải tiêu đề -> bỏ.
+    """
+    votes: List[np.ndarray] = []
+    strong: List[List[Tuple[int, int]]] = []
+    refs: List[List[Tuple[int, int]]] = []
+    terms: List[frozenset] = []
+    headings: List[bool] = []
+    for text in iter_knowledge(path):
+        hits = category_hits(text)
+        row = np.asarray([0] + [hits[cat] for cat in CATEGORIES], dtype="float64")
+        s, r = item_markers(text)
+        votes.append(row)
+        strong.append(s)
+        refs.append(r)
+        terms.append(item_terms(text))
+        headings.append(bool(TEST_HEADING_RE.match(text)))
+    n = len(votes)
+    for i in range(n):
+        listing = any(0 <= j < n and refs[j] and set(refs[j]) != set(refs[i]) for j in (i - 1, i + 1))
+        for c, _ in strong[i] + ([] if listing else refs[i]):
+            votes[i][c] += MARKER_WEIGHT
+    return np.asarray(votes).reshape(n, len(CATEGORIES) + 1), strong, terms, headings
+
+
+def segment_chapters(votes: np.ndarray, penalty: float = SWITCH_PENALTY,
+                     front_score: float = FRONT_MATTER_SCORE) -> np.ndarray:
+    """
+    Viterbi trên chuỗi chương không giảm 0 (mở đầu) <= 4.1 <= ... <= 4.12: mỗi item cộng điểm của
+    chương nó thuộc, mỗi lần sang chương mới (nhảy cóc được) trừ `penalty`. Trả về chương của từng item.
+    """
+    n, S = votes.shape
+    if n == 0:
+        return np.zeros(0, dtype="int64")
+    emit = votes.copy()
+    emit[:, 0] = front_score
+    score = emit[0] - penalty * (np.arange(S) > 0)
+    back = np.zeros((n, S), dtype="int64")
+    for i in range(1, n):
+        new = np.empty(S)
+        prev_best, prev_arg = -np.inf, 0
+        for s in range(S):
+            move = prev_best - penalty
+            if score[s] >= move:
+                new[s], back[i, s] = score[s], s
+            else:
+                new[s], back[i, s] = move, prev_arg
+            if score[s] > prev_best:
+                prev_best, prev_arg = score[s], s
+        score = new + emit[i]
+    path = np.zeros(n, dtype="int64")
+    path[-1] = int(np.argmax(score))
+    for i in range(n - 1, 0, -1):
+        path[i - 1] = back[i, path[i]]
+    return path
+
+
+def test_span(i: int, test: int, floor: int, chapters: List[int], markers: List[List[Tuple[int, int]]],
+              rare: List[frozenset], headings: List[bool]) -> Tuple[int, int]:
+    """
+    [first, last] (tính cả) của section test `test` mở bởi marker ở item i: bằng chứng là từ hiếm của
+    item marker (+ tiêu đề ngay trước nó); mở rộng hai phía tới item cuối còn bằng chứng, dừng ở tiêu đề /
+    marker test khác, khoảng trống > TEST_GAP_ITEMS hoặc TEST_MAX_ITEMS. Không lùi quá `floor`.
+    """
+    chapter, n = chapters[i], len(chapters)
+    tests_at = lambda j: {t for c, t in markers[j] if c == chapter}
+    vocab, first, last = set(rare[i]), i, i
+    if i - 1 >= floor and headings[i - 1] and chapters[i - 1] == chapter:
+        vocab |= rare[i - 1]
+        first = i - 1
+    j = i + 1
+    while j < n and chapters[j] == chapter and j - first < TEST_MAX_ITEMS:
+        found = tests_at(j)
+        if found - {test} or (headings[j] and test not in found):
+            break  # test khác bắt đầu
+        if test in found:
+            vocab |= rare[j]
+            last = j
+        elif rare[j] & vocab:
+            last = j
+        elif j - last > TEST_GAP_ITEMS:
+            break
+        j += 1
+    j = first - 1
+    while j >= floor and chapters[j] == chapter and last - j < TEST_MAX_ITEMS and first - j <= TEST_GAP_ITEMS:
+        if tests_at(j):
+            break
+        if rare[j] & vocab:
+            first = j
+        if headings[j]:
+            break
+        j -= 1
+    return first, last
+
+
+def assign_sections(chapters: np.ndarray, markers: List[List[Tuple[int, int]]], terms: List[frozenset],
+                    headings: List[bool]) -> List[str]:
+    """
+    Section của từng item: "front", chương "4.c", hoặc test "4.c.t" quanh marker chắc chắn (số test
+    không giảm trong chương) trong phạm vi còn bằng chứng (test_span); ngoài đó là chương "4.c".
+    """
+    chapters = chapters.tolist()
+    n = len(chapters)
+    df = Counter(t for ts in terms for t in ts)
+    max_df = TEST_TERM_MAX_DF * n
+    rare = [frozenset(t for t in ts if df[t] <= max_df) for ts in terms]
+    sections = ["front" if c == 0 else f"4.{c}" for c in chapters]
+    last_test: Dict[int, int] = {}
+    i = floor = 0
+    while i < n:
+        chapter = chapters[i]
+        later = [t for c, t in markers[i] if chapter and c == chapter and t >= last_test.get(c, 0)]
+        if not later:
+            i += 1
+            continue
+        test = min(later)
+        first, last = test_span(i, test, floor, chapters, markers, rare, headings)
+        sections[first:last + 1] = [f"4.{chapter}.{test}"] * (last + 1 - first)
+        last_test[chapter] = test
+        i = floor = last + 1
+    return sections
+
+
+# 3) Child / parent chunks cho một section
+def pack_runs(tokens: List[int], budget: int, overlap: int = 0) -> List[Tuple[int, int]]:
+    """Cắt dãy item thành đoạn [start, end) liên tiếp <= budget token (ít nhất một item / đoạn)."""
+    runs, start, n = [], 0, len(tokens)
+    while start < n:
+        end, total = start + 1, tokens[start]
+        while end < n and total + tokens[end] <= budget:
+            total += tokens[end]
+            end += 1
+        runs.append((start, end))
+        if end >= n:
+            break
+        start = max(end - overlap, start + 1)
+    return runs
+
+
+def section_meta(section: str) -> Dict[str, Any]:
+    if section == "front":
+        return {"section": section}
+    parts = section.split(".")
+    category = CATEGORIES[int(parts[1]) - 1]
+    meta: Dict[str, Any] = {"section": section, "category": category}
+    if len(parts) == 3:
+        meta["wstg_id"] = f"WSTG-{category}-{int(parts[2]):02d}"
+    return meta
+
+
+def section_chunks(section: str, items: List[Tuple[int, str, int]], args: argparse.Namespace,
+                   source: str, first_parent: int = 1) -> Iterator[Dict[str, Any]]:
+    """
+    items = [(số thứ tự item, text, token)] của một đoạn section -> parent rồi các child của nó;
+    parent đánh số từ `first_parent` (đoạn sau của cùng section đánh số tiếp).
+    """
+    base = section_meta(section)
+    children = pack_runs([t for _, _, t in items], args.child_tokens, args.child_overlap)
+    # parent = các child liên tiếp, đếm token theo các item (phần overlap chỉ tính một lần)
+    groups, start = [], 0
+    while start < len(children):
+        end = start + 1
+        while (end < len(children) and
+               sum(t for _, _, t in items[children[start][0]:children[end][1]]) <= args.parent_tokens):
+            end += 1
+        groups.append(children[start:end])
+        start = end
+    for p, group in enumerate(groups, start=first_parent):
+        pid = f"{args.id_prefix}-{section}-p{p:02d}"
+        lo, hi = group[0][0], group[-1][1]
+        kids = [(f"{pid}-c{c:02d}", a, b) for c, (a, b) in enumerate(group, start=1)]
+        yield {
+            "id": pid,
+            "source": source,
+            "start_item": items[lo][0],
+            "end_item": items[hi - 1][0],
+            "text": "\n".join(text for _, text, _ in items[lo:hi]),
+            "meta": {**base, "level": "parent", "child_ids": [cid for cid, _, _ in kids]},
+        }
+        for cid, a, b in kids:
+            yield {
+                "id": cid,
+                "source": source,
+                "start_item": items[a][0],
+                "end_item": items[b - 1][0],
+                "text": "\n".join(text for _, text, _ in items[a:b]),
+                "meta": {**base, "level": "child", "parent_id": pid},
+            }
+
+
+def iter_chunks(path: Path, sections: List[str], args: argparse.Namespace,
+                counter: TokenCounter) -> Iterator[Dict[str, Any]]:
+    """Lượt 2: stream lại các item, gom theo section (liền nhau) và sinh chunk từng section."""
+    source = path.name
+    current: Optional[str] = None
+    items: List[Tuple[int, str, int]] = []
+    parents: Counter = Counter()  # số parent đã sinh của mỗi section
+
+    def flush() -> Iterator[Dict[str, Any]]:
+        for chunk in section_chunks(current, items, args, source, parents[current] + 1):
+            parents[current] += chunk["meta"]["level"] == "parent"
+            yield chunk
+
+    for i, text in enumerate(iter_knowledge(path)):
+        if sections[i] != current and items:
+            yield from flush()
+            items = []
+        current = sections[i]
+        items.append((i, text, max(1, counter.count(text))))
+    if items:
+        yield from flush()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Structure-aware chunking of the WSTG knowledge items "
+                                             "(child chunks per section + parent chunks)")
+    ap.add_argument("--knowledge", default="wstg-v4.2_knowledge.json", help="Knowledge JSON from read_books.py")
+    ap.add_argument("--out", default="out/wstg_chunks.from_knowledge.jsonl", help="Output chunks JSONL")
+    ap.add_argument("--id-prefix", default="WSTGv4_2", help="Chunk id prefix")
+    ap.add_argument("--child-tokens", type=int, default=128,
+                    help="Max tokens per child chunk (embedded + BM25; a longer single item stays whole)")
+    ap.add_argument("--parent-tokens", type=int, default=512, help="Max tokens per parent chunk (context only)")
+    ap.add_argument("--child-overlap", type=int, default=0, help="Items shared by neighbouring children")
+    ap.add_argument("--tokenizer", default="approx",
+                    help="Token counter for the budgets: approx, tiktoken:<encoding> or hf:<model>")
+    args = ap.parse_args()
+    if args.parent_tokens < args.child_tokens:
+        raise SystemExit("--parent-tokens must be >= --child-tokens")
+
+    path = Path(args.knowledge)
+    votes, markers, terms, headings = score_items(path)
+    chapters = segment_chapters(votes)
+    sections = assign_sections(chapters, markers, terms, headings)
+    counter = TokenCounter(args.tokenizer)
+
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    n_parents = n_children = 0
+    child_tokens: List[int] = []
+    with out.open("w", encoding="utf-8") as f:
+        for chunk in iter_chunks(path, sections, args, counter):
+            if chunk["meta"]["level"] == "parent":
+                n_parents += 1
+            else:
+                n_children += 1
+                child_tokens.append(counter.count(chunk["text"]))
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+
+    starts = [i for i in range(len(sections)) if i == 0 or sections[i] != sections[i - 1]]
+    n_tests = len({s for s in sections if s.count(".") == 2})
+    print(f"{len(sections)} items -> {len(starts)} section runs ({n_tests} test sections), "
+          f"{n_parents} parents, {n_children} children "
+          f"(child tokens avg {np.mean(child_tokens or [0]):.0f}, max {max(child_tokens or [0])})")
+    print("  " + " ".join(f"{i}:{sections[i]}" for i in starts))
+    print(f"Wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,716 @@
-import json, faiss, numpy as np
-from sentence_transformers import SentenceTransformer
-
-# 1) Đọc chunks
-texts, ids = [], []
-with open("wstg_chunks.from_knowledge.jsonl", "r", encoding="utf-8") as f:
-    for line in f:
-        obj = json.loads(line)
-        texts.append(obj["text"])
-        ids.append(obj["id"])
-
-# 2) Embed (ví dụ multilingual-e5-large)
-model = SentenceTransformer("intfloat/multilingual-e5-large")
-embs = model.encode(texts, batch_size=32, normalize_embeddings=True)
-
-# 3) Lưu FAISS + mapping
-index = faiss.IndexFlatIP(embs.shape[1])
-index.add(np.asarray(embs, dtype="float32"))
-faiss.write_index(index, "wstg_faiss.index")
-with open("wstg_faiss_ids.json", "w", encoding="utf-8") as f:
-    json.dump(ids, f, ensure_ascii=False, indent=2)
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Build FAISS index cho chunks (dense retrieval).
+
+Index types:
+ - flat  : exact IndexFlatIP (mặc định, brute-force)
+ - hnsw  : IndexHNSWFlat (M, efConstruction, efSearch)
+ - ivf   : IndexIVFFlat (nlist, nprobe)
+ - ivfpq : IndexIVFPQ (nlist, pq-m, pq-nbits, nprobe)
+
+Nén vector cho stage 1 (--compress), vector float32 đầy đủ vẫn nằm trên đĩa
+(wstg_faiss_vectors.npy) để rescore top k * --rescore-factor ứng viên:
+ - sq8      : int8 scalar quantization (flat / hnsw / ivf), ~4x nhỏ hơn
+ - binary   : mã nhị phân 1 bit/chiều, tìm bằng Hamming (chỉ flat), ~32x
+ - pca      : PCA xuống --reduce-dim chiều trước index
+ - truncate : cắt --reduce-dim chiều đầu + normalize (kiểu Matryoshka)
+
+Metadata (loại index + search params + nén) được ghi cạnh index: wstg_faiss.meta.json,
+rag_retrieve_clustered.py đọc file này khi load để set nprobe / efSearch / rescoring.
+
+--report: đo recall@k so với flat + latency/query cho từng search param,
+          kèm bộ nhớ index so với flat và recall sau rescoring,
+--sweep: build + report tất cả loại index (và các kiểu nén) để chọn điểm speed/recall/RAM.
+
+--manifest: ghi corpus này (chunks / index / ids / vectors) vào shard manifest, để
+            rag_retrieve_clustered.py --shards tìm song song trên nhiều corpus.
+
+Cập nhật tăng dần: index luôn là ID-mapped (IndexIDMap2 / id trong IVF lists, label FAISS ==
+vị trí trong wstg_faiss_ids.json) và wstg_faiss.build.json lưu hash nội dung + label của từng
+chunk cùng model. Chạy lại embed.py chỉ embed chunk mới / đổi nội dung, xoá chunk đã bị bỏ
+(remove_ids; chỗ của nó trong ids.json thành null), rồi compact khi số chỗ trống vượt
+--compact-ratio. --full để embed lại toàn bộ. Retriever đọc build.json để kiểm tra index,
+ids và chunks cùng một build.
+
+Embedding dạng stream: chunks JSONL chỉ được quét một lượt (id, hash, offset, độ dài token ước lượng),
+chunk được sắp theo độ dài và chia batch cùng độ dài (ít padding, --max-batch-tokens giới hạn bộ nhớ),
+encode trên --workers process CPU, vector ghi dần vào wstg_faiss_vectors.partial.npy (memmap) rồi add
+vào index theo block. Checkpoint (wstg_faiss.embed.ckpt.json) cho phép chạy lại tiếp tục sau khi bị
+ngắt; log in ra chunks/s.
+
+Chunk parent (meta.level = "parent", do chunk_knowledge.py sinh) chỉ là context cho retriever,
+không được embed; chỉ các child vào index.
+
+Example:
+  python embed.py --chunks out/wstg_chunks.from_knowledge.jsonl --out-dir out
+  python embed.py --chunks out/wstg_chunks.from_knowledge.jsonl --out-dir out --full --workers 4
+  python embed.py --from-vectors out/wstg_faiss_vectors.npy --out-dir out --index-type hnsw --report
+  python embed.py --from-vectors out/wstg_faiss_vectors.npy --out-dir out --sweep
+  python embed.py --from-vectors out/wstg_faiss_vectors.npy --out-dir out --compress sq8 --report
+  python embed.py --chunks out/book_chunks.jsonl --out-dir out --prefix book_faiss --manifest out/shards.json
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from rag_common import (RescoringIndex, TokenCounter, binarize, chunk_text_hash, chunks_fingerprint, file_stat,
+                        is_indexed_chunk)
+
+DEFAULT_MODEL = "intfloat/multilingual-e5-large"
+
+
+# 1) Đọc chunks (stream): chỉ giữ id, hash, offset dòng và độ dài ước lượng, text đọc lại theo offset khi embed
+def scan_chunks(path: Path, counter: TokenCounter) -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
+    ids, hashes, offsets, lengths = [], [], [], []
+    offset = 0
+    with path.open("rb") as f:
+        for line in f:
+            obj = json.loads(line) if line.strip() else None
+            if obj is not None and is_indexed_chunk(obj):
+                ids.append(obj["id"])
+                hashes.append(chunk_text_hash(obj["text"]))
+                offsets.append(offset)
+                lengths.append(counter.count(obj["text"]))
+            offset += len(line)
+    return ids, hashes, np.asarray(offsets, dtype="int64"), np.asarray(lengths, dtype="int64")
+
+
+def read_texts(path: Path, offsets: np.ndarray) -> List[str]:
+    texts = []
+    with path.open("rb") as f:
+        for off in offsets:
+            f.seek(int(off))
+            texts.append(json.loads(f.readline())["text"])
+    return texts
+
+
+# 2) Embed (ví dụ multilingual-e5-large): stream theo batch cùng độ dài, nhiều process, checkpoint
+MAX_SEQ_TOKENS = 512  # max_seq_length của e5 / BERT: text dài hơn bị cắt khi encode
+_MODEL = None  # model của process hiện tại (worker hoặc chạy tại chỗ khi --workers 0)
+
+
+def _init_worker(model_name: str, threads: int) -> None:
+    global _MODEL
+    if threads > 0:
+        import torch
+
+        torch.set_num_threads(threads)
+    from sentence_transformers import SentenceTransformer
+
+    _MODEL = SentenceTransformer(model_name, device="cpu" if threads > 0 else None)
+
+
+def _encode_batch(chunks_path: str, offsets: np.ndarray) -> np.ndarray:
+    texts = read_texts(Path(chunks_path), offsets)
+    embs = _MODEL.encode(texts, batch_size=len(texts), normalize_embeddings=True)
+    return np.asarray(embs, dtype="float32")
+
+
+def plan_batches(lengths: np.ndarray, batch_size: int, max_batch_tokens: int) -> List[np.ndarray]:
+    """
+    Sắp xếp theo độ dài giảm dần rồi cắt batch: chunk trong một batch dài gần bằng nhau nên ít padding,
+    và batch chứa chunk dài thì nhỏ hơn để batch_size * độ dài dài nhất <= max_batch_tokens (bộ nhớ
+    activation có giới hạn). Batch dài nhất chạy trước: thiếu RAM thì lỗi ngay từ đầu.
+    """
+    order = np.argsort(-np.minimum(lengths, MAX_SEQ_TOKENS), kind="stable")
+    batches, start = [], 0
+    while start < order.shape[0]:
+        longest = max(1, min(int(lengths[order[start]]), MAX_SEQ_TOKENS))
+        size = batch_size if max_batch_tokens <= 0 else max(1, min(batch_size, max_batch_tokens // longest))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+def padding_ratio(batches: List[np.ndarray], lengths: np.ndarray) -> float:
+    """Tỉ lệ token thật / token sau padding (1.0 = không padding)."""
+    capped = np.minimum(lengths, MAX_SEQ_TOKENS)
+    padded = sum(int(capped[b].max()) * b.shape[0] for b in batches if b.size)
+    return float(capped.sum()) / max(1, padded)
+
+
+def _run_batches(batches: List[np.ndarray], pending: List[int], chunks_path: Path, offsets: np.ndarray,
+                 model_name: str, workers: int) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yield (số batch, embeddings) theo thứ tự xong; tối đa 2 batch / worker đang chờ (RAM có giới hạn)."""
+    if workers <= 0:
+        if _MODEL is None:
+            _init_worker(model_name, 0)
+        for b in pending:
+            yield b, _encode_batch(str(chunks_path), offsets[batches[b]])
+        return
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    ctx = multiprocessing.get_context("spawn")  # torch + fork không an toàn
+    with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker,
+                             initargs=(model_name, threads)) as pool:
+        queue = iter(pending)
+        inflight = {}
+
+        def submit(b: int) -> None:
+            inflight[pool.submit(_encode_batch, str(chunks_path), offsets[batches[b]])] = b
+
+        for b in itertools.islice(queue, 2 * workers):
+            submit(b)
+        while inflight:
+            finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                b = inflight.pop(fut)
+                yield b, fut.result()
+                nxt = next(queue, None)
+                if nxt is not None:
+                    submit(nxt)
+
+
+def _write_checkpoint(path: Path, state: Dict[str, Any]) -> None:
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def clear_checkpoint(out_dir: Path, prefix: str) -> None:
+    """Xoá checkpoint sau khi ghi xong output (không còn checkpoint thì file .partial.npy bị bỏ qua)."""
+    for path in (out_dir / f"{prefix}.embed.ckpt.json", out_dir / f"{prefix}_vectors.partial.npy"):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def embed_stream(chunks_path: Path, offsets: np.ndarray, lengths: np.ndarray, hashes: List[str],
+                 args: argparse.Namespace, out_dir: Path) -> np.ndarray:
+    """
+    Embed các chunk tại `offsets` (theo thứ tự đó) và trả về ma trận memmap float32 (n, dim) trong
+    <prefix>_vectors.partial.npy: batch xong được ghi thẳng vào đúng hàng, RAM chỉ giữ các batch đang
+    chạy. Cứ --checkpoint-every batch thì flush + ghi <prefix>.embed.ckpt.json (danh sách batch đã xong);
+    chạy lại cùng chunks / model / batch params sau khi bị ngắt sẽ tiếp tục từ đó.
+    Cần ít nhất 1 chunk (không có chunk thì không biết dim của model) -> ValueError.
+    """
+    n = offsets.shape[0]
+    if n == 0:
+        raise ValueError("embed_stream() needs at least one chunk")
+    ckpt_path = out_dir / f"{args.prefix}.embed.ckpt.json"
+    part_path = out_dir / f"{args.prefix}_vectors.partial.npy"
+    key = hashlib.sha1("\n".join([args.model, str(args.batch_size), str(args.max_batch_tokens), *hashes])
+                       .encode("utf-8")).hexdigest()
+    batches = plan_batches(lengths, args.batch_size, args.max_batch_tokens)
+    state = {"key": key, "n": n, "dim": None, "done": []}
+    vecs = None
+    if ckpt_path.exists() and part_path.exists():
+        with ckpt_path.open("r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("key") == key and previous.get("dim"):
+            state = previous
+            vecs = np.lib.format.open_memmap(part_path, mode="r+")
+            print(f"Resuming embedding: {len(state['done'])}/{len(batches)} batches already done")
+    done = set(state["done"])
+    pending = [b for b in range(len(batches)) if b not in done]
+    total = sum(batches[b].shape[0] for b in pending)
+    print(f"Embedding {total} chunks in {len(pending)} batches (workers={args.workers}, "
+          f"padding efficiency {padding_ratio(batches, lengths):.2f})")
+
+    t0 = last = time.perf_counter()
+    finished = since_ckpt = 0
+    try:
+        for b, embs in _run_batches(batches, pending, chunks_path, offsets, args.model, args.workers):
+            if vecs is None:
+                state["dim"] = int(embs.shape[1])
+                vecs = np.lib.format.open_memmap(part_path, mode="w+", dtype="float32", shape=(n, embs.shape[1]))
+            vecs[batches[b]] = embs
+            state["done"].append(b)
+            finished += embs.shape[0]
+            since_ckpt += 1
+            if since_ckpt >= args.checkpoint_every:
+                vecs.flush()
+                _write_checkpoint(ckpt_path, state)
+                since_ckpt = 0
+            now = time.perf_counter()
+            if now - last >= 10.0:
+                rate = finished / (now - t0)
+                print(f"  {finished}/{total} chunks, {rate:.1f} chunks/s, eta {(total - finished) / rate:.0f}s")
+                last = now
+    finally:
+        if vecs is not None and since_ckpt:
+            vecs.flush()
+            _write_checkpoint(ckpt_path, state)
+    if vecs is None:
+        raise RuntimeError(f"embedding produced no vectors for {n} chunks")
+    elapsed = time.perf_counter() - t0
+    print(f"Embedded {finished} chunks in {elapsed:.1f}s ({finished / max(elapsed, 1e-9):.1f} chunks/s)")
+    return vecs
+
+
+# 3) Build index theo loại
+def default_nlist(n: int) -> int:
+    # ~4*sqrt(N) centroids, nhưng mỗi centroid cần >= 39 điểm train
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+
+def index_config(index_type: str, n: int, dim: int, args: argparse.Namespace,
+                 compress: str = "none") -> Dict[str, Any]:
+    """Tham số build + search cho một loại index (auto-fit theo kích thước corpus)."""
+    cfg = _base_config(index_type, n, dim, args, compress)
+    cfg["compress"] = compress
+    if compress == "none":
+        return cfg
+    if compress == "binary" and index_type != "flat":
+        raise ValueError("--compress binary only supports --index-type flat")
+    if compress == "sq8" and index_type == "ivfpq":
+        raise ValueError("ivfpq is already quantized; use --compress none/pca/truncate")
+    if compress in ("pca", "truncate"):
+        if not 0 < args.reduce_dim < dim:
+            raise ValueError(f"--reduce-dim ({args.reduce_dim}) must be in (0, {dim})")
+        # PCA cần >= d_out điểm train
+        cfg["reduce_dim"] = min(args.reduce_dim, n) if compress == "pca" else args.reduce_dim
+    cfg["rescore_factor"] = args.rescore_factor
+    return cfg
+
+
+def _base_config(index_type: str, n: int, dim: int, args: argparse.Namespace, compress: str) -> Dict[str, Any]:
+    if index_type == "flat":
+        return {"index_type": "flat", "params": {}, "search": {}}
+    if index_type == "hnsw":
+        return {
+            "index_type": "hnsw",
+            "params": {"M": args.hnsw_m, "efConstruction": args.ef_construction},
+            "search": {"efSearch": args.ef_search},
+        }
+    nlist = args.nlist or default_nlist(n)
+    if index_type == "ivf":
+        return {"index_type": "ivf", "params": {"nlist": nlist},
+                "search": {"nprobe": min(args.nprobe, nlist)}}
+    if index_type == "ivfpq":
+        pq_m = args.pq_m
+        d_index = args.reduce_dim if compress in ("pca", "truncate") else dim
+        if d_index % pq_m != 0:
+            raise ValueError(f"--pq-m ({pq_m}) must divide the indexed vector dim ({d_index})")
+        # PQ codebook cần >= 2^nbits điểm train
+        nbits = max(1, min(args.pq_nbits, int(math.log2(max(2, n)))))
+        return {"index_type": "ivfpq", "params": {"nlist": nlist, "pq_m": pq_m, "pq_nbits": nbits},
+                "search": {"nprobe": min(args.nprobe, nlist)}}
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def base_index(kind: str, dim: int, p: Dict[str, Any], sq8: bool = False) -> faiss.Index:
+    ip = faiss.METRIC_INNER_PRODUCT
+    qt = faiss.ScalarQuantizer.QT_8bit
+    if kind == "flat":
+        return faiss.IndexScalarQuantizer(dim, qt, ip) if sq8 else faiss.IndexFlatIP(dim)
+    if kind == "hnsw":
+        if sq8:
+            index = faiss.IndexHNSWSQ(dim, qt, p["M"], ip)
+        else:
+            index = faiss.IndexHNSWFlat(dim, p["M"], ip)
+        index.hnsw.efConstruction = p["efConstruction"]
+        return index
+    if kind == "ivf":
+        if sq8:
+            return faiss.IndexIVFScalarQuantizer(faiss.IndexFlatIP(dim), dim, p["nlist"], qt, ip)
+        return faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, p["nlist"], ip)
+    if kind == "ivfpq":
+        return faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, p["nlist"], p["pq_m"], p["pq_nbits"], ip)
+    raise ValueError(f"Unknown index type: {kind}")
+
+
+def build_index(vecs: np.ndarray, cfg: Dict[str, Any], labels: Optional[np.ndarray] = None):
+    """
+    Index ID-mapped: label FAISS = `labels` (mặc định 0..n-1 = vị trí trong ids.json), để cập nhật
+    tăng dần bằng add_with_ids / remove_ids mà không đánh số lại.
+    """
+    dim = vecs.shape[1]
+    kind = cfg["index_type"]
+    compress = cfg.get("compress", "none")
+    if labels is None:
+        labels = np.arange(vecs.shape[0], dtype="int64")
+    if compress == "binary":
+        index = faiss.IndexBinaryIDMap2(faiss.IndexBinaryFlat(dim))
+        add_blocks(index, vecs, labels, binary=True)
+        return index
+
+    d_index = cfg.get("reduce_dim") or dim
+    index = base_index(kind, d_index, cfg["params"], sq8=(compress == "sq8"))
+    if compress == "pca":
+        index = faiss.IndexPreTransform(faiss.PCAMatrix(dim, d_index), index)
+    elif compress == "truncate":
+        # giữ d_index chiều đầu rồi normalize lại (IP = cosine trên prefix)
+        index = faiss.IndexPreTransform(faiss.NormalizationTransform(d_index, 2.0), index)
+        index.prepend_transform(faiss.RemapDimensionsTransform(dim, d_index, False))
+    if not index.is_trained:
+        index.train(vecs)
+    if kind in ("ivf", "ivfpq"):
+        # IVF tự lưu id trong inverted lists; direct map dạng hashtable cho reconstruct() + remove_ids
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        index = faiss.IndexIDMap2(index)
+    add_blocks(index, vecs, labels)
+    apply_search_params(index, cfg["search"])
+    return index
+
+
+ADD_BLOCK = 16384
+
+
+def add_blocks(index, vecs: np.ndarray, labels: np.ndarray, binary: bool = False) -> None:
+    """add_with_ids từng block hàng: vecs có thể là memmap từ embed_stream, không copy cả ma trận."""
+    for start in range(0, vecs.shape[0], ADD_BLOCK):
+        block = np.ascontiguousarray(vecs[start:start + ADD_BLOCK], dtype="float32")
+        index.add_with_ids(binarize(block) if binary else block, labels[start:start + ADD_BLOCK])
+
+
+def index_nbytes(index) -> int:
+    if isinstance(index, faiss.IndexBinary):
+        return int(faiss.serialize_index_binary(index).nbytes)
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def apply_search_params(index, search: Dict[str, Any]) -> None:
+    if not search:
+        return
+    ps = faiss.ParameterSpace()
+    for name, value in (search or {}).items():
+        ps.set_index_parameter(index, name, value)
+
+
+# 4) Recall@k so với flat + latency
+def evaluate(index: faiss.Index, flat: faiss.Index, queries: np.ndarray, k: int = 10) -> Dict[str, float]:
+    _, I_true = flat.search(queries, k)
+    t0 = time.perf_counter()
+    I_parts = []
+    for q in queries:  # một query / lần = latency giống retriever
+        _, I = index.search(q.reshape(1, -1), k)
+        I_parts.append(I[0])
+    elapsed = time.perf_counter() - t0
+    hits = sum(len(set(a[a >= 0]) & set(b[b >= 0])) for a, b in zip(I_parts, I_true))
+    return {
+        "recall_at_k": hits / float(len(queries) * k),
+        "latency_ms": 1000.0 * elapsed / max(1, len(queries)),
+    }
+
+
+def search_grid(cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    kind = cfg["index_type"]
+    if kind == "hnsw":
+        return [{"efSearch": v} for v in (16, 32, 64, 128, 256)]
+    if kind in ("ivf", "ivfpq"):
+        nlist = cfg["params"]["nlist"]
+        return [{"nprobe": v} for v in sorted({1, 2, 4, 8, 16, 32, 64, nlist}) if v <= nlist]
+    return [{}]
+
+
+def report(vecs: np.ndarray, index, cfg: Dict[str, Any], k: int, n_queries: int,
+           seed: int = 0) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    live = np.flatnonzero(np.any(vecs != 0, axis=1))  # bỏ các hàng trống của chunk đã xoá
+    n_queries = min(n_queries, live.shape[0])
+    queries = np.ascontiguousarray(vecs[rng.choice(live, n_queries, replace=False)])
+    flat = faiss.IndexFlatIP(vecs.shape[1])
+    flat.add(vecs)
+    compress = cfg.get("compress", "none")
+    nbytes = index_nbytes(index)
+    memory = {"index_bytes": nbytes, "bytes_per_vector": nbytes / max(1, index.ntotal),
+              "memory_vs_flat": nbytes / float(index_nbytes(flat))}
+    binary = compress == "binary"
+    first_stage = RescoringIndex(index, binary=binary)
+    rescored = RescoringIndex(index, vecs, factor=cfg.get("rescore_factor") or 4, binary=binary)
+    label = f"{cfg['index_type']}/{compress}" if compress != "none" else cfg["index_type"]
+    rows = []
+    for search in search_grid(cfg):
+        apply_search_params(index, search)
+        m = evaluate(first_stage, flat, queries, k=k)
+        line = (f"  {label:15s} {json.dumps(cfg['params']):48s} {json.dumps(search):18s} "
+                f"recall@{k}={m['recall_at_k']:.3f}  latency={m['latency_ms']:.3f} ms/query  "
+                f"mem={memory['memory_vs_flat']:.3f}x flat")
+        if compress != "none":
+            # stage 2: rescore bằng vector float32 (vecs ở đây nằm trong RAM, thực tế mmap từ đĩa)
+            r = evaluate(rescored, flat, queries, k=k)
+            m.update({"recall_at_k_rescored": r["recall_at_k"], "latency_ms_rescored": r["latency_ms"]})
+            line += f"  rescored: recall@{k}={r['recall_at_k']:.3f} latency={r['latency_ms']:.3f} ms"
+        rows.append({"index_type": cfg["index_type"], "compress": compress, "reduce_dim": cfg.get("reduce_dim"),
+                     "params": cfg["params"], "search": search, **memory, **m})
+        print(line)
+    apply_search_params(index, cfg["search"])
+    return rows
+
+
+# 5) Lưu FAISS + mapping + metadata
+def write_outputs(out_dir: Path, prefix: str, index, vecs: np.ndarray, ids: List[Optional[str]],
+                  cfg: Dict[str, Any], model_name: str, build_id: str) -> None:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if isinstance(index, faiss.IndexBinary):
+        faiss.write_index_binary(index, str(out_dir / f"{prefix}.index"))
+    else:
+        faiss.write_index(index, str(out_dir / f"{prefix}.index"))
+    np.save(out_dir / f"{prefix}_vectors.npy", vecs)  # cho MMR (--vectors) + rescoring khi nén
+    with (out_dir / f"{prefix}_ids.json").open("w", encoding="utf-8") as f:
+        json.dump(ids, f, ensure_ascii=False, indent=2)
+    meta = {
+        **cfg,
+        "metric": "IP",
+        "dim": int(vecs.shape[1]),
+        "ntotal": int(index.ntotal),
+        "model": model_name,
+        "build_id": build_id,
+    }
+    with (out_dir / f"{prefix}.meta.json").open("w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+# 6) Build manifest + cập nhật tăng dần
+def write_build_manifest(out_dir: Path, prefix: str, chunks_path: Path, ids: List[Optional[str]],
+                         hashes: Dict[str, str], cfg: Dict[str, Any], model_name: str, ntotal: int,
+                         build_id: str) -> None:
+    """wstg_faiss.build.json: model, config, và {chunk id: [label, hash nội dung]}; ghi sau cùng."""
+    with (out_dir / f"{prefix}_ids.json").open("rb") as f:
+        ids_sha1 = hashlib.sha1(f.read()).hexdigest()
+    manifest = {
+        "format": 1,
+        "build_id": build_id,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model_name,
+        "config": cfg,
+        "chunks_path": str(chunks_path),
+        "chunks_fingerprint": chunks_fingerprint(chunks_path),
+        "chunks_stat": file_stat(chunks_path),
+        "ntotal": ntotal,
+        "n_labels": len(ids),
+        "ids_sha1": ids_sha1,
+        "ids_stat": file_stat(out_dir / f"{prefix}_ids.json"),
+        "chunks": {cid: [label, hashes[cid]] for label, cid in enumerate(ids) if cid is not None},
+    }
+    with (out_dir / f"{prefix}.build.json").open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def load_previous_build(out_dir: Path, prefix: str, model_name: str) -> Optional[Dict[str, Any]]:
+    """Build trước đó dùng lại được (cùng model, đủ file), hoặc None -> build lại toàn bộ."""
+    path = out_dir / f"{prefix}.build.json"
+    needed = [path, out_dir / f"{prefix}.index", out_dir / f"{prefix}_ids.json", out_dir / f"{prefix}_vectors.npy"]
+    if not all(p.exists() for p in needed):
+        return None
+    with path.open("r", encoding="utf-8") as f:
+        build = json.load(f)
+    if build.get("model") != model_name:
+        print(f"Model changed ({build.get('model')} -> {model_name}): re-embedding everything")
+        return None
+    return build
+
+
+def read_index_file(path: Path, cfg: Dict[str, Any]):
+    if cfg.get("compress") == "binary":
+        return faiss.read_index_binary(str(path))
+    return faiss.read_index(str(path))
+
+
+def update_build(build: Dict[str, Any], chunks_path: Path, ids: List[str], hashes: List[str],
+                 offsets: np.ndarray, lengths: np.ndarray, args: argparse.Namespace, out_dir: Path):
+    """
+    Diff chunks với build trước theo hash nội dung: chỉ embed chunk mới / đổi, chunk đổi giữ label
+    cũ, chunk mới nhận label mới ở cuối, chunk bị xoá -> remove_ids + null trong ids.json.
+    Chi phí tỉ lệ với phần thay đổi (HNSW không hỗ trợ remove_ids: build lại từ vector đã lưu,
+    không embed lại). Trả về (vecs, ids theo label, index, cfg, stats).
+    """
+    prefix = args.prefix
+    recorded: Dict[str, List[Any]] = build["chunks"]
+    with (out_dir / f"{prefix}_ids.json").open("r", encoding="utf-8") as f:
+        labels_to_ids: List[Optional[str]] = json.load(f)
+    vecs = np.array(np.load(out_dir / f"{prefix}_vectors.npy"), dtype="float32")
+    dim = vecs.shape[1]
+
+    current = set(ids)
+    removed = [cid for cid in recorded if cid not in current]
+    changed = [i for i, cid in enumerate(ids) if cid in recorded and recorded[cid][1] != hashes[i]]
+    new = [i for i, cid in enumerate(ids) if cid not in recorded]
+    stats = {"new": len(new), "changed": len(changed), "removed": len(removed),
+             "unchanged": len(ids) - len(new) - len(changed)}
+
+    todo = changed + new
+    t0 = time.perf_counter()
+    fresh = (embed_stream(chunks_path, offsets[todo], lengths[todo], [hashes[i] for i in todo], args, out_dir)
+             if todo else np.zeros((0, dim), dtype="float32"))
+    stats["embed_s"] = round(time.perf_counter() - t0, 3)
+
+    changed_labels = [recorded[ids[i]][0] for i in changed]
+    new_labels = list(range(len(labels_to_ids), len(labels_to_ids) + len(new)))
+    removed_labels = [recorded[cid][0] for cid in removed]
+    labels_to_ids.extend(ids[i] for i in new)
+    vecs = np.vstack([vecs, np.zeros((len(new), dim), dtype="float32")])
+    for label in removed_labels:
+        labels_to_ids[label] = None
+        vecs[label] = 0.0
+    upsert = np.asarray(changed_labels + new_labels, dtype="int64")
+    vecs[upsert] = fresh
+
+    cfg = build["config"]
+    live = np.asarray([label for label, cid in enumerate(labels_to_ids) if cid is not None], dtype="int64")
+    holes = len(labels_to_ids) - live.shape[0]
+    if (args.index_type, args.compress) != (cfg["index_type"], cfg.get("compress", "none")):
+        print(f"Index config changed: rebuilding {args.index_type}/{args.compress} from stored vectors")
+        cfg = index_config(args.index_type, live.shape[0], dim, args, compress=args.compress)
+        index = build_index(vecs[live], cfg, labels=live)
+    elif holes > args.compact_ratio * max(1, len(labels_to_ids)):
+        print(f"Compacting: {holes} empty labels of {len(labels_to_ids)}")
+        vecs, labels_to_ids = np.ascontiguousarray(vecs[live]), [labels_to_ids[i] for i in live]
+        index = build_index(vecs, cfg)
+    elif cfg["index_type"] == "hnsw":
+        index = build_index(vecs[live], cfg, labels=live)
+    else:
+        index = read_index_file(out_dir / f"{prefix}.index", cfg)
+        stale = np.asarray(changed_labels + removed_labels, dtype="int64")
+        if stale.size:
+            index.remove_ids(stale)
+        if upsert.size:
+            add_blocks(index, fresh, upsert, binary=cfg.get("compress") == "binary")
+    return vecs, labels_to_ids, index, cfg, stats
+
+
+def update_manifest(manifest_path: Path, name: str, chunks_path: Path, out_dir: Path, prefix: str) -> None:
+    """Thêm / cập nhật shard `name` trong manifest (rag_retrieve_clustered.py --shards), path tương đối."""
+    manifest = {"shards": []}
+    if manifest_path.exists():
+        with manifest_path.open("r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    base = manifest_path.resolve().parent
+
+    def rel(p: Path) -> str:
+        return Path(os.path.relpath(p.resolve(), base)).as_posix()
+
+    entry = {
+        "name": name,
+        "chunks": rel(chunks_path),
+        "faiss": rel(out_dir / f"{prefix}.index"),
+        "ids": rel(out_dir / f"{prefix}_ids.json"),
+        "vectors": rel(out_dir / f"{prefix}_vectors.npy"),
+    }
+    shards = [s for s in manifest.get("shards", []) if s.get("name") != name]
+    manifest["shards"] = shards + [entry]
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with manifest_path.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+SWEEP = [
+    ("flat", "none"), ("hnsw", "none"), ("ivf", "none"), ("ivfpq", "none"),
+    ("flat", "sq8"), ("flat", "binary"), ("flat", "pca"), ("flat", "truncate"),
+    ("hnsw", "sq8"), ("ivf", "sq8"),
+]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Embed chunks and build a FAISS index (flat / HNSW / IVF / IVF-PQ)")
+    ap.add_argument("--chunks", default="wstg_chunks.from_knowledge.jsonl", help="Chunks JSONL")
+    ap.add_argument("--from-vectors", default=None,
+                    help="Reuse an existing embedding matrix (.npy aligned with --chunks) instead of embedding")
+    ap.add_argument("--model", default=DEFAULT_MODEL, help="SentenceTransformer model")
+    ap.add_argument("--batch-size", type=int, default=32, help="Max chunks per encode batch")
+    ap.add_argument("--max-batch-tokens", type=int, default=8192,
+                    help="Cap batch size * longest chunk (tokens) so batches of long chunks stay small (0 = off)")
+    ap.add_argument("--length-tokenizer", default="approx",
+                    help="Tokenizer for the length buckets: approx, hf:<model> or tiktoken:<encoding>")
+    ap.add_argument("--workers", type=int, default=0,
+                    help="CPU worker processes, each with its own model copy (0 = encode in this process)")
+    ap.add_argument("--checkpoint-every", type=int, default=20,
+                    help="Flush vectors + write the resume checkpoint every N batches")
+    ap.add_argument("--out-dir", default=".", help="Output directory")
+    ap.add_argument("--prefix", default="wstg_faiss", help="Output file prefix")
+    ap.add_argument("--manifest", default=None,
+                    help="Add / update this corpus in a shard manifest (rag_retrieve_clustered.py --shards)")
+    ap.add_argument("--shard-name", default=None, help="Shard name in --manifest (default: --prefix)")
+
+    ap.add_argument("--index-type", default="flat", choices=["flat", "hnsw", "ivf", "ivfpq"])
+    ap.add_argument("--hnsw-m", type=int, default=32)
+    ap.add_argument("--ef-construction", type=int, default=200)
+    ap.add_argument("--ef-search", type=int, default=64)
+    ap.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = auto ~4*sqrt(N))")
+    ap.add_argument("--nprobe", type=int, default=16)
+    ap.add_argument("--pq-m", type=int, default=64, help="PQ sub-quantizers (must divide dim)")
+    ap.add_argument("--pq-nbits", type=int, default=8)
+
+    ap.add_argument("--compress", default="none", choices=["none", "sq8", "binary", "pca", "truncate"],
+                    help="Compressed first-stage vectors (full-precision vectors stay on disk for rescoring)")
+    ap.add_argument("--reduce-dim", type=int, default=256, help="Target dim for --compress pca/truncate")
+    ap.add_argument("--rescore-factor", type=int, default=4,
+                    help="Rescore k * factor first-stage candidates with full-precision vectors (0 = off)")
+
+    ap.add_argument("--full", action="store_true",
+                    help="Re-embed every chunk (default: only new / changed chunks when a build manifest exists)")
+    ap.add_argument("--compact-ratio", type=float, default=0.25,
+                    help="Rebuild with dense labels once removed chunks leave more than this fraction of labels empty")
+
+    ap.add_argument("--report", action="store_true", help="Report recall@k vs flat and latency")
+    ap.add_argument("--sweep", action="store_true",
+                    help="Build + report every index type and compression (writes only <prefix>.sweep.json)")
+    ap.add_argument("--k", type=int, default=10, help="k for recall@k")
+    ap.add_argument("--eval-queries", type=int, default=200, help="Sampled corpus vectors used as queries")
+    args = ap.parse_args()
+
+    chunks_path = Path(args.chunks)
+    ids, hashes, offsets, lengths = scan_chunks(chunks_path, TokenCounter(args.length_tokenizer))
+    if not ids:
+        raise SystemExit(f"No indexable chunks in {chunks_path} (empty file, or only parent chunks)")
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    previous = None
+    if not (args.full or args.from_vectors or args.sweep):
+        previous = load_previous_build(out_dir, args.prefix, args.model)
+
+    if previous is not None:
+        vecs, labels_to_ids, index, cfg, stats = update_build(previous, chunks_path, ids, hashes, offsets, lengths,
+                                                              args, out_dir)
+        print(f"Incremental update: {stats['new']} new, {stats['changed']} changed, {stats['removed']} removed, "
+              f"{stats['unchanged']} unchanged (embedding took {stats['embed_s']}s)")
+    else:
+        if args.from_vectors:
+            vecs = np.ascontiguousarray(np.load(args.from_vectors), dtype="float32")
+            if vecs.shape[0] != len(ids):
+                raise SystemExit(f"--from-vectors rows ({vecs.shape[0]}) != chunks ({len(ids)})")
+        else:
+            vecs = embed_stream(chunks_path, offsets, lengths, hashes, args, out_dir)
+        labels_to_ids = list(ids)
+    n, dim = vecs.shape
+
+    if args.sweep:
+        rows = []
+        for kind, compress in SWEEP:
+            cfg = index_config(kind, n, dim, args, compress=compress)
+            t0 = time.perf_counter()
+            index = build_index(vecs, cfg)
+            print(f"[{kind}/{compress}] built in {time.perf_counter() - t0:.2f}s")
+            rows.extend(report(vecs, index, cfg, args.k, args.eval_queries))
+        with (out_dir / f"{args.prefix}.sweep.json").open("w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        return
+
+    if previous is None:
+        cfg = index_config(args.index_type, n, dim, args, compress=args.compress)
+        index = build_index(vecs, cfg)
+    build_id = uuid.uuid4().hex
+    write_outputs(out_dir, args.prefix, index, vecs, labels_to_ids, cfg, args.model, build_id)
+    write_build_manifest(out_dir, args.prefix, chunks_path, labels_to_ids, dict(zip(ids, hashes)), cfg,
+                         args.model, int(index.ntotal), build_id)
+    clear_checkpoint(out_dir, args.prefix)
+    print(f"Wrote {cfg['index_type']} index ({index.ntotal} x {dim}, compress={cfg.get('compress', 'none')}) "
+          f"to {out_dir / (args.prefix + '.index')}")
+    if args.manifest:
+        name = args.shard_name or args.prefix
+        update_manifest(Path(args.manifest), name, Path(args.chunks), out_dir, args.prefix)
+        print(f"Updated shard {name!r} in {args.manifest}")
+    if args.report:
+        rows = report(vecs, index, cfg, args.k, args.eval_queries)
+        with (out_dir / f"{args.prefix}.report.json").open("w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the OpenAI chat completions API, so read_books.py can be run
+and its throughput benchmarked offline (no key, no cost, deterministic output).
+
+ - POST /v1/chat/completions: with a json_schema response_format (the
+   PageContent parse() call) the answer is {"has_content", "knowledge"} built
+   from the non-empty lines of the page text; otherwise a short markdown summary
+ - Simulated latency (--latency-ms +- --jitter-ms), injected transient errors
+   (--error-rate: 429 with Retry-After / 500) and a server-side RPM limit
+   (--rpm, 429 when exceeded) to exercise the client's limiter and retries
+ - usage (prompt / completion tokens ~ chars / 4) is reported like the real API
+ - GET /stats: request / error counters
+
+Example:
+  python mock_openai_server.py --port 8000 --latency-ms 800 --error-rate 0.05
+  python read_books.py --base-url http://127.0.0.1:8000/v1 --concurrency 16 --pages 40
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+MAX_POINTS = 8
+MAX_POINT_CHARS = 200
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def page_knowledge(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    text = str(messages[-1].get("content", "")) if messages else ""
+    text = text.split("Page text:", 1)[-1]
+    lines = [line.strip() for line in text.splitlines() if len(line.strip()) > 3]
+    return {"has_content": bool(lines), "knowledge": [line[:MAX_POINT_CHARS] for line in lines[:MAX_POINTS]]}
+
+
+def summary_markdown(messages: List[Dict[str, Any]]) -> str:
+    text = str(messages[-1].get("content", "")) if messages else ""
+    points = text.split("Content:", 1)[-1].strip().splitlines()
+    return "## Summary\n\n" + "\n".join(f"- {p[:MAX_POINT_CHARS]}" for p in points[:MAX_POINTS])
+
+
+class MockState:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.lock = threading.Lock()
+        self.allowance, self.updated = float(args.rpm), time.monotonic()  # --rpm token bucket
+        self.counts = {"requests": 0, "ok": 0, "rate_limited": 0, "server_errors": 0}
+
+    def admit(self) -> int:
+        """HTTP status for the next request: 200, or an injected / rate-limit error."""
+        now = time.monotonic()
+        with self.lock:
+            self.counts["requests"] += 1
+            if self.args.rpm:
+                rpm = self.args.rpm
+                self.allowance = min(rpm, self.allowance + (now - self.updated) * rpm / 60.0)
+                self.updated = now
+                if self.allowance < 1:
+                    self.counts["rate_limited"] += 1
+                    return 429
+                self.allowance -= 1
+            if random.random() < self.args.error_rate:
+                status = random.choice((429, 500))
+                self.counts["rate_limited" if status == 429 else "server_errors"] += 1
+                return status
+            self.counts["ok"] += 1
+            return 200
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *a):
+            if state.args.verbose:
+                super().log_message(fmt, *a)
+
+        def _send(self, status: int, payload: Dict[str, Any], headers: Dict[str, str] = None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with state.lock:
+                    self._send(200, dict(state.counts))
+            else:
+                self._send(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                req = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._send(400, {"error": {"message": "invalid JSON", "type": "invalid_request_error"}})
+                return
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+            args = state.args
+            delay = max(0.0, random.gauss(args.latency_ms, args.jitter_ms)) / 1000.0 if args.jitter_ms else \
+                args.latency_ms / 1000.0
+            time.sleep(delay)
+            status = state.admit()
+            if status == 429:
+                self._send(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                           {"Retry-After": str(args.retry_after)})
+                return
+            if status != 200:
+                self._send(status, {"error": {"message": "Internal error (mock)", "type": "server_error"}})
+                return
+
+            messages = req.get("messages") or []
+            fmt = (req.get("response_format") or {}).get("type")
+            content = json.dumps(page_knowledge(messages)) if fmt == "json_schema" else summary_markdown(messages)
+            prompt_tokens = sum(approx_tokens(str(m.get("content", ""))) for m in messages)
+            completion_tokens = approx_tokens(content)
+            self._send(200, {
+                "id": f"chatcmpl-mock-{time.time_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": req.get("model", "mock"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content, "refusal": None}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+    return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server (offline benchmarks)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--latency-ms", type=float, default=800.0, help="Mean response latency")
+    ap.add_argument("--jitter-ms", type=float, default=200.0, help="Latency standard deviation")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429 / 500")
+    ap.add_argument("--rpm", type=int, default=0, help="Server-side requests per minute limit (0 = off)")
+    ap.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--verbose", action="store_true", help="Log every request")
+    args = ap.parse_args()
+    random.seed(args.seed)
+
+    state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    print(f"Mock OpenAI API on http://{args.host}:{args.port}/v1 "
+          f"(latency {args.latency_ms:.0f}+-{args.jitter_ms:.0f} ms, error rate {args.error_rate})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Stats: {json.dumps(state.counts)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the retrieval scripts, kept apart from the retriever so that
+embed.py and chunk_knowledge.py do not import all of rag_retrieve_clustered.py:
+ - lazy heavy imports with startup-time accounting (STARTUP_TIMINGS)
+ - chunk identity: parent / child filter, text hash, file fingerprint + size / mtime
+ - sign-bit binarization and two-stage rescoring over compressed FAISS indexes
+ - WSTG test-family keywords and ids
+ - local token counting (TokenCounter)
+rag_retrieve_clustered.py re-exports what it uses, so rag.<name> keeps working.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import importlib
+import re
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Startup cost accounting (imports + loads), reported with --startup-report
+STARTUP_TIMINGS: Dict[str, float] = {}
+
+
+# =========================
+# Utilities
+# =========================
+@contextmanager
+def timed(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0.0) + (time.perf_counter() - t0)
+
+
+_LAZY_MODULES: Dict[str, Any] = {}
+
+
+def lazy_import(name: str):
+    """
+    Import heavy dependencies (faiss, sentence_transformers/torch) on first use
+    only, so e.g. --sparse-only never loads them. Import time is recorded.
+    """
+    mod = _LAZY_MODULES.get(name)
+    if mod is None:
+        with timed(f"import:{name}"):
+            mod = importlib.import_module(name)
+        _LAZY_MODULES[name] = mod
+    return mod
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def is_indexed_chunk(obj: Dict[str, Any]) -> bool:
+    """
+    Parent chunks (meta.level == "parent", written by chunk_knowledge.py) are
+    delivered context only: they are not embedded and not in BM25, their
+    children are what gets matched.
+    """
+    return (obj.get("meta") or {}).get("level") != "parent"
+
+
+# =========================
+# Chunk identity (embed.py build manifest, persisted sidecar indexes)
+# =========================
+def chunk_text_hash(text: str) -> str:
+    """Content hash of a chunk's text (what gets embedded); embed.py re-embeds a chunk when it changes."""
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+def chunks_fingerprint(path: Path) -> str:
+    h = hashlib.sha1()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_stat(path: Path) -> List[int]:
+    """[size, mtime_ns], recorded next to a content fingerprint so later checks need not read the file."""
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def same_source(path: Path, fingerprint: Optional[str], recorded_stat: Optional[List[int]],
+                verify: bool = False) -> bool:
+    """
+    Whether `path` is still the file something was built from. Matching size +
+    mtime is trusted without reading the file; the sha1 fingerprint is only
+    computed when they differ (e.g. a copied file) or with verify=True (--verify).
+    """
+    if not verify and recorded_stat and list(recorded_stat) == file_stat(path):
+        return True
+    return bool(fingerprint) and chunks_fingerprint(path) == fingerprint
+
+
+# =========================
+# Compressed first stage + full-precision rescoring
+# =========================
+def binarize(vecs: np.ndarray) -> np.ndarray:
+    """Sign bits packed 8 per byte (IndexBinary codes); shared by embed.py and queries."""
+    return np.packbits(np.asarray(vecs) > 0, axis=1)
+
+
+def rescore(queries: np.ndarray, I: np.ndarray, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact inner products of each query with its first-stage candidates I
+    (FAISS rows, -1 = empty) against the full-precision `vectors`; returns the
+    top-k (D, I). Candidate rows are gathered once, in sorted order, so an
+    mmap'd matrix is read mostly sequentially.
+    """
+    nq = I.shape[0]
+    D_out = np.full((nq, k), -np.inf, dtype="float32")
+    I_out = np.full((nq, k), -1, dtype="int64")
+    valid = I >= 0
+    rows = np.unique(I[valid])
+    if rows.size == 0:
+        return D_out, I_out
+    full = np.asarray(vectors[rows], dtype="float32")
+    pos = np.searchsorted(rows, np.where(valid, I, rows[0]))
+    for qi in range(nq):
+        scores = full[pos[qi]] @ queries[qi]
+        scores[~valid[qi]] = -np.inf
+        top = np.argsort(-scores, kind="stable")[:k]
+        top = top[np.isfinite(scores[top])]
+        D_out[qi, :len(top)] = scores[top]
+        I_out[qi, :len(top)] = I[qi, top]
+    return D_out, I_out
+
+
+class RescoringIndex:
+    """
+    Two-stage search over a compressed index (embed.py --compress: int8 SQ,
+    binary codes, PCA / truncated dims): fetch k * factor candidates from
+    `index`, rescore them against the full-precision `vectors` (the mmap'd
+    <prefix>_vectors.npy aligned with the FAISS rows) and keep the top k.
+    Without vectors the first-stage scores are returned (binary: d - 2 * hamming,
+    the inner product of the ±1 codes). Quacks like a faiss.Index for retrieve().
+    """
+
+    def __init__(self, index, vectors: Optional[np.ndarray] = None, factor: int = 4, binary: bool = False):
+        faiss = lazy_import("faiss")
+        self.index = index
+        self.vectors = vectors
+        self.factor = max(1, int(factor))
+        self.binary = binary
+        self.d = int(index.d)
+        self.ntotal = int(index.ntotal)
+        if binary or vectors is not None:
+            self.metric_type = faiss.METRIC_INNER_PRODUCT
+        else:
+            self.metric_type = getattr(index, "metric_type", faiss.METRIC_INNER_PRODUCT)
+
+    def first_stage(self, queries: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        if self.binary:
+            D, I = self.index.search(binarize(queries), k, params=params)
+            return (self.d - 2 * D).astype("float32"), I
+        return self.index.search(queries, k, params=params)
+
+    def search(self, queries: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(queries, dtype="float32")
+        if self.vectors is None:
+            return self.first_stage(queries, k, params=params)
+        _, I = self.first_stage(queries, min(self.ntotal, k * self.factor), params=params)
+        return rescore(queries, I, self.vectors, k)
+
+    def reconstruct_batch(self, rows: np.ndarray) -> np.ndarray:
+        if self.vectors is not None:
+            return np.asarray(self.vectors[np.asarray(rows, dtype="int64")], dtype="float32")
+        if self.binary:
+            raise RuntimeError("binary codes cannot be reconstructed")
+        return self.index.reconstruct_batch(rows)
+
+
+# =========================
+# WSTG test families
+# =========================
+WSTG_ID_RE = re.compile(r"\bWSTG-([A-Z]{4})-\d{2}\b")
+
+# WSTG v4.2 test families (chapter 4.x) -> keywords; a chunk is tagged with a
+# family when its text mentions an explicit WSTG-<FAMILY>-NN id or at least
+# CATEGORY_MIN_HITS of the keywords. Explicit meta.category wins.
+WSTG_CATEGORY_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "INFO": ("information gathering", "fingerprint", "reconnaissance", "search engine", "entry points",
+             "application architecture", "webpage content", "metafiles"),
+    "CONF": ("configuration", "deployment", "http methods", "strict transport", "file extension",
+             "backup", "admin interface", "cloud storage", "subdomain takeover", "content security policy"),
+    "IDNT": ("identity management", "user registration", "account provisioning", "account enumeration",
+             "username policy", "role definitions"),
+    "ATHN": ("authentication", "password", "credential", "lockout", "login", "remember me",
+             "multi-factor", "security question", "default credentials"),
+    "ATHZ": ("authorization", "privilege escalation", "direct object reference", "idor", "path traversal",
+             "directory traversal", "bypassing authorization", "oauth"),
+    "SESS": ("session", "cookie", "csrf", "cross site request forgery", "cross-site request forgery",
+             "logout", "session fixation", "session hijacking"),
+    "INPV": ("injection", "cross site scripting", "cross-site scripting", "xss", "sql", "xxe", "ssrf",
+             "template injection", "parameter pollution", "http splitting", "smuggling", "input validation"),
+    "ERRH": ("error handling", "stack trace", "error code", "improper error"),
+    "CRYP": ("cryptograph", "tls", "ssl", "cipher", "padding oracle", "encryption", "unencrypted"),
+    "BUSL": ("business logic", "workflow", "unexpected file", "malicious file", "function limits",
+             "request forgery", "integrity checks"),
+    "CLNT": ("client-side", "client side", "dom-based", "dom based", "javascript execution", "clickjacking",
+             "cors", "websocket", "web messaging", "browser storage", "html injection", "url redirect"),
+    "APIT": ("graphql", "api testing", "rest api"),
+}
+CATEGORY_MIN_HITS = 2
+_CATEGORY_RES = {cat: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in kws) + r")", re.IGNORECASE)
+                 for cat, kws in WSTG_CATEGORY_KEYWORDS.items()}
+
+
+def category_hits(text: str) -> Dict[str, int]:
+    """Keyword hits per WSTG family (WSTG_CATEGORY_KEYWORDS) in `text`."""
+    return {cat: len(rx.findall(text)) for cat, rx in _CATEGORY_RES.items()}
+
+
+# =========================
+# Token counting (context packing, chunk sizes)
+# =========================
+APPROX_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+class TokenCounter:
+    """
+    Local tokenizer for the packing budget:
+      - "tiktoken:<encoding>" (e.g. tiktoken:cl100k_base, the OpenAI chat models)
+      - "hf:<model>"          (transformers AutoTokenizer, from the local HF cache)
+      - "approx"              (words + punctuation, no dependency)
+      - "auto"                (tiktoken cl100k_base if installed and loadable, else approx)
+    """
+
+    def __init__(self, spec: str = "auto"):
+        self.spec = spec
+        self._encode = None
+        kind, _, name = spec.partition(":")
+        if kind == "auto":
+            try:
+                kind, name = "tiktoken", "cl100k_base"
+                self._encode = lazy_import("tiktoken").get_encoding(name).encode
+            except ImportError:
+                eprint("[info] tiktoken not installed; counting approximate tokens")
+                kind = "approx"
+            except Exception as e:
+                # get_encoding() downloads the BPE file on first use; offline hosts fail here
+                eprint(f"[warn] tiktoken encoding {name} unavailable ({e!r}); counting approximate tokens")
+                kind = "approx"
+        elif kind == "tiktoken":
+            self._encode = lazy_import("tiktoken").get_encoding(name or "cl100k_base").encode
+        elif kind == "hf":
+            if not name:
+                raise ValueError("hf tokenizer needs a model name, e.g. hf:BAAI/bge-large-en-v1.5")
+            tok = lazy_import("transformers").AutoTokenizer.from_pretrained(name)
+            self._encode = functools.partial(tok.encode, add_special_tokens=False)
+        elif kind != "approx":
+            raise ValueError(f"unknown tokenizer {spec!r} (tiktoken:<enc>, hf:<model>, approx, auto)")
+        self.name = kind if kind == "approx" else f"{kind}:{name or 'cl100k_base'}"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encode is None:
+            return len(APPROX_TOKEN_RE.findall(text))
+        return len(self._encode(text))
@@ -4,13 +4,48 @@
 RAG Retriever (cross-platform) — features:
  - Cross-platform paths, no hard-coded /mnt/data
  - Auto-pick SentenceTransformer embedder to match FAISS index dimension
- - Multi-Query variants (+ optional HyDE)
- - Dense FAISS search
+ - sbert (PyTorch) or onnx backend (--backend onnx: exported once, cached, optional dynamic
+   int8 quantization, onnxruntime thread settings, --onnx-check agreement with sbert)
+ - Multi-Query variants (+ optional HyDE), encoded in one batch
+ - Dense FAISS search (one search call over the stacked variant matrix); flat, HNSW,
+   IVF or IVF-PQ indexes with search params from embed.py metadata (--nprobe/--ef-search)
+ - Compressed indexes (int8 SQ, binary codes, PCA / truncated dims) with full-precision
+   rescoring of the top candidates against the mmap'd vectors (--rescore-factor)
+ - Incrementally updated ID-mapped indexes from embed.py: FAISS label == position in the ids
+   file (null for removed chunks); the build manifest (wstg_faiss.build.json) is checked at
+   load so index, ids and chunks come from the same build
+ - Query-embedding cache: in-process LRU + optional SQLite store (--embed-cache), prewarmable
+ - Semantic result cache (--result-cache 0.97): near-duplicate queries (cosine of the query
+   embeddings, same options and corpus version) reuse the full result; TTL + LRU eviction,
+   hit-rate stats
+ - Batch mode (--queries-file): many queries per embedding/search call, JSONL output
  - Optional Hybrid: BM25 (sparse) + RRF fusion with dense
- - Optional MMR diversification
- - Optional Cross-Encoder reranking
- - Parent-Child expansion (if chunk.meta.parent_id exists)
+   (persisted inverted index, memory-mapped, built once next to the FAISS index)
+ - Optional MMR diversification (stored chunk vectors, incremental NumPy MMR)
+ - Optional Cross-Encoder reranking (score cache; batch mode / server coalesce pairs
+   across queries into large predict calls)
+ - Metadata filters (--filter "category=ATHN and item>=100"): chunk fields indexed at load,
+   applied inside FAISS (ID selector bitmap) and inside the BM25 postings
+ - Parent-Child expansion (if chunk.meta.parent_id exists; chunk_knowledge.py writes small
+   children per WSTG section plus their parents, parents are not embedded / in BM25)
+ - Token-budget packing (--token-budget N, local tokenizer): parent / child and overlapping
+   chunk text deduplicated, greedy fill by final score, sentence-boundary trimming,
+   structured JSON output with token counts
+ - Optional mmap'd chunk store (--chunk-store) and memory-mapped FAISS index (--mmap-index)
  - Context preview printing
+ - BM25-only mode (--sparse-only) and lazy heavy imports: faiss / torch load only when needed;
+   --startup-report records import / load timings
+ - Per-stage tracing (wall / CPU time, candidate counts, batch sizes): Tracer passed to
+   retrieve(), --profile [PATH] JSON traces, --cprofile PATH, pluggable sinks
+   (server aggregates histograms on GET /metrics)
+ - Concurrent branches (--branch-workers: BM25 alongside encode + FAISS, chunk prefetch
+   before rerank), asyncio API (aretrieve(), RetrievalResources.arun()), thread caps
+   for torch / FAISS (--torch-threads / --faiss-threads)
+ - Multi-corpus shards (--shards manifest.json): per-corpus index / ids / chunks / BM25,
+   parallel fan-out across shards, global top-k merge (dense scores compared raw or
+   normalized per shard, BM25 lists merged by rank before RRF)
+ - Server mode (--serve): models/indexes loaded once, JSON over HTTP or a Unix socket;
+   --server forwards a CLI query to a running server
 
 Example (PowerShell):
   python .\\rag_retrieve_clustered.py `
@@ -26,33 +61,75 @@ Example (PowerShell):
     --hybrid --rrf-k 60 `
     --rerank --mmr `
     --print-context
+
+Server / client:
+  python rag_retrieve_clustered.py --chunks ... --faiss ... --ids ... --serve --port 8765 --workers 4
+  python rag_retrieve_clustered.py --server http://127.0.0.1:8765 --query "IDOR testing" --hybrid
+  curl -s localhost:8765/retrieve -d '{"query": "IDOR testing", "hybrid": true, "deliver_to_llm": 5}'
+
+Several corpora (manifest written by embed.py --manifest, one entry per corpus):
+  python rag_retrieve_clustered.py --shards out/shards.json --query "IDOR testing" --hybrid
+
+BM25 only (no faiss / torch imported at all):
+  python rag_retrieve_clustered.py --chunks out/wstg_chunks.from_knowledge.jsonl --sparse-only \
+    --query "IDOR testing" --startup-report
 """
+from __future__ import annotations
+
+import time
+
+_T_MODULE_START = time.perf_counter()
+
 import argparse
+import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
+import http.client
 import json
 import sys
 import math
+import mmap
+import queue
 import re
+import socket
+import socketserver
+import sqlite3
+import stat
+import threading
+from collections import ChainMap, OrderedDict
+from contextlib import contextmanager
+from collections.abc import Mapping
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse
 from pathlib import Path
-from typing import Dict, List, Tuple, Any, Optional
+from typing import TYPE_CHECKING, Dict, List, Tuple, Any, Optional, Union
 
+if TYPE_CHECKING:
+    from faiss import Index as FaissIndex
+else:
+    FaissIndex = Any  # faiss is only imported lazily; annotations must resolve without it
+
+_t = time.perf_counter()
 import numpy as np
-import faiss
 
-# sentence-transformers for embeddings + reranker (optional)
-try:
-    from sentence_transformers import SentenceTransformer, CrossEncoder
-except Exception:
-    SentenceTransformer = None
-    CrossEncoder = None
+_t_numpy = time.perf_counter()
+from rag_common import (CATEGORY_MIN_HITS, STARTUP_TIMINGS, WSTG_ID_RE, RescoringIndex, TokenCounter, category_hits,
+                        chunk_text_hash, chunks_fingerprint, eprint, file_stat, is_indexed_chunk, lazy_import,
+                        same_source, timed)
+
+# Startup cost accounting (imports + loads), reported with --startup-report
+STARTUP_TIMINGS.update({
+    "import:stdlib": _t - _T_MODULE_START,
+    "import:numpy": _t_numpy - _t,
+})
 
 
 # =========================
 # Utilities
 # =========================
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
-
-
 def read_json(path: Path):
     with path.open("r", encoding="utf-8") as f:
         return json.load(f)
@@ -82,6 +159,280 @@ def normalize(vecs: np.ndarray) -> np.ndarray:
     return (vecs / norms).astype("float32")
 
 
+# =========================
+# Tracing (per-stage wall / CPU time, candidate counts, batch sizes)
+# =========================
+class Tracer:
+    """
+    Records one span per retrieval stage:
+      {"stage": "encode", "wall_ms": ..., "cpu_ms": ..., "thread_cpu_ms": ..., <attrs>}
+    cpu_ms is process-wide (includes BLAS / torch worker threads), thread_cpu_ms
+    only the calling thread. Attributes such as candidate counts or model batch
+    sizes are passed to stage() or set on the yielded span dict.
+
+    finish() closes the trace and hands it to every sink (any object with an
+    emit(trace) method, e.g. JsonlTraceSink or HistogramSink).
+    """
+    enabled = True
+
+    def __init__(self, sinks: Optional[List[Any]] = None, **attrs):
+        self.sinks = list(sinks or [])
+        self.attrs = dict(attrs)
+        self.spans: List[Dict[str, Any]] = []
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+
+    @contextmanager
+    def stage(self, name: str, **attrs):
+        span: Dict[str, Any] = {"stage": name, **attrs}
+        t0, c0, tc0 = time.perf_counter(), time.process_time(), time.thread_time()
+        try:
+            yield span
+        finally:
+            span["wall_ms"] = round(1000.0 * (time.perf_counter() - t0), 3)
+            span["cpu_ms"] = round(1000.0 * (time.process_time() - c0), 3)
+            span["thread_cpu_ms"] = round(1000.0 * (time.thread_time() - tc0), 3)
+            self.spans.append(span)
+
+    def stage_totals(self) -> Dict[str, float]:
+        """Wall ms per stage name (a stage can occur more than once, e.g. per query in a batch)."""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span["stage"]] = totals.get(span["stage"], 0.0) + span["wall_ms"]
+        return totals
+
+    def finish(self, **attrs) -> Dict[str, Any]:
+        trace = {
+            **self.attrs,
+            **attrs,
+            "wall_ms": round(1000.0 * (time.perf_counter() - self._t0), 3),
+            "cpu_ms": round(1000.0 * (time.process_time() - self._c0), 3),
+            "stages": self.spans,
+        }
+        for sink in self.sinks:
+            sink.emit(trace)
+        return trace
+
+
+class _NullTracer(Tracer):
+    """Default tracer: stages cost one generator call, nothing is recorded."""
+    enabled = False
+
+    def __init__(self):
+        super().__init__()
+
+    @contextmanager
+    def stage(self, name: str, **attrs):
+        yield {}
+
+    def finish(self, **attrs) -> Dict[str, Any]:
+        return {}
+
+
+NULL_TRACER = _NullTracer()
+
+
+class JsonlTraceSink:
+    """Append each finished trace as one JSON line (thread-safe); path None = stderr."""
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, trace: Dict[str, Any]) -> None:
+        line = json.dumps(trace, ensure_ascii=False)
+        with self._lock:
+            if self.path is None:
+                eprint("[profile] " + line)
+            else:
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+
+class HistogramSink:
+    """
+    Aggregates wall-time histograms per stage (plus "total") with fixed
+    cumulative buckets in ms, Prometheus-style. Thread-safe; snapshot() is
+    what the server exposes on GET /metrics.
+    """
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, buckets_ms: Optional[Tuple[float, ...]] = None):
+        self.buckets_ms = tuple(buckets_ms or self.BUCKETS_MS)
+        self._lock = threading.Lock()
+        self._hist: Dict[str, Dict[str, Any]] = {}
+
+    def _observe(self, name: str, wall_ms: float, cpu_ms: float) -> None:
+        h = self._hist.get(name)
+        if h is None:
+            h = self._hist[name] = {"count": 0, "sum_ms": 0.0, "cpu_sum_ms": 0.0,
+                                    "buckets": [0] * (len(self.buckets_ms) + 1)}
+        h["count"] += 1
+        h["sum_ms"] += wall_ms
+        h["cpu_sum_ms"] += cpu_ms
+        h["buckets"][bisect.bisect_left(self.buckets_ms, wall_ms)] += 1
+
+    def emit(self, trace: Dict[str, Any]) -> None:
+        with self._lock:
+            self._observe("total", trace["wall_ms"], trace["cpu_ms"])
+            for span in trace["stages"]:
+                self._observe(span["stage"], span["wall_ms"], span["cpu_ms"])
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"le_{b:g}" for b in self.buckets_ms] + ["le_inf"]
+        with self._lock:
+            out: Dict[str, Any] = {}
+            for name, h in self._hist.items():
+                cumulative = np.cumsum(h["buckets"]).tolist()
+                out[name] = {
+                    "count": h["count"],
+                    "sum_ms": round(h["sum_ms"], 3),
+                    "cpu_sum_ms": round(h["cpu_sum_ms"], 3),
+                    "mean_ms": round(h["sum_ms"] / h["count"], 3),
+                    "buckets": dict(zip(labels, cumulative)),
+                }
+            return out
+
+
+# =========================
+# Chunk store (mmap'd text blob + offset table, lazy per-id access)
+# =========================
+class ChunkStore(Mapping):
+    """
+    Read-only, dict-like view of the chunks file that never materializes it:
+      - text.bin    : UTF-8 texts back to back
+      - spans.npy   : int64 [N, 2] (start, end) byte span per row
+      - columns.json: ids + every non-text field as one list per field (columnar)
+    Rows follow the FAISS ids order (row i == FAISS row i); chunks that are not
+    in the index (e.g. parents) come after. `store[cid]` decodes one chunk.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory: Path):
+        cols = read_json(directory / "columns.json")
+        if cols.get("version") != self.FORMAT_VERSION:
+            raise ValueError(f"Unsupported chunk store version in {directory}: {cols.get('version')}")
+        self.directory = directory
+        self.fingerprint = cols.get("fingerprint", "")
+        self.source_stat: Optional[List[int]] = cols.get("source_stat")
+        self.ids: List[str] = cols["ids"]
+        self.columns: Dict[str, List[Any]] = cols["columns"]
+        self.row_of = {cid: i for i, cid in enumerate(self.ids)}
+        self.spans = np.load(directory / "spans.npy", mmap_mode="r")
+        self._file = (directory / "text.bin").open("rb")
+        size = (directory / "text.bin").stat().st_size
+        self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @classmethod
+    def build(cls, chunks_path: Path, directory: Path, order: Optional[List[str]] = None,
+              fingerprint: str = "", source_stat: Optional[List[int]] = None) -> None:
+        """Stream the JSONL once; text goes straight to disk, other fields to columns."""
+        directory.mkdir(parents=True, exist_ok=True)
+        ids: List[str] = []
+        spans: List[Tuple[int, int]] = []
+        rows: List[Dict[str, Any]] = []
+        pos = 0
+        with (directory / "text.bin").open("wb") as blob, chunks_path.open("r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                obj = json.loads(line)
+                cid = obj.get("id")
+                if not cid:
+                    continue
+                data = (obj.get("text") or "").encode("utf-8")
+                blob.write(data)
+                ids.append(cid)
+                spans.append((pos, pos + len(data)))
+                rows.append({k: v for k, v in obj.items() if k not in ("id", "text")})
+                pos += len(data)
+
+        # Align rows with the FAISS ids, extra chunks last (file order)
+        last = {cid: i for i, cid in enumerate(ids)}  # duplicate ids: last line wins, like read_chunks_jsonl
+        ordered = [last[cid] for cid in (order or []) if cid in last]
+        in_order = set(ordered)
+        ordered += [i for cid, i in last.items() if i not in in_order]
+
+        names: List[str] = []
+        for i in ordered:
+            for k in rows[i]:
+                if k not in names:
+                    names.append(k)
+        columns = {k: [rows[i].get(k) for i in ordered] for k in names}
+        np.save(directory / "spans.npy", np.asarray([spans[i] for i in ordered], dtype="int64").reshape(-1, 2))
+        with (directory / "columns.json").open("w", encoding="utf-8") as f:
+            json.dump({"version": cls.FORMAT_VERSION, "fingerprint": fingerprint, "source_stat": source_stat,
+                       "ids": [ids[i] for i in ordered], "columns": columns}, f, ensure_ascii=False)
+
+    @classmethod
+    def open_or_build(cls, chunks_path: Path, directory: Path,
+                      order: Optional[List[str]] = None, verify: bool = False) -> "ChunkStore":
+        if (directory / "columns.json").exists():
+            try:
+                store = cls(directory)
+                if same_source(chunks_path, store.fingerprint, store.source_stat, verify=verify):
+                    return store
+                store.close()
+                eprint(f"[info] Chunk store at {directory} is stale, rebuilding.")
+            except Exception as e:
+                eprint(f"[warn] Could not open chunk store at {directory}: {e}. Rebuilding.")
+        source_stat = file_stat(chunks_path)
+        cls.build(chunks_path, directory, order=order, fingerprint=chunks_fingerprint(chunks_path),
+                  source_stat=source_stat)
+        return cls(directory)
+
+    def text(self, cid: str) -> str:
+        start, end = self.spans[self.row_of[cid]]
+        return self._blob[int(start):int(end)].decode("utf-8")
+
+    def __getitem__(self, cid: str) -> Dict[str, Any]:
+        row = self.row_of[cid]
+        start, end = self.spans[row]
+        obj: Dict[str, Any] = {"id": cid, "text": self._blob[int(start):int(end)].decode("utf-8")}
+        for k, col in self.columns.items():
+            if col[row] is not None:
+                obj[k] = col[row]
+        return obj
+
+    def __contains__(self, cid: object) -> bool:
+        return cid in self.row_of
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def close(self) -> None:
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
+
+
+def read_faiss_index(path: Path, use_mmap: bool = False, binary: bool = False) -> FaissIndex:
+    """
+    Read a FAISS index, memory-mapped when asked and the index type allows it
+    (flat codes via IO_FLAG_MMAP_IFC, IVF lists via IO_FLAG_MMAP); falls back to
+    a normal read otherwise. `binary` reads an IndexBinary (embed.py --compress binary).
+    """
+    faiss = lazy_import("faiss")
+    read = faiss.read_index_binary if binary else faiss.read_index
+    if use_mmap:
+        flags = [getattr(faiss, "IO_FLAG_MMAP_IFC", None),
+                 faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY]
+        for flag in flags:
+            if flag is None:
+                continue
+            try:
+                return read(str(path), flag)
+            except RuntimeError:
+                continue
+        eprint("[warn] FAISS index type does not support mmap; loading into RAM.")
+    return read(str(path))
+
+
 # =========================
 # Sparse/BM25 + RRF (generic safety net)
 # =========================
@@ -92,67 +443,468 @@ def tokenize(text: str) -> List[str]:
     return [t.lower() for t in WORD_RE.findall(text or "")]
 
 
-def build_bm25_stats(chunks: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
-    N = len(chunks)
-    df: Dict[str, int] = {}
-    doc_len: Dict[str, int] = {}
-    for cid, obj in chunks.items():
-        tokens = tokenize(obj.get("text") or "")
-        doc_len[cid] = len(tokens)
-        seen = set(tokens)
-        for t in seen:
-            df[t] = df.get(t, 0) + 1
-    avgdl = (sum(doc_len.values()) / max(1, N)) if N else 0.0
-    return {"N": N, "df": df, "doc_len": doc_len, "avgdl": avgdl}
-
-
-def bm25_rank(query: str, chunks: Dict[str, Dict[str, Any]], stats: Dict[str, Any],
-              topn: int = 60, k1: float = 1.5, b: float = 0.75) -> List[str]:
-    qtokens = tokenize(query)
-    if not qtokens:
-        return []
-    N, df, doc_len, avgdl = stats["N"], stats["df"], stats["doc_len"], stats["avgdl"]
-    scores: Dict[str, float] = {}
-    for cid, obj in chunks.items():
-        tokens = tokenize(obj.get("text") or "")
-        if not tokens:
-            continue
-        # term freq per doc
-        tf: Dict[str, int] = {}
-        for t in tokens:
-            tf[t] = tf.get(t, 0) + 1
-        L = doc_len.get(cid, 0) or 1
-        s = 0.0
+class BM25Index:
+    """
+    Persistent inverted index for BM25 (postings in CSR layout).
+
+    Files (in a directory next to the FAISS index, e.g. out/wstg_faiss.bm25/):
+      - indptr.npy  : int64 [V+1], postings range per term id
+      - docs.npy    : int32 [nnz], doc row per posting (ascending inside a term)
+      - tf.npy      : int32 [nnz], term frequency per posting
+      - doc_len.npy : int32 [N], token count per doc
+      - meta.json   : vocab, doc ids, avgdl, source fingerprint + [size, mtime_ns]
+
+    Raw term frequencies are stored (not final weights) so k1/b stay query-time
+    parameters. Arrays are opened with mmap_mode="r"; a query only touches the
+    postings of its own terms. Ranking is standard Okapi BM25 over the term
+    frequencies of the indexed chunks.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, vocab: Dict[str, int], doc_ids: List[str], indptr: np.ndarray,
+                 docs: np.ndarray, tf: np.ndarray, doc_len: np.ndarray, avgdl: float,
+                 fingerprint: str = "", source_stat: Optional[List[int]] = None):
+        self.vocab = vocab
+        self.doc_ids = doc_ids
+        self.indptr = indptr
+        self.docs = docs
+        self.tf = tf
+        self.doc_len = doc_len
+        self.avgdl = avgdl
+        self.fingerprint = fingerprint
+        self.source_stat = source_stat
+
+    @property
+    def N(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, chunks: Mapping[str, Dict[str, Any]], fingerprint: str = "",
+              source_stat: Optional[List[int]] = None) -> "BM25Index":
+        vocab: Dict[str, int] = {}
+        postings: List[List[Tuple[int, int]]] = []
+        doc_ids: List[str] = []
+        doc_len: List[int] = []
+        indexed = ((cid, obj) for cid, obj in chunks.items() if is_indexed_chunk(obj))
+        for row, (cid, obj) in enumerate(indexed):
+            tokens = tokenize(obj.get("text") or "")
+            doc_ids.append(cid)
+            doc_len.append(len(tokens))
+            tf: Dict[str, int] = {}
+            for t in tokens:
+                tf[t] = tf.get(t, 0) + 1
+            for t, f in tf.items():
+                tid = vocab.get(t)
+                if tid is None:
+                    tid = vocab[t] = len(postings)
+                    postings.append([])
+                postings[tid].append((row, f))
+
+        indptr = np.zeros(len(postings) + 1, dtype="int64")
+        for tid, plist in enumerate(postings):
+            indptr[tid + 1] = indptr[tid] + len(plist)
+        docs = np.fromiter((r for plist in postings for r, _ in plist), dtype="int32", count=int(indptr[-1]))
+        tfs = np.fromiter((f for plist in postings for _, f in plist), dtype="int32", count=int(indptr[-1]))
+        N = len(doc_ids)
+        avgdl = (sum(doc_len) / max(1, N)) if N else 0.0
+        return cls(vocab, doc_ids, indptr, docs, tfs, np.asarray(doc_len, dtype="int32"), avgdl, fingerprint,
+                   source_stat)
+
+    def save(self, directory: Path) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / "indptr.npy", np.asarray(self.indptr))
+        np.save(directory / "docs.npy", np.asarray(self.docs))
+        np.save(directory / "tf.npy", np.asarray(self.tf))
+        np.save(directory / "doc_len.npy", np.asarray(self.doc_len))
+        terms = sorted(self.vocab, key=self.vocab.get)
+        meta = {
+            "version": self.FORMAT_VERSION,
+            "fingerprint": self.fingerprint,
+            "source_stat": self.source_stat,
+            "avgdl": self.avgdl,
+            "doc_ids": self.doc_ids,
+            "terms": terms,
+        }
+        with (directory / "meta.json").open("w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = True) -> "BM25Index":
+        meta = read_json(directory / "meta.json")
+        if meta.get("version") != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index version in {directory}: {meta.get('version')}")
+        mode = "r" if mmap else None
+        return cls(
+            vocab={t: i for i, t in enumerate(meta["terms"])},
+            doc_ids=meta["doc_ids"],
+            indptr=np.load(directory / "indptr.npy", mmap_mode=mode),
+            docs=np.load(directory / "docs.npy", mmap_mode=mode),
+            tf=np.load(directory / "tf.npy", mmap_mode=mode),
+            doc_len=np.load(directory / "doc_len.npy", mmap_mode=mode),
+            avgdl=float(meta["avgdl"]),
+            fingerprint=meta.get("fingerprint", ""),
+            source_stat=meta.get("source_stat"),
+        )
+
+    def scores(self, query: str, k1: float = 1.5, b: float = 0.75,
+               doc_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (rows, scores) for every doc matching at least one query term.
+        Terms are accumulated in query order (duplicates count twice).
+        `doc_mask` (bool per doc row, see ChunkFilter.doc_mask) drops postings
+        of filtered-out docs before scoring; idf keeps the corpus-wide statistics.
+        """
+        qtokens = tokenize(query)
+        N = self.N
+        norm = max(1.0, self.avgdl)
+        touched: List[np.ndarray] = []
+        contribs: List[np.ndarray] = []
         for t in qtokens:
-            n = df.get(t, 0)
-            if n == 0:
+            tid = self.vocab.get(t)
+            if tid is None:
                 continue
+            lo, hi = int(self.indptr[tid]), int(self.indptr[tid + 1])
+            n = hi - lo
             idf = math.log(1 + (N - n + 0.5) / (n + 0.5))
-            f = tf.get(t, 0)
-            s += idf * (f * (k1 + 1)) / (f + k1 * (1 - b + b * L / max(1.0, avgdl)))
-        if s > 0:
-            scores[cid] = s
-    ranked = sorted(scores, key=scores.get, reverse=True)
-    return ranked[:topn]
+            rows = np.asarray(self.docs[lo:hi])
+            f = np.asarray(self.tf[lo:hi], dtype="float64")
+            if doc_mask is not None:
+                keep = doc_mask[rows]
+                rows, f = rows[keep], f[keep]
+            L = np.asarray(self.doc_len[rows], dtype="float64")
+            L[L == 0] = 1.0
+            touched.append(rows)
+            contribs.append(idf * (f * (k1 + 1)) / (f + k1 * (1 - b + b * L / norm)))
+        if not touched:
+            return np.empty(0, dtype="int32"), np.empty(0, dtype="float64")
+        uniq = np.unique(np.concatenate(touched))
+        total = np.zeros(uniq.shape[0], dtype="float64")
+        for rows, c in zip(touched, contribs):
+            total[np.searchsorted(uniq, rows)] += c
+        return uniq, total
+
+    def rank_scored(self, query: str, topn: int = 60, k1: float = 1.5, b: float = 0.75,
+                    doc_mask: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        rows, scores = self.scores(query, k1=k1, b=b, doc_mask=doc_mask)
+        if rows.size == 0:
+            return []
+        # nlargest is stable on ties (same as sorted(..., reverse=True)[:n]) and
+        # rows are ascending, so ties resolve in corpus order.
+        best = heapq.nlargest(topn, range(rows.shape[0]), key=scores.__getitem__)
+        return [(self.doc_ids[int(rows[i])], float(scores[i])) for i in best if scores[i] > 0]
+
+    def rank(self, query: str, topn: int = 60, k1: float = 1.5, b: float = 0.75,
+             doc_mask: Optional[np.ndarray] = None) -> List[str]:
+        return [cid for cid, _ in self.rank_scored(query, topn=topn, k1=k1, b=b, doc_mask=doc_mask)]
+
+
+def files_fingerprint(paths: List[Optional[Path]]) -> str:
+    """Cheap corpus version: path, size and mtime of each file (no content hashing)."""
+    h = hashlib.sha1()
+    for path in paths:
+        if path is None:
+            continue
+        st = path.stat()
+        h.update(f"{path}\x00{st.st_size}\x00{st.st_mtime_ns}\x00".encode("utf-8"))
+    return h.hexdigest()
 
 
-def rrf_fuse(order_a: List[str], order_b: List[str], k: int = 60, topn: int = 60) -> List[str]:
+def load_or_build_bm25_index(chunks: Mapping[str, Dict[str, Any]], chunks_path: Path,
+                             index_dir: Path, rebuild: bool = False, verify: bool = False) -> BM25Index:
+    """
+    Open the persisted BM25 index if it was built from the same chunks file
+    (see same_source()), otherwise (re)build it and write it to index_dir.
+    """
+    if not rebuild and (index_dir / "meta.json").exists():
+        try:
+            idx = BM25Index.load(index_dir)
+            if same_source(chunks_path, idx.fingerprint, idx.source_stat, verify=verify):
+                return idx
+            eprint(f"[info] BM25 index at {index_dir} is stale, rebuilding.")
+        except Exception as e:
+            eprint(f"[warn] Could not load BM25 index at {index_dir}: {e}. Rebuilding.")
+    source_stat = file_stat(chunks_path)
+    idx = BM25Index.build(chunks, fingerprint=chunks_fingerprint(chunks_path), source_stat=source_stat)
+    try:
+        idx.save(index_dir)
+    except OSError as e:
+        eprint(f"[warn] Could not persist BM25 index to {index_dir}: {e}")
+    return idx
+
+
+def rrf_scores(order_a: List[str], order_b: List[str], k: int = 60) -> Dict[str, float]:
     ranks_a = {cid: i for i, cid in enumerate(order_a)}
     ranks_b = {cid: i for i, cid in enumerate(order_b)}
-    all_ids = list({*order_a, *order_b})
-
-    def rrf_score(cid: str) -> float:
+    out: Dict[str, float] = {}
+    for cid in {*order_a, *order_b}:
         s = 0.0
         if cid in ranks_a:
             s += 1.0 / (k + ranks_a[cid] + 1)
         if cid in ranks_b:
             s += 1.0 / (k + ranks_b[cid] + 1)
-        return s
+        out[cid] = s
+    return out
+
 
-    fused = sorted(all_ids, key=rrf_score, reverse=True)
+def rrf_fuse(order_a: List[str], order_b: List[str], k: int = 60, topn: int = 60) -> List[str]:
+    fused_scores = rrf_scores(order_a, order_b, k=k)
+    fused = sorted(fused_scores, key=fused_scores.get, reverse=True)
     return fused[:topn]
 
 
+# =========================
+# Chunk metadata fields + filters (FAISS ID selectors, BM25 posting masks)
+# =========================
+def chunk_fields(obj: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Structured, filterable fields of one chunk:
+      source, section, wstg_id (list), category (list), start_item, end_item,
+    plus any scalar meta.* value. Explicit meta wins over fields derived from text.
+    """
+    meta = obj.get("meta") or {}
+    text = obj.get("text") or ""
+    ids = sorted(set(m.group(0) for m in WSTG_ID_RE.finditer(text)) |
+                 set(_as_list(meta.get("wstg_id"))))
+    categories = _as_list(meta.get("category"))
+    if not categories:
+        found = {i.split("-")[1] for i in ids}
+        found.update(cat for cat, hits in category_hits(text).items() if hits >= CATEGORY_MIN_HITS)
+        categories = sorted(found)
+    fields: Dict[str, Any] = {k: v for k, v in meta.items() if isinstance(v, (str, int, float))}
+    fields.update({
+        "source": meta.get("source", obj.get("source")),
+        "section": meta.get("section", obj.get("section")),
+        "wstg_id": ids,
+        "category": categories,
+        "start_item": obj.get("start_item", meta.get("start_item")),
+        "end_item": obj.get("end_item", meta.get("end_item")),
+    })
+    return fields
+
+
+def _as_list(value: Any) -> List[Any]:
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+FILTER_CLAUSE_RE = re.compile(r"^\s*([A-Za-z_][\w.]*)\s*(!=|>=|<=|=|>|<)\s*(.+?)\s*$")
+# Separators only count outside quotes: group 1 (a quoted value) is skipped by split_outside_quotes()
+QUOTED_VALUE_RE = r"\"[^\"]*\"|'[^']*'"
+FILTER_SPLIT_RE = re.compile(rf"({QUOTED_VALUE_RE})|\s+and\s+|\s*&&?\s*|\s*;\s*", re.IGNORECASE)
+FILTER_VALUE_SPLIT_RE = re.compile(rf"({QUOTED_VALUE_RE})|\s*,\s*")
+
+
+def split_outside_quotes(text: str, sep_re: re.Pattern) -> List[str]:
+    """Split `text` on matches of `sep_re` that are not inside a "..." / '...' value."""
+    parts, start = [], 0
+    for m in sep_re.finditer(text):
+        if m.group(1) is None:
+            parts.append(text[start:m.start()])
+            start = m.end()
+    parts.append(text[start:])
+    return parts
+
+
+def unquote(value: str) -> str:
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        return value[1:-1]
+    return value
+
+
+class MetadataIndex:
+    """
+    Field index over the chunks, in FAISS row order (`ids`):
+      - string / list fields: value (lowercased) -> sorted int64 rows (postings)
+      - numeric fields: float64 column (NaN = missing)
+    compile(expr) evaluates a filter expression to a row mask:
+
+      category=ATHN,SESS and item>=100 and source=wstg*
+      wstg_id=WSTG-SESS-01; section!=4.1*; start_item<500
+      section="Authentication and Session*"
+
+    Clauses are AND-ed; "=" takes comma-separated alternatives (OR) and a
+    trailing "*" for prefix match, "!=" negates. Values may be quoted ("..."
+    or '...'); separators inside quotes (and, &&, ;, commas) are literal. "item" is the chunk's item
+    range [start_item, end_item]: item>=a / item<=b / item=a..b test overlap.
+    """
+
+    def __init__(self, ids: List[str], chunks: Mapping[str, Dict[str, Any]]):
+        self.ids = list(ids)
+        self.n = len(self.ids)
+        postings: Dict[str, Dict[str, List[int]]] = {}
+        numeric: Dict[str, List[Tuple[int, float]]] = {}
+        self.live = np.zeros(self.n, dtype=bool)  # rows with a chunk (not a removed-chunk placeholder)
+        for row, cid in enumerate(self.ids):
+            obj = chunks.get(cid) if cid is not None else None
+            if obj is None:
+                continue
+            self.live[row] = True
+            for field, value in chunk_fields(obj).items():
+                if value is None:
+                    continue
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    numeric.setdefault(field, []).append((row, float(value)))
+                    continue
+                for v in _as_list(value):
+                    postings.setdefault(field, {}).setdefault(str(v).lower(), []).append(row)
+        self.postings = {f: {v: np.asarray(rows, dtype="int64") for v, rows in vals.items()}
+                         for f, vals in postings.items()}
+        self.numeric: Dict[str, np.ndarray] = {}
+        for field, pairs in numeric.items():
+            col = np.full(self.n, np.nan)
+            rows, vals = zip(*pairs)
+            col[list(rows)] = vals
+            self.numeric[field] = col
+        self._positions: Dict[int, Tuple[Any, np.ndarray]] = {}
+
+    def fields(self) -> Dict[str, int]:
+        """Field -> number of distinct values (numeric fields: -1)."""
+        out = {f: len(vals) for f, vals in self.postings.items()}
+        out.update({f: -1 for f in self.numeric})
+        return out
+
+    def _rows_mask(self, rows: np.ndarray) -> np.ndarray:
+        mask = np.zeros(self.n, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def _string_mask(self, field: str, values: List[str]) -> np.ndarray:
+        vals = self.postings.get(field, {})
+        mask = np.zeros(self.n, dtype=bool)
+        for v in values:
+            v = v.strip().lower()
+            if v.endswith("*"):
+                for key, rows in vals.items():
+                    if key.startswith(v[:-1]):
+                        mask[rows] = True
+            elif v in vals:
+                mask[vals[v]] = True
+        return mask
+
+    def _numeric_mask(self, field: str, op: str, value: float) -> np.ndarray:
+        col = self.numeric.get(field)
+        if col is None:
+            return np.zeros(self.n, dtype=bool)
+        with np.errstate(invalid="ignore"):
+            return {"=": col == value, "!=": col != value, ">=": col >= value,
+                    "<=": col <= value, ">": col > value, "<": col < value}[op]
+
+    def _item_mask(self, op: str, raw: str) -> np.ndarray:
+        if op == "=" and ".." in raw:
+            lo, hi = (float(x) for x in raw.split("..", 1))
+        elif op == "=":
+            lo = hi = float(raw)
+        elif op in (">=", ">"):
+            return self._numeric_mask("end_item", op, float(raw))
+        elif op in ("<=", "<"):
+            return self._numeric_mask("start_item", op, float(raw))
+        else:
+            return ~self._item_mask("=", raw)
+        return self._numeric_mask("end_item", ">=", lo) & self._numeric_mask("start_item", "<=", hi)
+
+    def _clause_mask(self, clause: str) -> np.ndarray:
+        m = FILTER_CLAUSE_RE.match(clause)
+        if not m:
+            raise ValueError(f"Bad filter clause: {clause!r} (expected <field><op><value>)")
+        field, op, raw = m.groups()
+        field = field.lower()
+        if field == "item":
+            return self._item_mask(op, unquote(raw))
+        if field in self.numeric:
+            return self._numeric_mask(field, op, float(unquote(raw)))
+        if op not in ("=", "!="):
+            raise ValueError(f"Operator {op} needs a numeric field, {field!r} is not numeric")
+        if field not in self.postings:
+            raise ValueError(f"Unknown filter field {field!r}; known: {sorted(self.fields())}")
+        mask = self._string_mask(field, [unquote(v) for v in split_outside_quotes(raw, FILTER_VALUE_SPLIT_RE)])
+        return ~mask if op == "!=" else mask
+
+    def compile(self, expr: str) -> "ChunkFilter":
+        clauses = [c for c in split_outside_quotes(expr or "", FILTER_SPLIT_RE) if c.strip()]
+        if not clauses:
+            raise ValueError("Empty filter expression")
+        mask = self.live.copy()
+        for clause in clauses:
+            mask &= self._clause_mask(clause)
+        return ChunkFilter(expr, mask, self)
+
+    def positions(self, ids: List[str]) -> np.ndarray:
+        """Rows of this index for another id ordering (e.g. BM25 doc ids), -1 if absent; cached."""
+        cached = self._positions.get(id(ids))
+        if cached is not None and cached[0] is ids:
+            return cached[1]
+        row_of = {cid: i for i, cid in enumerate(self.ids) if cid is not None}
+        pos = np.asarray([row_of.get(cid, -1) for cid in ids], dtype="int64")
+        self._positions[id(ids)] = (ids, pos)
+        return pos
+
+
+class ChunkFilter:
+    """
+    A compiled filter: boolean mask over FAISS rows. Applied inside the search
+    (FAISS IDSelectorBitmap through SearchParameters; BM25 postings masked per
+    term), so filtered queries touch fewer vectors / postings instead of
+    over-fetching and discarding.
+    """
+
+    def __init__(self, expr: str, mask: np.ndarray, meta_index: MetadataIndex):
+        self.expr = expr
+        self.mask = mask
+        self.meta_index = meta_index
+        self.rows = np.flatnonzero(mask)
+        self.count = int(self.rows.shape[0])
+        self._bits: Optional[np.ndarray] = None
+        self._selector = None
+        self._doc_masks: Dict[int, Tuple[Any, np.ndarray]] = {}
+        self._subsets: Dict[Tuple[int, int], "ChunkFilter"] = {}
+
+    def subset(self, start: int, stop: int) -> "ChunkFilter":
+        """The filter restricted to rows [start, stop) (one shard of a ShardedIndex), cached."""
+        sub = self._subsets.get((start, stop))
+        if sub is None:
+            sub = ChunkFilter(self.expr, self.mask[start:stop], self.meta_index)
+            self._subsets[(start, stop)] = sub
+        return sub
+
+    def selector(self):
+        if self._selector is None:
+            faiss = lazy_import("faiss")
+            self._bits = np.packbits(self.mask, bitorder="little")  # must outlive the selector
+            self._selector = faiss.IDSelectorBitmap(self.mask.shape[0], faiss.swig_ptr(self._bits))
+        return self._selector
+
+    def search_params(self, index):
+        """SearchParameters carrying the selector, keeping the index's own nprobe / efSearch."""
+        faiss = lazy_import("faiss")
+        if isinstance(index, RescoringIndex):
+            index = index.index
+        if isinstance(index, faiss.IndexBinary):
+            return faiss.SearchParameters(sel=self.selector())
+        index = faiss.downcast_index(index)
+        if isinstance(index, faiss.IndexIDMap):  # labels are translated before the selector sees them
+            return self.search_params(index.index)
+        if isinstance(index, faiss.IndexPreTransform):
+            return faiss.SearchParametersPreTransform(index_params=self.search_params(index.index))
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            return faiss.SearchParametersIVF(sel=self.selector(), nprobe=ivf.nprobe)
+        if isinstance(index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=self.selector(), efSearch=index.hnsw.efSearch)
+        return faiss.SearchParameters(sel=self.selector())
+
+    def doc_mask(self, bm25_index: BM25Index) -> np.ndarray:
+        """Mask over BM25 doc positions (cached per BM25 index)."""
+        cached = self._doc_masks.get(id(bm25_index))
+        if cached is None or cached[0] is not bm25_index:
+            pos = self.meta_index.positions(bm25_index.doc_ids)
+            cached = (bm25_index, (pos >= 0) & self.mask[np.maximum(pos, 0)])
+            self._doc_masks[id(bm25_index)] = cached
+        return cached[1]
+
+
 # =========================
 # MMR Diversification
 # =========================
@@ -163,38 +915,49 @@ def mmr(candidate_vecs: np.ndarray,
     """
     Basic MMR on cosine-sim (assuming normalized vectors).
     Returns selected indices into candidate_vecs.
+
+    Incremental: keeps a running max-similarity-to-selected vector (one
+    matrix-vector product per pick) and masks selected items.
     """
     if candidate_vecs.size == 0:
         return []
 
-    sim_to_query = candidate_vecs @ query_vec.reshape(-1, 1)  # (N,1)
-    sim_to_query = sim_to_query.flatten()
+    n = candidate_vecs.shape[0]
+    sim_to_query = candidate_vecs @ query_vec.reshape(-1)  # (N,)
+    max_sim_selected = np.full(n, -np.inf, dtype=sim_to_query.dtype)
+    taken = np.zeros(n, dtype=bool)
 
     selected: List[int] = []
-    rest: List[int] = list(range(candidate_vecs.shape[0]))
-
-    while rest and len(selected) < topn:
-        if not selected:
-            # pick the best to query first
-            best = int(np.argmax(sim_to_query[rest]))
-            first = rest[best]
-            selected.append(first)
-            rest.remove(first)
-            continue
-
-        selected_vecs = candidate_vecs[selected]  # (k, d)
-        sim_to_selected = candidate_vecs @ selected_vecs.T     # (N, k)
-        max_sim_selected = sim_to_selected.max(axis=1)         # (N,)
-
+    # pick the best to query first
+    best = int(np.argmax(sim_to_query))
+    while len(selected) < min(topn, n):
+        selected.append(best)
+        taken[best] = True
+        if len(selected) == min(topn, n):
+            break
+        np.maximum(max_sim_selected, candidate_vecs @ candidate_vecs[best], out=max_sim_selected)
         mmr_score = lambda_mult * sim_to_query + (1.0 - lambda_mult) * (1.0 - max_sim_selected)
-        # choose best among remaining
-        best_idx = max(rest, key=lambda r: mmr_score[r])
-        selected.append(best_idx)
-        rest.remove(best_idx)
+        mmr_score[taken] = -np.inf
+        best = int(np.argmax(mmr_score))
 
     return selected
 
 
+def candidate_vectors(index: FaissIndex, rows: List[int],
+                      vectors: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+    """
+    Stored vectors for FAISS rows: from a persisted matrix aligned with the ids
+    file if given, else reconstructed from the index. Returns None if the index
+    cannot reconstruct (caller falls back to re-embedding).
+    """
+    if vectors is not None:
+        return np.asarray(vectors[np.asarray(rows, dtype="int64")], dtype="float32")
+    try:
+        return index.reconstruct_batch(np.asarray(rows, dtype="int64")).astype("float32")
+    except RuntimeError:
+        return None
+
+
 # =========================
 # Multi-Query / HyDE (lightweight)
 # =========================
@@ -249,18 +1012,111 @@ AUTO_MODEL_BY_DIM = {
     # add more if your index uses a different dim
 }
 
+ONNX_QUANT_TARGETS = ("arm64", "avx2", "avx512", "avx512_vnni")
+
+
+class OnnxBackend:
+    """
+    --backend onnx: a SentenceTransformer / CrossEncoder is exported to ONNX once
+    (optionally dynamically int8-quantized for a CPU target, see
+    ONNX_QUANT_TARGETS) and cached under `cache_dir`; later runs load the cached
+    artifacts through onnxruntime with the given intra/inter-op thread counts
+    (0 = onnxruntime default). Tokenizer, pooling and normalization stay those of
+    sentence-transformers, so embeddings remain compatible with indexes built by
+    the sbert backend. With `check_export` each fresh export is compared against
+    sbert by embedder_agreement() (loads the sbert model a second time, so it is
+    opt-in; --onnx-check runs the same comparison on demand).
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None, quantize: Optional[str] = None,
+                 intra_op_threads: int = 0, inter_op_threads: int = 0, check_export: bool = False):
+        if quantize and quantize not in ONNX_QUANT_TARGETS:
+            raise ValueError(f"Unknown ONNX quantization target: {quantize} (choose from {ONNX_QUANT_TARGETS})")
+        self.cache_dir = cache_dir or Path.home() / ".cache" / "rag_onnx"
+        self.quantize = quantize or None
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.check_export = check_export
+
+    @property
+    def tag(self) -> str:
+        return f"onnx-qint8-{self.quantize}" if self.quantize else "onnx"
+
+    def model_dir(self, model_name: str) -> Path:
+        return self.cache_dir / re.sub(r"[^A-Za-z0-9_.-]+", "--", model_name)
+
+    def model_kwargs(self) -> Dict[str, Any]:
+        try:
+            ort = lazy_import("onnxruntime")
+        except ImportError:
+            raise RuntimeError("--backend onnx needs onnxruntime: pip install 'sentence-transformers[onnx]'")
+        so = ort.SessionOptions()
+        if self.intra_op_threads:
+            so.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            so.inter_op_num_threads = self.inter_op_threads
+            so.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        return {"provider": "CPUExecutionProvider", "session_options": so}
+
+    def load(self, cls, model_name: str) -> Tuple[Any, bool]:
+        """
+        Returns (model, exported): `cls` is SentenceTransformer or CrossEncoder;
+        exported is True when the ONNX artifacts were (re)built by this call.
+        """
+        st = lazy_import("sentence_transformers")
+        local = self.model_dir(model_name)
+        kwargs = self.model_kwargs()
+        exported = False
+        if next(local.glob("**/model.onnx"), None) is None:
+            eprint(f"[info] Exporting {model_name} to ONNX: {local}")
+            with timed("export:onnx"):
+                cls(model_name, backend="onnx", model_kwargs=kwargs).save_pretrained(str(local))
+            exported = True
+        onnx_file = next(local.glob("**/model.onnx"))
+        if self.quantize:
+            q_name = f"model_qint8_{self.quantize}.onnx"
+            if next(local.glob(f"**/{q_name}"), None) is None:
+                eprint(f"[info] Quantizing {model_name} (dynamic int8, {self.quantize})")
+                with timed("export:onnx_quantize"):
+                    st.export_dynamic_quantized_onnx_model(
+                        cls(str(local), backend="onnx", model_kwargs=kwargs), self.quantize, str(local))
+                exported = True
+            onnx_file = next(local.glob(f"**/{q_name}"))
+        file_name = onnx_file.relative_to(local).as_posix()
+        return cls(str(local), backend="onnx", model_kwargs={**kwargs, "file_name": file_name}), exported
+
 
 class Embedder:
-    def __init__(self, model_name: str):
-        if SentenceTransformer is None:
+    normalize_embeddings = True
+
+    def __init__(self, model_name: str, backend: str = "sbert", onnx: Optional[OnnxBackend] = None):
+        try:
+            st = lazy_import("sentence_transformers")
+        except ImportError:
             raise RuntimeError("sentence-transformers is required. Please install it.")
         self.model_name = model_name
-        self.model = SentenceTransformer(self.model_name)
+        self.backend = backend
+        # Embedding-cache namespace: ONNX / int8 vectors are close to, not equal to, the sbert ones
+        self.cache_name = model_name
+        with timed("load:embedder"):
+            if backend == "onnx":
+                onnx = onnx or OnnxBackend()
+                self.model, exported = onnx.load(st.SentenceTransformer, model_name)
+                self.cache_name = f"{model_name}@{onnx.tag}"
+            else:
+                self.model = st.SentenceTransformer(self.model_name)
+        if backend == "onnx" and exported and onnx.check_export:
+            agreement = embedder_agreement(self, AGREEMENT_PROBE_TEXTS)
+            eprint(f"[info] ONNX vs sbert embeddings: {agreement}")
+            if agreement["min_cosine"] < ONNX_MIN_COSINE:
+                eprint(f"[warn] ONNX embeddings drift from sbert (min cosine {agreement['min_cosine']:.4f} "
+                       f"< {ONNX_MIN_COSINE}); results may not match the FAISS index. "
+                       "Try without --onnx-quantize.")
 
     def encode(self, texts: List[str]) -> np.ndarray:
         emb = self.model.encode(
             texts,
-            normalize_embeddings=True,
+            normalize_embeddings=self.normalize_embeddings,
             convert_to_numpy=True,
             show_progress_bar=False,
         )
@@ -275,17 +1131,543 @@ class Embedder:
             return int(v.shape[0])
 
 
+class EmbeddingCache:
+    """
+    Two-level cache of query embeddings keyed by (model name, normalize flag, text):
+      - in-process LRU (OrderedDict, `mem_size` entries)
+      - optional on-disk SQLite store (`path`, at most `disk_size` rows, LRU by last use)
+    Thread-safe; hit/miss counters in stats().
+    """
+
+    def __init__(self, path: Optional[Path] = None, mem_size: int = 4096, disk_size: int = 200_000):
+        self.mem_size = mem_size
+        self.disk_size = disk_size
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS emb ("
+                " key TEXT PRIMARY KEY, model TEXT, normalized INTEGER, text TEXT,"
+                " dim INTEGER, vec BLOB, last_used REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS emb_last_used ON emb(last_used)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model_name: str, normalized: bool, text: str) -> str:
+        h = hashlib.sha1()
+        h.update(f"{model_name}\x00{int(normalized)}\x00".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    def _mem_put(self, key: str, vec: np.ndarray) -> None:
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_size:
+            self._mem.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        out: List[Optional[np.ndarray]] = [None] * len(keys)
+        disk_wanted: List[int] = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                vec = self._mem.get(key)
+                if vec is not None:
+                    self._mem.move_to_end(key)
+                    out[i] = vec
+                    self.hits_mem += 1
+                else:
+                    disk_wanted.append(i)
+            if disk_wanted and self._db is not None:
+                now = time.time()
+                wanted = list({keys[i] for i in disk_wanted})
+                found: Dict[str, np.ndarray] = {}
+                for start in range(0, len(wanted), 500):
+                    part = wanted[start:start + 500]
+                    rows = self._db.execute(
+                        f"SELECT key, vec FROM emb WHERE key IN ({','.join('?' * len(part))})", part
+                    ).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype="float32")
+                if found:
+                    self._db.executemany("UPDATE emb SET last_used=? WHERE key=?",
+                                         [(now, key) for key in found])
+                    self._db.commit()
+                for i in disk_wanted:
+                    vec = found.get(keys[i])
+                    if vec is not None:
+                        out[i] = vec
+                        self._mem_put(keys[i], vec)
+                        self.hits_disk += 1
+            self.misses += sum(1 for v in out if v is None)
+        return out
+
+    def put_many(self, items: List[Tuple[str, str, str, bool, np.ndarray]]) -> None:
+        """items: (key, model_name, text, normalized, vec)"""
+        with self._lock:
+            for key, _, _, _, vec in items:
+                self._mem_put(key, vec)
+            if self._db is not None and items:
+                now = time.time()
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO emb(key, model, normalized, text, dim, vec, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(key, model, int(norm), text, int(vec.shape[0]),
+                      np.asarray(vec, dtype="float32").tobytes(), now)
+                     for key, model, text, norm, vec in items],
+                )
+                (count,) = self._db.execute("SELECT COUNT(*) FROM emb").fetchone()
+                if count > self.disk_size:
+                    self._db.execute(
+                        "DELETE FROM emb WHERE key IN (SELECT key FROM emb ORDER BY last_used ASC LIMIT ?)",
+                        (count - self.disk_size,),
+                    )
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits_mem + self.hits_disk + self.misses
+            return {
+                "hits_mem": self.hits_mem,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": ((self.hits_mem + self.hits_disk) / lookups) if lookups else 0.0,
+                "mem_entries": len(self._mem),
+            }
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CachedEmbedder:
+    """
+    Drop-in wrapper around Embedder: encode() answers from EmbeddingCache and
+    only sends misses (deduplicated) to the model in one batch. Every text
+    retrieve() encodes goes through here, including variants and the HyDE hint.
+    """
+
+    def __init__(self, embedder: Embedder, cache: EmbeddingCache):
+        self.embedder = embedder
+        self.cache = cache
+        self.model_name = embedder.model_name
+        self.cache_name = getattr(embedder, "cache_name", embedder.model_name)
+        self.normalize_embeddings = getattr(embedder, "normalize_embeddings", True)
+
+    @property
+    def dim(self) -> int:
+        return self.embedder.dim
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        keys = [EmbeddingCache.make_key(self.cache_name, self.normalize_embeddings, t) for t in texts]
+        vecs = self.cache.get_many(keys)
+        missing: Dict[str, int] = {}  # key -> first position
+        for i, (key, vec) in enumerate(zip(keys, vecs)):
+            if vec is None and key not in missing:
+                missing[key] = i
+        if missing:
+            positions = list(missing.values())
+            fresh = self.embedder.encode([texts[i] for i in positions])
+            self.cache.put_many([(keys[i], self.cache_name, texts[i], self.normalize_embeddings, fresh[j])
+                                 for j, i in enumerate(positions)])
+            by_key = {keys[i]: fresh[j] for j, i in enumerate(positions)}
+            vecs = [v if v is not None else by_key[k] for k, v in zip(keys, vecs)]
+        if not vecs:
+            return np.zeros((0, self.dim), dtype="float32")
+        return np.stack(vecs).astype("float32", copy=False)
+
+    def prewarm(self, queries: List[str], n_variants: int = 3, use_hyde: bool = False,
+                with_query: bool = False, batch_size: int = 256) -> int:
+        """Encode every text retrieve() would embed for `queries`. Returns #texts."""
+        texts: List[str] = []
+        for q in queries:
+            texts.extend(query_texts(q, n_variants=n_variants, use_hyde=use_hyde, with_query=with_query)[0])
+        texts = list(dict.fromkeys(texts))
+        for start in range(0, len(texts), batch_size):
+            self.encode(texts[start:start + batch_size])
+        return len(texts)
+
+
+class ResultCache:
+    """
+    Semantic cache of whole retrieval results (RetrievalResources.run()
+    payloads) keyed by the query embedding: a query whose vector is within
+    `threshold` cosine of a cached query with the same resolved options gets
+    that result back without running the pipeline. Entries expire after
+    `ttl_s` seconds (0 = never); beyond `max_entries` the least recently used
+    are evicted. Results are tagged with the corpus version they were computed
+    on; a different version clears the cache. Thread-safe; counters in stats().
+    """
+
+    def __init__(self, threshold: float = 0.97, max_entries: int = 1024, ttl_s: float = 3600.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.version: Optional[str] = None
+        # entry id -> (options key, unit query vector, query, payload, created)
+        self._entries: "OrderedDict[int, Tuple[str, np.ndarray, str, Dict[str, Any], float]]" = OrderedDict()
+        self._matrices: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}  # options key -> (entry ids, vectors)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def options_key(opts: Dict[str, Any]) -> str:
+        return json.dumps(opts, sort_keys=True)
+
+    def _check_version(self, version: str) -> None:
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+                self._entries.clear()
+                self._matrices.clear()
+            self.version = version
+
+    def _matrix(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        cached = self._matrices.get(key)
+        if cached is None:
+            ids = [eid for eid, entry in self._entries.items() if entry[0] == key]
+            vecs = [self._entries[eid][1] for eid in ids]
+            cached = (np.asarray(ids, dtype="int64"),
+                      np.stack(vecs) if vecs else np.zeros((0, 0), dtype="float32"))
+            self._matrices[key] = cached
+        return cached
+
+    def _drop(self, eid: int) -> None:
+        entry = self._entries.pop(eid)
+        self._matrices.pop(entry[0], None)
+
+    def get(self, query_vec: np.ndarray, options_key: str,
+            version: str) -> Optional[Tuple[Dict[str, Any], str, float]]:
+        """(payload, cached query, cosine) of the closest live entry above the threshold, else None."""
+        q = np.asarray(query_vec, dtype="float32").reshape(-1)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        with self._lock:
+            self._check_version(version)
+            ids, mat = self._matrix(options_key)
+            if ids.size:
+                sims = mat @ q
+                now = time.time()
+                for j in np.argsort(-sims, kind="stable"):
+                    if sims[j] < self.threshold:
+                        break
+                    eid = int(ids[j])
+                    _, _, cached_query, payload, created = self._entries[eid]
+                    if self.ttl_s > 0 and now - created > self.ttl_s:
+                        self._drop(eid)
+                        self.expired += 1
+                        continue
+                    self._entries.move_to_end(eid)
+                    self.hits += 1
+                    return payload, cached_query, float(sims[j])
+            self.misses += 1
+            return None
+
+    def put(self, query_vec: np.ndarray, options_key: str, version: str, query: str,
+            payload: Dict[str, Any]) -> None:
+        q = np.asarray(query_vec, dtype="float32").reshape(-1)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        with self._lock:
+            self._check_version(version)
+            self._entries[self._next_id] = (options_key, q, query, dict(payload), time.time())
+            self._next_id += 1
+            self._matrices.pop(options_key, None)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrices.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
 class ReRanker:
-    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
-        if CrossEncoder is None:
+    max_chars = 2048  # docs are truncated to doc[:max_chars] before scoring
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size: int = 32,
+                 backend: str = "sbert", onnx: Optional[OnnxBackend] = None):
+        try:
+            st = lazy_import("sentence_transformers")
+        except ImportError:
             raise RuntimeError("sentence-transformers (CrossEncoder) is required for --rerank.")
         self.model_name = model_name
-        self.model = CrossEncoder(self.model_name)
+        self.batch_size = batch_size
+        self.backend = backend
+        with timed("load:reranker"):
+            if backend == "onnx":
+                self.model, _ = (onnx or OnnxBackend()).load(st.CrossEncoder, model_name)
+            else:
+                self.model = st.CrossEncoder(self.model_name)
+
+    def predict_pairs(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        if not pairs:
+            return np.zeros(0, dtype="float32")
+        scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        return np.asarray(scores, dtype="float32").reshape(-1)
 
     def score(self, query: str, docs: List[str]) -> np.ndarray:
-        pairs = [(query, d) for d in docs]
-        scores = self.model.predict(pairs)
-        return np.asarray(scores, dtype="float32")
+        return self.predict_pairs([(query, d) for d in docs])
+
+    def score_many(self, requests: List[Tuple[str, List[str]]],
+                   chunks: Mapping[str, Dict[str, Any]]) -> List[np.ndarray]:
+        """
+        Score several (query, chunk ids) requests with one predict call.
+        Returns one score array per request.
+        """
+        pairs = [(q, chunks[cid]["text"][:self.max_chars]) for q, cids in requests for cid in cids]
+        flat = self.predict_pairs(pairs)
+        out: List[np.ndarray] = []
+        pos = 0
+        for _, cids in requests:
+            out.append(flat[pos:pos + len(cids)])
+            pos += len(cids)
+        return out
+
+    def score_chunks(self, query: str, cids: List[str], chunks: Mapping[str, Dict[str, Any]]) -> np.ndarray:
+        return self.score_many([(query, cids)], chunks)[0]
+
+
+AGREEMENT_PROBE_TEXTS = [
+    "query: Insecure Direct Object References (IDOR) testing",
+    "query: how to test for SQL injection in login forms",
+    "passage: Session fixation occurs when the application does not renew the session identifier after login.",
+    "passage: Cross-site scripting (XSS) lets an attacker inject client-side scripts into pages viewed by others.",
+    "Kiểm thử phân quyền truy cập trực tiếp đối tượng",
+    "OWASP Web Security Testing Guide v4.2",
+]
+ONNX_MIN_COSINE = 0.99
+
+
+def embedder_agreement(embedder: Embedder, texts: List[str]) -> Dict[str, Any]:
+    """Cosine between `embedder` and the sbert backend of the same model, per text."""
+    ref = Embedder(embedder.model_name) if embedder.backend != "sbert" else embedder
+    cos = np.sum(ref.encode(texts) * embedder.encode(texts), axis=1)  # both L2-normalized
+    return {"n": len(texts), "min_cosine": float(cos.min()), "mean_cosine": float(cos.mean())}
+
+
+def reranker_agreement(reranker: ReRanker, pairs: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """Score agreement between `reranker` and the sbert backend of the same CrossEncoder."""
+    ref = ReRanker(reranker.model_name, batch_size=reranker.batch_size) if reranker.backend != "sbert" else reranker
+    a, b = ref.predict_pairs(pairs), reranker.predict_pairs(pairs)
+    pearson = float(np.corrcoef(a, b)[0, 1]) if len(pairs) > 1 else 1.0
+    k = min(10, len(pairs))
+    top_overlap = len(set(np.argsort(-a)[:k]) & set(np.argsort(-b)[:k])) / float(k) if k else 1.0
+    return {"n": len(pairs), "pearson": pearson, "max_abs_diff": float(np.max(np.abs(a - b))) if len(pairs) else 0.0,
+            f"top{k}_overlap": top_overlap}
+
+
+class RerankBatcher:
+    """
+    Coalesces predict calls from concurrent callers (server mode) into larger
+    CrossEncoder batches. A flush happens when `max_batch` pairs are pending or
+    `window_ms` has passed since the first pending request.
+    """
+
+    def __init__(self, reranker: ReRanker, max_batch: int = 128, window_ms: float = 5.0):
+        self.reranker = reranker
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._queue: "queue.Queue[Optional[Tuple[List[Tuple[str, str]], Future]]]" = queue.Queue()
+        self.flushes = 0
+        self.pairs_scored = 0
+        self._thread = threading.Thread(target=self._loop, name="rerank-batcher", daemon=True)
+        self._thread.start()
+
+    def predict_pairs(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        if not pairs:
+            return np.zeros(0, dtype="float32")
+        fut: Future = Future()
+        self._queue.put((pairs, fut))
+        return fut.result()
+
+    def _loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            pending = [item]
+            n_pairs = len(item[0])
+            deadline = time.monotonic() + self.window
+            while n_pairs < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    self._queue.put(None)  # stop after this flush
+                    break
+                pending.append(nxt)
+                n_pairs += len(nxt[0])
+            self._flush(pending)
+
+    def _flush(self, pending: List[Tuple[List[Tuple[str, str]], Future]]) -> None:
+        pairs = [p for req_pairs, _ in pending for p in req_pairs]
+        try:
+            flat = self.reranker.predict_pairs(pairs)
+        except Exception as e:
+            for _, fut in pending:
+                fut.set_exception(e)
+            return
+        self.flushes += 1
+        self.pairs_scored += len(pairs)
+        pos = 0
+        for req_pairs, fut in pending:
+            fut.set_result(flat[pos:pos + len(req_pairs)])
+            pos += len(req_pairs)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class CachedReRanker:
+    """
+    ReRanker front-end with an LRU score cache keyed by
+    (reranker model, query, chunk id, truncation length). Only cache misses go
+    to the model, optionally through a RerankBatcher.
+    """
+
+    def __init__(self, reranker: ReRanker, cache_size: int = 100_000,
+                 batcher: Optional[RerankBatcher] = None):
+        self.reranker = reranker
+        self.model_name = reranker.model_name
+        self.max_chars = reranker.max_chars
+        self.cache_size = cache_size
+        self.batcher = batcher
+        self._cache: "OrderedDict[Tuple[str, str, str, int], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def score_many(self, requests: List[Tuple[str, List[str]]],
+                   chunks: Mapping[str, Dict[str, Any]]) -> List[np.ndarray]:
+        keys = [[(self.model_name, q, cid, self.max_chars) for cid in cids] for q, cids in requests]
+        out = [np.zeros(len(cids), dtype="float32") for _, cids in requests]
+        missing: Dict[Tuple[str, str, str, int], List[Tuple[int, int]]] = {}
+        with self._lock:
+            for r_i, req_keys in enumerate(keys):
+                for c_i, key in enumerate(req_keys):
+                    val = self._cache.get(key)
+                    if val is None:
+                        missing.setdefault(key, []).append((r_i, c_i))
+                    else:
+                        self._cache.move_to_end(key)
+                        out[r_i][c_i] = val
+                        self.hits += 1
+            self.misses += sum(len(v) for v in missing.values())
+
+        if missing:
+            miss_keys = list(missing)
+            pairs = [(q, chunks[cid]["text"][:self.max_chars]) for _, q, cid, _ in miss_keys]
+            predictor = self.batcher if self.batcher is not None else self.reranker
+            fresh = predictor.predict_pairs(pairs)
+            with self._lock:
+                for key, val in zip(miss_keys, fresh):
+                    for r_i, c_i in missing[key]:
+                        out[r_i][c_i] = val
+                    self._cache[key] = float(val)
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return out
+
+    def score_chunks(self, query: str, cids: List[str], chunks: Mapping[str, Dict[str, Any]]) -> np.ndarray:
+        return self.score_many([(query, cids)], chunks)[0]
+
+    def score(self, query: str, docs: List[str]) -> np.ndarray:
+        return self.reranker.score(query, docs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            out: Dict[str, Any] = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._cache),
+            }
+        if self.batcher is not None:
+            out["batcher"] = {"flushes": self.batcher.flushes, "pairs_scored": self.batcher.pairs_scored}
+        return out
+
+
+def load_index_meta(index_path: Path) -> Dict[str, Any]:
+    """Build metadata written by embed.py next to the index (wstg_faiss.meta.json), if any."""
+    meta_path = index_path.with_suffix(".meta.json")
+    return read_json(meta_path) if meta_path.exists() else {}
+
+
+def load_build_manifest(index_path: Path) -> Dict[str, Any]:
+    """embed.py build manifest next to the index (wstg_faiss.build.json), if any."""
+    path = index_path.with_suffix(".build.json")
+    return read_json(path) if path.exists() else {}
+
+
+def verify_build(build: Dict[str, Any], index_meta: Dict[str, Any], index, ids_path: Path,
+                 chunks: Mapping[str, Dict[str, Any]], chunks_path: Path, verify: bool = False) -> None:
+    """
+    Check that index, ids and chunks come from the build recorded in the
+    manifest: a mismatch of index / ids / meta is an error (a half-written or
+    mixed build); chunks edited since the build only warn (their vectors are
+    stale until embed.py is re-run, which re-embeds just those chunks).
+    Files are compared by size + mtime; verify=True hashes them in full.
+    """
+    problems = []
+    if index_meta.get("build_id") != build.get("build_id"):
+        problems.append("meta.json is from another build")
+    if not same_source(ids_path, build.get("ids_sha1"), build.get("ids_stat"), verify=verify):
+        problems.append(f"{ids_path.name} is from another build")
+    if int(index.ntotal) != build.get("ntotal"):
+        problems.append(f"index has {index.ntotal} vectors, build has {build.get('ntotal')}")
+    if problems:
+        raise RuntimeError(f"Index / ids / build manifest mismatch ({'; '.join(problems)}); re-run embed.py")
+    if same_source(chunks_path, build.get("chunks_fingerprint"), build.get("chunks_stat"), verify=verify):
+        return
+    recorded: Dict[str, Any] = build.get("chunks", {})
+    changed = sum(1 for cid, (_, h) in recorded.items()
+                  if cid in chunks and chunk_text_hash(chunks[cid].get("text") or "") != h)
+    removed = sum(1 for cid in recorded if cid not in chunks)
+    added = sum(1 for cid, obj in chunks.items() if cid not in recorded and is_indexed_chunk(obj))
+    if changed or removed or added:
+        eprint(f"[warn] Chunks changed since the index was built ({changed} changed, {added} new, "
+               f"{removed} removed); re-run embed.py to update the index incrementally.")
+
+
+def apply_search_params(index: FaissIndex, search: Dict[str, Any]) -> None:
+    """Set ANN search parameters (nprobe for IVF, efSearch for HNSW)."""
+    ps = lazy_import("faiss").ParameterSpace()
+    for name, value in search.items():
+        if value is not None:
+            ps.set_index_parameter(index, name, value)
 
 
 def pick_embedder_model_name(index_dim: int, user_model: Optional[str]) -> str:
@@ -309,11 +1691,87 @@ def pick_embedder_model_name(index_dim: int, user_model: Optional[str]) -> str:
 # =========================
 # Core retrieval
 # =========================
+def query_texts(query: str, n_variants: int = 3, use_hyde: bool = False,
+                with_query: bool = False) -> Tuple[List[str], int]:
+    """
+    Texts to embed for one query: the variants (+ HyDE hint), plus the raw
+    query itself when with_query is set (MMR needs it) and it is not already
+    a variant. Returns (texts, n_search) where texts[:n_search] are searched
+    and the query vector for MMR is texts.index(query).
+    """
+    texts = make_query_variants(query, n_variants=n_variants)
+    hint = hyde_hint(query, enabled=use_hyde)
+    if hint:
+        texts.append(hint)
+    n_search = len(texts)
+    if with_query and query not in texts:
+        texts.append(query)
+    return texts, n_search
+
+
+def encode_queries(embedder: Embedder, index: FaissIndex, texts: List[str]) -> np.ndarray:
+    qvecs = embedder.encode(texts)
+    if qvecs.shape[1] != index.d:
+        raise AssertionError(
+            f"Query vector dim ({qvecs.shape[1]}) != index dim ({index.d}). "
+            "Please rebuild the index or use an embedder with matching dimension."
+        )
+    return qvecs
+
+
+EXACT_FILTER_MAX_ROWS = 4096
+
+
+def search_index(index: FaissIndex, queries: np.ndarray, k: int,
+                 chunk_filter: Optional[ChunkFilter] = None,
+                 vectors: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    index.search(), restricted to the rows of `chunk_filter` when given: small
+    selections with stored vectors are scored exactly (one matmul over the
+    selected rows), larger ones go through a FAISS IDSelector.
+    """
+    if chunk_filter is None:
+        return index.search(queries, k)
+    faiss = lazy_import("faiss")
+    if chunk_filter.count == 0:
+        return np.full((queries.shape[0], k), -np.inf, dtype="float32"), np.full((queries.shape[0], k), -1)
+    if isinstance(index, ShardedIndex):
+        return index.search(queries, k, chunk_filter=chunk_filter)
+    if (vectors is not None and chunk_filter.count <= EXACT_FILTER_MAX_ROWS
+            and getattr(index, "metric_type", faiss.METRIC_INNER_PRODUCT) == faiss.METRIC_INNER_PRODUCT):
+        rows = chunk_filter.rows
+        S = np.asarray(queries, dtype="float32") @ np.asarray(vectors[rows], dtype="float32").T
+        top = np.argsort(-S, axis=1, kind="stable")[:, :k]
+        D = np.take_along_axis(S, top, axis=1)
+        I = rows[top]
+        if top.shape[1] < k:  # fewer selected rows than k: pad like FAISS
+            pad = k - top.shape[1]
+            D = np.hstack([D, np.full((D.shape[0], pad), -np.inf, dtype="float32")])
+            I = np.hstack([I, np.full((I.shape[0], pad), -1, dtype=I.dtype)])
+        return D, I
+    return index.search(queries, k, params=chunk_filter.search_params(index))
+
+
+def sparse_branch(query: str, bm25_index: BM25Index, topn: int = 60,
+                  chunk_filter: Optional[ChunkFilter] = None, tracer: Tracer = NULL_TRACER) -> List[str]:
+    """BM25 ranking for hybrid fusion; independent of the dense branch, so it can run concurrently."""
+    with tracer.stage("bm25", topn=topn) as span:
+        doc_mask = chunk_filter.doc_mask(bm25_index) if chunk_filter is not None else None
+        order = bm25_index.rank(query, topn=topn, doc_mask=doc_mask)
+        span["candidates"] = len(order)
+    return order
+
+
+def fetch_chunks(chunks: Mapping[str, Dict[str, Any]], ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Materialize chunk objects (mmap'd ChunkStore reads) ahead of reranking."""
+    return {cid: chunks[cid] for cid in ids if cid in chunks}
+
+
 def retrieve(
     query: str,
-    index: faiss.Index,
+    index: FaissIndex,
     all_ids: List[str],
-    chunks: Dict[str, Dict[str, Any]],
+    chunks: Mapping[str, Dict[str, Any]],
     embedder: Embedder,
     k_per_branch: int = 20,
     deliver_to_llm: int = 10,
@@ -324,111 +1782,1458 @@ def retrieve(
     n_variants: int = 3,
     use_hyde: bool = False,
     hybrid: bool = False,
-    bm25_stats: Optional[Dict[str, Any]] = None,
+    bm25_index: Optional[BM25Index] = None,
     rrf_k: int = 60,
+    scores: Optional[Dict[str, float]] = None,
+    id_to_row: Optional[Dict[str, int]] = None,
+    vectors: Optional[np.ndarray] = None,
+    tracer: Tracer = NULL_TRACER,
+    chunk_filter: Optional[ChunkFilter] = None,
+    branch_executor: Optional[Executor] = None,
 ) -> Tuple[List[Dict[str, Any]], List[str]]:
     """
     Returns (contexts, top_ids)
       - contexts: list of chunk objects (child + optional parent)
       - top_ids: list of selected child chunk IDs (for logging / debugging)
+    If `scores` is given, it is filled with the final-stage score of each top id
+    (rerank score, else RRF score when fused, else dense score).
+
+    All query variants (and the raw query for MMR) are encoded in one batch and
+    searched with a single index.search() on the stacked matrix. MMR uses the
+    stored chunk vectors (`vectors` aligned with all_ids, else reconstructed
+    from the index); pass a prebuilt `id_to_row` to avoid rebuilding it.
+
+    Pass a Tracer to record per-stage timings (the caller calls finish()).
+    A ChunkFilter (MetadataIndex.compile()) restricts both the dense search and
+    BM25 to the matching chunks.
+
+    With a `branch_executor` (thread pool), the BM25 branch runs concurrently
+    with encoding + FAISS search (both release the GIL), and with reranking on
+    an mmap'd ChunkStore the candidate texts are fetched while fusion / MMR run.
     """
-    variants = make_query_variants(query, n_variants=n_variants)
-    hint = hyde_hint(query, enabled=use_hyde)
-    if hint:
-        variants.append(hint)
+    sparse_order: Optional[Future] = None
+    if branch_executor is not None and hybrid and bm25_index is not None:
+        sparse_order = branch_executor.submit(sparse_branch, query, bm25_index,
+                                              chunk_filter=chunk_filter, tracer=tracer)
+    with tracer.stage("query_variants") as span:
+        texts, n_search = query_texts(query, n_variants=n_variants, use_hyde=use_hyde, with_query=use_mmr)
+        span["variants"] = n_search
+    with tracer.stage("encode", batch_size=len(texts)):
+        qvecs = encode_queries(embedder, index, texts)
+    with tracer.stage("faiss_search", nq=n_search, k=k_per_branch) as span:
+        if chunk_filter is not None:
+            span["filtered_rows"] = chunk_filter.count
+        D, I = search_index(index, qvecs[:n_search], k_per_branch, chunk_filter=chunk_filter, vectors=vectors)
+    prefetched: Optional[Future] = None
+    if branch_executor is not None and use_rerank and isinstance(chunks, ChunkStore):
+        dense_ids = [all_ids[i] for i in np.unique(I[I >= 0])]
+        prefetched = branch_executor.submit(fetch_chunks, chunks, dense_ids)
+    return rank_candidates(
+        query, D, I, index, all_ids, chunks, embedder,
+        query_vec=qvecs[texts.index(query)] if use_mmr else None,
+        deliver_to_llm=deliver_to_llm, use_mmr=use_mmr, mmr_lambda=mmr_lambda,
+        use_rerank=use_rerank, reranker=reranker, hybrid=hybrid,
+        bm25_index=bm25_index, rrf_k=rrf_k, scores=scores,
+        id_to_row=id_to_row, vectors=vectors, tracer=tracer, chunk_filter=chunk_filter,
+        sparse_order=sparse_order, prefetched=prefetched,
+    )
 
-    # --- Dense search per variant ---
-    all_hits: List[Tuple[str, float]] = []  # (chunk_id, distance/score)
-    for v in variants:
-        qvec = embedder.encode([v])
-        if qvec.shape[1] != index.d:
-            raise AssertionError(
-                f"Query vector dim ({qvec.shape[1]}) != index dim ({index.d}). "
-                "Please rebuild the index or use an embedder with matching dimension."
-            )
-        D, I = index.search(qvec, k_per_branch)
-        for i, d in zip(I[0], D[0]):
-            if i < 0:
-                continue
-            cid = all_ids[i]
-            if cid in chunks:
-                all_hits.append((cid, float(d)))
-
-    # Deduplicate IDs keeping the best score (direction depends on index metric)
-    metric_type = getattr(index, "metric_type", faiss.METRIC_INNER_PRODUCT)
-    bigger_is_better = (metric_type == faiss.METRIC_INNER_PRODUCT)
-
-    best: Dict[str, float] = {}
-    for cid, score in all_hits:
-        if cid not in best:
-            best[cid] = score
-        else:
-            if (bigger_is_better and score > best[cid]) or (not bigger_is_better and score < best[cid]):
+
+async def aretrieve(query: str, executor: Optional[Executor] = None,
+                    **kwargs) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    asyncio API: retrieve() runs in `executor` (default: the loop's executor),
+    so the event loop is never blocked by encoding / search / rerank. Size the
+    executor to bound concurrent retrievals; pass `branch_executor` (a separate
+    pool, never the same one, or nested submits can deadlock) for concurrent
+    branches within each retrieval.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(retrieve, query, **kwargs))
+
+
+def retrieve_sparse(
+    query: str,
+    chunks: Mapping[str, Dict[str, Any]],
+    bm25_index: BM25Index,
+    deliver_to_llm: int = 10,
+    use_rerank: bool = False,
+    reranker: Optional[ReRanker] = None,
+    scores: Optional[Dict[str, float]] = None,
+    topn: int = 60,
+    tracer: Tracer = NULL_TRACER,
+    chunk_filter: Optional[ChunkFilter] = None,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    BM25-only retrieval (--sparse-only): no embedder, no FAISS. Optional rerank
+    and parent-child expansion work as in retrieve().
+    """
+    with tracer.stage("bm25", topn=topn) as span:
+        doc_mask = chunk_filter.doc_mask(bm25_index) if chunk_filter is not None else None
+        ranked = [(cid, s) for cid, s in bm25_index.rank_scored(query, topn=topn, doc_mask=doc_mask)
+                  if cid in chunks]
+        span["candidates"] = len(ranked)
+    ordered_ids = [cid for cid, _ in ranked]
+    rr_scores = None
+    if use_rerank and ordered_ids:
+        if reranker is None:
+            reranker = ReRanker()
+        with tracer.stage("rerank", pairs=len(ordered_ids)):
+            rr_scores = reranker.score_chunks(query, ordered_ids, chunks)
+    return select_contexts(ordered_ids, dict(ranked), chunks, deliver_to_llm, rr_scores=rr_scores,
+                           scores=scores, tracer=tracer)
+
+
+def retrieve_batch(
+    queries: List[str],
+    index: FaissIndex,
+    all_ids: List[str],
+    chunks: Mapping[str, Dict[str, Any]],
+    embedder: Embedder,
+    k_per_branch: int = 20,
+    n_variants: int = 3,
+    use_hyde: bool = False,
+    batch_size: int = 256,
+    tracer: Tracer = NULL_TRACER,
+    **kwargs,
+) -> List[Tuple[List[Dict[str, Any]], List[str], Dict[str, float]]]:
+    """
+    retrieve() for many queries. Per batch of `batch_size` queries, every
+    variant of every query is encoded in one embedder call and searched in one
+    index.search(); fusion / MMR run per query, and reranking scores the pairs
+    of the whole batch in one call. Other keyword arguments are the same as
+    retrieve(). One tracer covers the whole call: per-query stages (dedup,
+    fusion, MMR, expansion) appear once per query.
+    Returns a list of (contexts, top_ids, scores), aligned with `queries`.
+    """
+    use_mmr = kwargs.get("use_mmr", False)
+    chunk_filter = kwargs.get("chunk_filter")
+    branch_executor = kwargs.pop("branch_executor", None)
+    bm25_index = kwargs.get("bm25_index")
+    concurrent_sparse = branch_executor is not None and kwargs.get("hybrid") and bm25_index is not None
+    use_rerank = kwargs.pop("use_rerank", False)
+    reranker = kwargs.pop("reranker", None)
+    deliver_to_llm = kwargs.pop("deliver_to_llm", 10)
+    if use_rerank and reranker is None:
+        reranker = ReRanker()
+    results: List[Tuple[List[Dict[str, Any]], List[str], Dict[str, float]]] = []
+    for start in range(0, len(queries), max(1, batch_size)):
+        batch = queries[start:start + batch_size]
+        sparse_orders: List[Optional[Future]] = [None] * len(batch)
+        if concurrent_sparse:
+            sparse_orders = [branch_executor.submit(sparse_branch, q, bm25_index,
+                                                    chunk_filter=chunk_filter, tracer=tracer) for q in batch]
+        texts: List[str] = []
+        spans: List[Tuple[int, int, int]] = []  # (offset, n_search, query position)
+        with tracer.stage("query_variants", queries=len(batch)):
+            for q in batch:
+                q_texts, n_search = query_texts(q, n_variants=n_variants, use_hyde=use_hyde, with_query=use_mmr)
+                spans.append((len(texts), n_search, len(texts) + q_texts.index(q) if use_mmr else -1))
+                texts.extend(q_texts)
+        with tracer.stage("encode", batch_size=len(texts)):
+            qvecs = encode_queries(embedder, index, texts)
+        search_rows = np.concatenate([np.arange(off, off + n) for off, n, _ in spans])
+        with tracer.stage("faiss_search", nq=len(search_rows), k=k_per_branch):
+            D_all, I_all = search_index(index, np.ascontiguousarray(qvecs[search_rows]), k_per_branch,
+                                        chunk_filter=chunk_filter, vectors=kwargs.get("vectors"))
+
+        pos = 0
+        ordered: List[Tuple[List[str], Dict[str, float]]] = []
+        for q, (off, n_search, q_row), sparse_order in zip(batch, spans, sparse_orders):
+            ordered.append(order_candidates(
+                q, D_all[pos:pos + n_search], I_all[pos:pos + n_search], index, all_ids, chunks, embedder,
+                query_vec=qvecs[q_row] if q_row >= 0 else None, tracer=tracer, sparse_order=sparse_order,
+                **kwargs,
+            ))
+            pos += n_search
+
+        rr_all: List[Optional[np.ndarray]] = [None] * len(batch)
+        if use_rerank:
+            with tracer.stage("rerank", queries=len(batch), pairs=sum(len(ids) for ids, _ in ordered)):
+                rr_all = reranker.score_many([(q, ids) for q, (ids, _) in zip(batch, ordered)], chunks)
+
+        for (ordered_ids, stage_scores), rr_scores in zip(ordered, rr_all):
+            scores: Dict[str, float] = {}
+            contexts, top_ids = select_contexts(ordered_ids, stage_scores, chunks, deliver_to_llm,
+                                                rr_scores=rr_scores if ordered_ids else None, scores=scores,
+                                                tracer=tracer)
+            results.append((contexts, top_ids, scores))
+    return results
+
+
+def rank_candidates(
+    query: str,
+    D: np.ndarray,
+    I: np.ndarray,
+    index: FaissIndex,
+    all_ids: List[str],
+    chunks: Mapping[str, Dict[str, Any]],
+    embedder: Embedder,
+    query_vec: Optional[np.ndarray] = None,
+    deliver_to_llm: int = 10,
+    use_mmr: bool = False,
+    mmr_lambda: float = 0.5,
+    use_rerank: bool = False,
+    reranker: Optional[ReRanker] = None,
+    hybrid: bool = False,
+    bm25_index: Optional[BM25Index] = None,
+    rrf_k: int = 60,
+    scores: Optional[Dict[str, float]] = None,
+    id_to_row: Optional[Dict[str, int]] = None,
+    vectors: Optional[np.ndarray] = None,
+    tracer: Tracer = NULL_TRACER,
+    chunk_filter: Optional[ChunkFilter] = None,
+    sparse_order: Union[None, List[str], Future] = None,
+    prefetched: Optional[Future] = None,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Everything after the dense search: dedup, hybrid fusion, MMR, rerank and
+    parent-child expansion. D/I are the index.search() results of the query
+    variants (one row per variant). `sparse_order` / `prefetched` may be
+    futures of a concurrently running BM25 branch / chunk fetch.
+    """
+    ordered_ids, stage_scores = order_candidates(
+        query, D, I, index, all_ids, chunks, embedder,
+        query_vec=query_vec, use_mmr=use_mmr, mmr_lambda=mmr_lambda, hybrid=hybrid,
+        bm25_index=bm25_index, rrf_k=rrf_k, id_to_row=id_to_row, vectors=vectors, tracer=tracer,
+        chunk_filter=chunk_filter, sparse_order=sparse_order,
+    )
+    rr_scores = None
+    if use_rerank and ordered_ids:
+        if reranker is None:
+            reranker = ReRanker()
+        rr_chunks = ChainMap(prefetched.result(), chunks) if prefetched is not None else chunks
+        with tracer.stage("rerank", pairs=len(ordered_ids)):
+            rr_scores = reranker.score_chunks(query, ordered_ids, rr_chunks)
+    return select_contexts(ordered_ids, stage_scores, chunks, deliver_to_llm, rr_scores=rr_scores,
+                           scores=scores, tracer=tracer)
+
+
+def order_candidates(
+    query: str,
+    D: np.ndarray,
+    I: np.ndarray,
+    index: FaissIndex,
+    all_ids: List[str],
+    chunks: Mapping[str, Dict[str, Any]],
+    embedder: Embedder,
+    query_vec: Optional[np.ndarray] = None,
+    use_mmr: bool = False,
+    mmr_lambda: float = 0.5,
+    hybrid: bool = False,
+    bm25_index: Optional[BM25Index] = None,
+    rrf_k: int = 60,
+    id_to_row: Optional[Dict[str, int]] = None,
+    vectors: Optional[np.ndarray] = None,
+    tracer: Tracer = NULL_TRACER,
+    chunk_filter: Optional[ChunkFilter] = None,
+    sparse_order: Union[None, List[str], Future] = None,
+) -> Tuple[List[str], Dict[str, float]]:
+    """
+    Dedup dense hits, fuse with BM25 and diversify with MMR.
+    Returns (ordered_ids, stage_scores) ready for reranking. The BM25 order is
+    computed here unless given (a list, or a Future awaited only once the
+    dense candidates are deduplicated).
+    """
+    with tracer.stage("dedup") as span:
+        all_hits: List[Tuple[str, float]] = []  # (chunk_id, distance/score)
+        for row_i, row_d in zip(I, D):
+            for i, d in zip(row_i, row_d):
+                if i < 0:
+                    continue
+                cid = all_ids[i]
+                if cid in chunks:
+                    all_hits.append((cid, float(d)))
+
+        # Deduplicate IDs keeping the best score (direction depends on index metric)
+        faiss = lazy_import("faiss")
+        metric_type = getattr(index, "metric_type", faiss.METRIC_INNER_PRODUCT)
+        bigger_is_better = (metric_type == faiss.METRIC_INNER_PRODUCT)
+
+        best: Dict[str, float] = {}
+        for cid, score in all_hits:
+            if cid not in best:
                 best[cid] = score
+            else:
+                if (bigger_is_better and score > best[cid]) or (not bigger_is_better and score < best[cid]):
+                    best[cid] = score
+        span["hits"] = len(all_hits)
+        span["candidates"] = len(best)
 
     candidate_ids = list(best.keys())
     if not candidate_ids:
-        return [], []
+        return [], {}
 
     # --- Dense order (pre-fusion) ---
     dense_order = sorted(candidate_ids, key=lambda c: best[c], reverse=bigger_is_better)[:60]
 
     # --- Hybrid fusion: Dense + Sparse(BM25) via RRF ---
     ordered_ids = dense_order
-    if hybrid and bm25_stats is not None:
-        sparse_order = bm25_rank(query, chunks, bm25_stats, topn=60)
+    stage_scores: Dict[str, float] = best
+    if hybrid and bm25_index is not None:
+        if isinstance(sparse_order, Future):
+            with tracer.stage("bm25_wait"):
+                sparse_order = sparse_order.result()
+        elif sparse_order is None:
+            sparse_order = sparse_branch(query, bm25_index, topn=60, chunk_filter=chunk_filter, tracer=tracer)
         if sparse_order:
-            ordered_ids = rrf_fuse(dense_order, sparse_order, k=rrf_k, topn=60)
+            with tracer.stage("rrf_fuse") as span:
+                stage_scores = rrf_scores(dense_order, sparse_order, k=rrf_k)
+                ordered_ids = sorted(stage_scores, key=stage_scores.get, reverse=True)[:60]
+                span["candidates"] = len(stage_scores)
 
-    # --- Optional MMR diversify on ordered list ---
+    # --- Optional MMR diversify on ordered list (stored vectors, no re-embedding) ---
     if use_mmr:
-        cand_texts = [chunks[cid]["text"][:1200] for cid in ordered_ids]
-        cand_vecs = embedder.encode(cand_texts)  # normalized by ST
-        qvec = embedder.encode([query])[0]
-        sel_idx = mmr(cand_vecs, qvec, lambda_mult=mmr_lambda, topn=min(60, len(ordered_ids)))
-        ordered_ids = [ordered_ids[i] for i in sel_idx]
-
-    # --- Optional rerank (query, doc[:2048]) ---
-    if use_rerank:
-        if reranker is None:
-            reranker = ReRanker()
-        docs = [chunks[cid]["text"][:2048] for cid in ordered_ids]
-        scores = reranker.score(query, docs)
-        order = np.argsort(-scores)
+        with tracer.stage("mmr", candidates=len(ordered_ids)) as span:
+            if id_to_row is None:
+                id_to_row = {cid: i for i, cid in enumerate(all_ids)}
+            cand_vecs = None
+            if all(cid in id_to_row for cid in ordered_ids):
+                cand_vecs = candidate_vectors(index, [id_to_row[cid] for cid in ordered_ids], vectors=vectors)
+            if cand_vecs is None:
+                cand_texts = [chunks[cid]["text"][:1200] for cid in ordered_ids]
+                span["reencode_batch_size"] = len(cand_texts)
+                cand_vecs = embedder.encode(cand_texts)  # normalized by ST
+            qvec = query_vec if query_vec is not None else embedder.encode([query])[0]
+            sel_idx = mmr(cand_vecs, qvec, lambda_mult=mmr_lambda, topn=min(60, len(ordered_ids)))
+            ordered_ids = [ordered_ids[i] for i in sel_idx]
+
+    return ordered_ids, stage_scores
+
+
+def select_contexts(
+    ordered_ids: List[str],
+    stage_scores: Dict[str, float],
+    chunks: Mapping[str, Dict[str, Any]],
+    deliver_to_llm: int = 10,
+    rr_scores: Optional[np.ndarray] = None,
+    scores: Optional[Dict[str, float]] = None,
+    tracer: Tracer = NULL_TRACER,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Pick the top `deliver_to_llm` ids (by rerank score when given) and expand
+    them with their parent chunks.
+    """
+    # --- Optional rerank order ---
+    if rr_scores is not None:
+        order = np.argsort(-rr_scores)
         top_ids = [ordered_ids[i] for i in order[:deliver_to_llm]]
+        stage_scores = {cid: float(s) for cid, s in zip(ordered_ids, rr_scores)}
     else:
         top_ids = ordered_ids[:deliver_to_llm]
 
     # --- Parent-Child expansion ---
-    contexts: List[Dict[str, Any]] = []
-    seen_ctx = set()
-    for cid in top_ids:
+    with tracer.stage("expand", top=len(top_ids)) as span:
+        contexts: List[Dict[str, Any]] = []
+        seen_ctx = set()
+        for cid in top_ids:
+            obj = chunks[cid]
+            parent_id = obj.get("meta", {}).get("parent_id")
+            if parent_id and parent_id in chunks:
+                pobj = chunks[parent_id]
+                if parent_id not in seen_ctx:
+                    contexts.append(pobj)
+                    seen_ctx.add(parent_id)
+            if cid not in seen_ctx:
+                contexts.append(obj)
+                seen_ctx.add(cid)
+        span["contexts"] = len(contexts)
+
+    if scores is not None:
+        scores.update({cid: float(stage_scores[cid]) for cid in top_ids})
+    return contexts, top_ids
+
+
+# =========================
+# Context packing (token budget)
+# =========================
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+MIN_OVERLAP_CHARS = 32     # shorter shared prefixes / suffixes are not treated as duplicated text
+MAX_OVERLAP_CHARS = 4000
+MIN_TRIM_TOKENS = 24       # a trimmed chunk shorter than this is dropped instead
+
+
+def _overlap(head_of: str, tail_of: str) -> int:
+    """Length of the longest suffix of `tail_of` that is a prefix of `head_of` (>= MIN_OVERLAP_CHARS)."""
+    if len(head_of) < MIN_OVERLAP_CHARS or len(tail_of) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = head_of[:MIN_OVERLAP_CHARS]
+    window_start = max(0, len(tail_of) - min(len(head_of), MAX_OVERLAP_CHARS))
+    pos = tail_of.find(probe, window_start)
+    while pos != -1:
+        if head_of.startswith(tail_of[pos:]):
+            return len(tail_of) - pos
+        pos = tail_of.find(probe, pos + 1)
+    return 0
+
+
+def strip_packed_overlap(text: str, packed: List[str]) -> Tuple[str, int]:
+    """
+    Remove text that is already packed: all of it when `text` is contained in a
+    packed text (a child inside its parent), else the leading / trailing part
+    shared with a packed text (overlapping chunk windows). Returns (rest, chars removed).
+    """
+    n = len(text)
+    if any(text in other for other in packed):
+        return "", n
+    head = max((_overlap(text, other) for other in packed), default=0)
+    text = text[head:]
+    tail = max((_overlap(other, text) for other in packed), default=0)
+    if tail:
+        text = text[:len(text) - tail]
+    return text.strip(), n - len(text.strip())
+
+
+def trim_to_budget(text: str, budget: int, counter: TokenCounter) -> str:
+    """Longest prefix of whole sentences that fits `budget` tokens ("" if not even one)."""
+    ends = [m.start() for m in SENTENCE_END_RE.finditer(text)] + [len(text)]
+    lo, hi = 0, len(ends)  # number of sentences kept: ends[lo - 1] fits, ends[hi - 1] may not
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if counter.count(text[:ends[mid - 1]]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:ends[lo - 1]].rstrip() if lo else ""
+
+
+def pack_contexts(top_ids: List[str], scores: Dict[str, float], chunks: Mapping[str, Dict[str, Any]],
+                  token_budget: int, counter: TokenCounter) -> Dict[str, Any]:
+    """
+    Fill `token_budget` greedily in final-score order (top_ids is already
+    sorted by rerank / fused / dense score). Each hit brings its parent chunk
+    first when the parent still fits; text already packed (a child inside its
+    parent, the overlap between neighbouring chunk windows) is not counted
+    twice; a chunk that does not fit whole is cut at a sentence boundary.
+    """
+    packed: List[Dict[str, Any]] = []
+    texts: List[str] = []
+    dropped: List[str] = []
+    used = 0
+
+    def add(cid: str, role: str, hit: str, allow_trim: bool) -> bool:
+        nonlocal used
         obj = chunks[cid]
-        parent_id = obj.get("meta", {}).get("parent_id")
-        if parent_id and parent_id in chunks:
-            pobj = chunks[parent_id]
-            if parent_id not in seen_ctx:
-                contexts.append(pobj)
-                seen_ctx.add(parent_id)
-        if cid not in seen_ctx:
-            contexts.append(obj)
-            seen_ctx.add(cid)
+        text, removed = strip_packed_overlap(obj.get("text") or "", texts)
+        if not text:
+            return removed > 0  # fully covered by packed text
+        tokens = counter.count(text)
+        truncated = False
+        if used + tokens > token_budget:
+            if not allow_trim:
+                return False
+            text = trim_to_budget(text, token_budget - used, counter)
+            tokens = counter.count(text)
+            if tokens < MIN_TRIM_TOKENS:
+                return False
+            truncated = True
+        used += tokens
+        texts.append(text)
+        packed.append({"id": cid, "role": role, "for": hit, "score": scores.get(hit), "tokens": tokens,
+                       "truncated": truncated, "deduped_chars": removed,
+                       "meta": obj.get("meta", {}), "text": text})
+        return True
 
-    return contexts, top_ids
+    for cid in top_ids:
+        parent_id = chunks[cid].get("meta", {}).get("parent_id")
+        if parent_id and parent_id in chunks and parent_id not in {c["id"] for c in packed}:
+            add(parent_id, "parent", cid, allow_trim=False)
+        if not add(cid, "child", cid, allow_trim=True):
+            dropped.append(cid)
+    return {"tokenizer": counter.name, "token_budget": token_budget, "tokens": used,
+            "contexts": packed, "dropped": dropped}
+
+
+# =========================
+# Sharded multi-corpus retrieval (shard manifest, parallel fan-out, global top-k)
+# =========================
+DENSE_MERGE_MODES = ("auto", "raw", "minmax", "zscore")
+
+
+def load_shard_manifest(path: Path) -> Dict[str, Any]:
+    """
+    Shard manifest (JSON), paths relative to the manifest file:
+
+      {"dense_merge": "auto",
+       "shards": [{"name": "wstg", "chunks": "wstg_chunks.from_knowledge.jsonl",
+                   "faiss": "wstg_faiss.index", "ids": "wstg_faiss_ids.json",
+                   "bm25": "wstg_faiss.bm25", "vectors": null, "chunk_store": null}, ...]}
+
+    "faiss" / "ids" may be omitted for sparse-only use; "bm25" defaults to the
+    usual directory next to the index. embed.py --manifest adds / updates entries.
+    """
+    manifest = read_json(path)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("shards"), list) or not manifest["shards"]:
+        raise ValueError(f"{path}: expected {{\"shards\": [...]}} with at least one shard")
+    base = path.parent
+    names = set()
+    shards = []
+    for i, entry in enumerate(manifest["shards"]):
+        if not isinstance(entry, dict) or not entry.get("chunks"):
+            raise ValueError(f"{path}: shard #{i} needs at least a 'chunks' path")
+        name = str(entry.get("name") or Path(entry["chunks"]).stem)
+        if name in names:
+            raise ValueError(f"{path}: duplicate shard name {name!r}")
+        names.add(name)
+        spec: Dict[str, Any] = {"name": name}
+        for key in ("chunks", "faiss", "ids", "bm25", "vectors", "chunk_store"):
+            value = entry.get(key)
+            spec[key] = (base / Path(value).expanduser()).resolve() if value else None
+        for key in ("chunks", "faiss", "ids", "vectors"):
+            if spec[key] is not None and not spec[key].exists():
+                raise FileNotFoundError(f"shard {name!r}: {key} not found: {spec[key]}")
+        shards.append(spec)
+    dense_merge = manifest.get("dense_merge", "auto")
+    if dense_merge not in DENSE_MERGE_MODES:
+        raise ValueError(f"{path}: dense_merge must be one of {DENSE_MERGE_MODES}")
+    return {"dense_merge": dense_merge, "shards": shards}
+
+
+def normalize_shard_scores(D: np.ndarray, I: np.ndarray, mode: str) -> np.ndarray:
+    """
+    Per-query score normalization of one shard's results (empty slots, I == -1,
+    are left at -inf): "minmax" maps each row to [0, 1], "zscore" to standard
+    scores; "raw" keeps the scores.
+    """
+    D = np.where(I >= 0, D, -np.inf).astype("float32")
+    if mode == "raw":
+        return D
+    valid = I >= 0
+    out = np.full_like(D, -np.inf)
+    for qi in range(D.shape[0]):
+        row = D[qi, valid[qi]]
+        if row.size == 0:
+            continue
+        if mode == "minmax":
+            span = float(row.max() - row.min())
+            out[qi, valid[qi]] = (row - row.min()) / span if span > 0 else 1.0
+        else:
+            std = float(row.std())
+            out[qi, valid[qi]] = (row - row.mean()) / std if std > 0 else 0.0
+    return out
+
+
+class ShardedIndex:
+    """
+    Several per-corpus indexes behind one faiss.Index-like search(): every shard
+    is searched for the top k in parallel (FAISS and the rescoring matmuls
+    release the GIL, so threads scale across cores without duplicating the
+    indexes in worker processes), then the shard lists are merged into the
+    global top k. Rows are global: shard i owns labels [offsets[i], offsets[i + 1]).
+
+    Dense merge: "raw" compares scores directly (correct when every shard was
+    embedded with the same model and returns cosine scores; L2 distances on
+    normalized vectors are converted to cosine), "minmax" / "zscore" normalize
+    each shard's list per query first (for shards whose scores are on different
+    scales, e.g. binary codes without rescoring). "auto" picks raw when all
+    shards return cosine scores.
+    """
+
+    def __init__(self, shards: List[Tuple[Any, Optional[np.ndarray], int]], executor: Optional[Executor] = None,
+                 dense_merge: str = "auto"):
+        faiss = lazy_import("faiss")
+        self.indexes = [index for index, _, _ in shards]
+        self.vectors = [vectors for _, vectors, _ in shards]
+        dims = {int(index.d) for index in self.indexes}
+        if len(dims) != 1:
+            raise RuntimeError(f"Shards have different dims {sorted(dims)}; embed all corpora with the same model")
+        self.d = dims.pop()
+        # label space per shard (len of its ids file, which may hold placeholders of removed chunks)
+        self.offsets = np.concatenate([[0], np.cumsum([n for _, _, n in shards])]).astype("int64")
+        self.ntotal = sum(int(index.ntotal) for index in self.indexes)
+        self.metric_type = faiss.METRIC_INNER_PRODUCT
+        self._l2 = [getattr(index, "metric_type", faiss.METRIC_INNER_PRODUCT) == faiss.METRIC_L2
+                    for index in self.indexes]
+        if dense_merge == "auto":
+            cosine = all(not (isinstance(index, RescoringIndex) and index.binary and index.vectors is None)
+                         for index in self.indexes)
+            dense_merge = "raw" if cosine else "minmax"
+        self.dense_merge = dense_merge
+        self.executor = executor
+
+    def _map(self, fn, items):
+        if self.executor is None or len(self.indexes) == 1:
+            return [fn(it) for it in items]
+        return list(self.executor.map(fn, items))
+
+    def _search_shard(self, si: int, queries: np.ndarray, k: int,
+                      chunk_filter: Optional[ChunkFilter]) -> Tuple[np.ndarray, np.ndarray]:
+        lo, hi = int(self.offsets[si]), int(self.offsets[si + 1])
+        sub = chunk_filter.subset(lo, hi) if chunk_filter is not None else None
+        D, I = search_index(self.indexes[si], queries, k, chunk_filter=sub, vectors=self.vectors[si])
+        if self._l2[si]:
+            D = 1.0 - D / 2.0  # squared L2 on unit vectors -> cosine
+        D = normalize_shard_scores(D, I, self.dense_merge)
+        return D, np.where(I >= 0, I + lo, -1)
+
+    def search(self, queries: np.ndarray, k: int, params=None,
+               chunk_filter: Optional[ChunkFilter] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if params is not None:
+            raise ValueError("ShardedIndex takes a chunk_filter, not FAISS SearchParameters")
+        queries = np.ascontiguousarray(queries, dtype="float32")
+        parts = self._map(lambda si: self._search_shard(si, queries, k, chunk_filter), range(len(self.indexes)))
+        D = np.hstack([d for d, _ in parts])
+        I = np.hstack([i for _, i in parts])
+        top = np.argsort(-D, axis=1, kind="stable")[:, :k]
+        D = np.take_along_axis(D, top, axis=1)
+        I = np.take_along_axis(I, top, axis=1)
+        I[~np.isfinite(D)] = -1
+        return D, I
+
+    def reconstruct_batch(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype="int64")
+        shard_of = np.searchsorted(self.offsets, rows, side="right") - 1
+        out = np.empty((rows.shape[0], self.d), dtype="float32")
+        for si in np.unique(shard_of):
+            sel = np.flatnonzero(shard_of == si)
+            vecs = candidate_vectors(self.indexes[si], rows[sel] - self.offsets[si], self.vectors[si])
+            if vecs is None:
+                raise RuntimeError(f"shard {si} cannot reconstruct vectors")
+            out[sel] = vecs
+        return out
+
+
+class ShardedBM25:
+    """
+    Per-corpus BM25 indexes behind the BM25Index ranking API. Each shard keeps
+    its own idf statistics, so raw BM25 scores are not comparable across
+    shards: the shard rankings (computed in parallel) are merged by rank, best
+    of every shard first, ties broken by the score relative to the shard's top
+    hit. That merged order is what RRF fuses with the dense list. `doc_ids`
+    (and so ChunkFilter.doc_mask) span all shards in order.
+    """
+
+    def __init__(self, indexes: List[BM25Index], executor: Optional[Executor] = None):
+        self.indexes = indexes
+        self.executor = executor
+        self.doc_ids: List[str] = [cid for idx in indexes for cid in idx.doc_ids]
+        self.doc_offsets = np.concatenate([[0], np.cumsum([len(idx.doc_ids) for idx in indexes])]).astype("int64")
+
+    @property
+    def N(self) -> int:
+        return len(self.doc_ids)
+
+    def rank_scored(self, query: str, topn: int = 60, k1: float = 1.5, b: float = 0.75,
+                    doc_mask: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        def one(si: int) -> List[Tuple[str, float]]:
+            lo, hi = int(self.doc_offsets[si]), int(self.doc_offsets[si + 1])
+            mask = doc_mask[lo:hi] if doc_mask is not None else None
+            return self.indexes[si].rank_scored(query, topn=topn, k1=k1, b=b, doc_mask=mask)
+
+        if self.executor is None or len(self.indexes) == 1:
+            lists = [one(si) for si in range(len(self.indexes))]
+        else:
+            lists = list(self.executor.map(one, range(len(self.indexes))))
+        merged = [(rank, -score / hits[0][1], si, cid, score)
+                  for si, hits in enumerate(lists) for rank, (cid, score) in enumerate(hits)]
+        merged.sort()
+        return [(cid, score) for _, _, _, cid, score in merged[:topn]]
+
+    def rank(self, query: str, topn: int = 60, k1: float = 1.5, b: float = 0.75,
+             doc_mask: Optional[np.ndarray] = None) -> List[str]:
+        return [cid for cid, _ in self.rank_scored(query, topn=topn, k1=k1, b=b, doc_mask=doc_mask)]
+
+
+# =========================
+# Resources (loaded once, shared by CLI and server)
+# =========================
+CORPUS_VERSION_CHECK_S = 5.0  # how often corpus_version re-stats the files (result cache invalidation)
+
+
+class RetrievalResources:
+    """
+    Everything retrieve() needs, loaded once. The reranker and the BM25 index
+    are created lazily (thread-safe) the first time a request asks for them.
+    When `trace_sinks` is non-empty, every run() / run_batch() is traced and
+    the trace emitted to those sinks.
+
+    Concurrency: `branch_workers` > 0 runs the BM25 branch (and chunk fetches)
+    on a shared pool alongside the dense branch; arun() serves asyncio callers
+    from a separate pool of `max_concurrent` threads. `torch_threads` /
+    `faiss_threads` cap the intra-op threads of the models / FAISS so the pools
+    do not oversubscribe the cores (0 = library default).
+    """
+
+    def __init__(self, chunks_path: Path, index_path: Optional[Path], ids_path: Optional[Path],
+                 embedder_name: Optional[str] = None,
+                 reranker_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                 bm25_dir: Optional[Path] = None, rebuild_bm25: bool = False,
+                 vectors_path: Optional[Path] = None,
+                 embed_cache: Optional[EmbeddingCache] = None,
+                 rerank_cache_size: int = 100_000, rerank_batch_size: int = 128,
+                 rerank_window_ms: float = 5.0, rerank_coalesce: bool = False,
+                 search_params: Optional[Dict[str, Any]] = None,
+                 mmap_index: bool = False, chunk_store_dir: Optional[Path] = None,
+                 sparse_only: bool = False, rescore_factor: Optional[int] = None,
+                 backend: str = "sbert", onnx: Optional[OnnxBackend] = None,
+                 branch_workers: int = 0, max_concurrent: int = 4,
+                 torch_threads: int = 0, faiss_threads: int = 0,
+                 embedder: Optional[Embedder] = None, result_cache: Optional[ResultCache] = None,
+                 tokenizer: str = "auto", verify: bool = False):
+        self.chunks_path = chunks_path
+        self.index_path = index_path
+        self.ids_path = ids_path
+        self.sparse_only = sparse_only
+        self.bm25_dir = bm25_dir or (index_path or chunks_path).with_suffix(".bm25")
+        self.rebuild_bm25 = rebuild_bm25
+        self.verify = verify
+        self._init_runtime(reranker_name=reranker_name, backend=backend, onnx=onnx,
+                           rerank_cache_size=rerank_cache_size, rerank_batch_size=rerank_batch_size,
+                           rerank_window_ms=rerank_window_ms, rerank_coalesce=rerank_coalesce,
+                           branch_workers=branch_workers, max_concurrent=max_concurrent,
+                           result_cache=result_cache, tokenizer=tokenizer)
+        self._version_paths = [chunks_path, index_path, ids_path, vectors_path]
+        self._init_corpus_version()
+
+        # Load FAISS (dense modes only)
+        if not sparse_only:
+            faiss = lazy_import("faiss")
+            if faiss_threads > 0:
+                faiss.omp_set_num_threads(faiss_threads)
+            self.index_meta = load_index_meta(index_path)
+            compress = self.index_meta.get("compress", "none")
+            eprint(f"[info] Loading FAISS index: {index_path}")
+            with timed("load:faiss_index"):
+                self.index = read_faiss_index(index_path, use_mmap=mmap_index, binary=(compress == "binary"))
+            idx_dim = int(self.index.d)
+            metric_type = getattr(self.index, "metric_type", faiss.METRIC_INNER_PRODUCT)
+            metric_name = "IP" if metric_type == faiss.METRIC_INNER_PRODUCT else "L2/Other"
+            if compress == "binary":
+                metric_name = "Hamming"
+            eprint(f"[info] FAISS index dim: {idx_dim} (metric: {metric_name}), ntotal: {self.index.ntotal}")
+
+            # ANN search params: build metadata, then explicit overrides
+            search = {**self.index_meta.get("search", {}),
+                      **{k: v for k, v in (search_params or {}).items() if v is not None}}
+            if search:
+                apply_search_params(self.index, search)
+                eprint(f"[info] Index type: {self.index_meta.get('index_type', 'unknown')}, search params: {search}")
+
+        # Load ids/chunks
+        self.all_ids: List[str] = []
+        if ids_path is not None:
+            eprint(f"[info] Loading ids: {ids_path}")
+            with timed("load:ids"):
+                self.all_ids = read_json(ids_path)
+        # Incrementally updated builds keep null placeholders for removed chunks (FAISS label == position)
+        n_live = sum(cid is not None for cid in self.all_ids)
+        if self.index is not None and n_live != self.index.ntotal:
+            eprint(f"[warn] ids count ({n_live}) != index.ntotal ({self.index.ntotal}). "
+                   "Proceeding, but ensure they match.")
+
+        with timed("load:chunks"):
+            if chunk_store_dir is not None:
+                eprint(f"[info] Opening chunk store: {chunk_store_dir}")
+                self.chunks: Mapping = ChunkStore.open_or_build(chunks_path, chunk_store_dir, order=self.all_ids,
+                                                               verify=verify)
+            else:
+                eprint(f"[info] Loading chunks: {chunks_path}")
+                self.chunks = read_chunks_jsonl(chunks_path)
+        self.id_to_row = {cid: i for i, cid in enumerate(self.all_ids) if cid is not None}
+
+        if sparse_only:
+            return
+        build = load_build_manifest(index_path)
+        if build:
+            with timed("load:verify_build"):
+                verify_build(build, self.index_meta, self.index, ids_path, self.chunks, chunks_path,
+                             verify=verify)
+
+        # Optional persisted embedding matrix (rows aligned with ids), used by MMR and,
+        # for compressed indexes, to rescore first-stage candidates at full precision
+        compress = self.index_meta.get("compress", "none")
+        if rescore_factor is None:
+            rescore_factor = int(self.index_meta.get("rescore_factor") or 0)
+        if vectors_path is None and compress != "none" and rescore_factor > 0:
+            default_vectors = index_path.with_name(index_path.stem + "_vectors.npy")
+            if default_vectors.exists():
+                vectors_path = default_vectors
+            else:
+                eprint(f"[warn] Compressed index ({compress}) but no {default_vectors.name}; "
+                       "searching without full-precision rescoring.")
+        if vectors_path is not None:
+            eprint(f"[info] Loading vectors: {vectors_path}")
+            self.vectors = np.load(vectors_path, mmap_mode="r")
+            if self.vectors.shape[0] != len(self.all_ids):
+                raise RuntimeError(f"--vectors rows ({self.vectors.shape[0]}) != ids count ({len(self.all_ids)})")
+        if compress != "none":
+            use_vectors = self.vectors if rescore_factor > 0 else None
+            self.index = RescoringIndex(self.index, use_vectors, factor=rescore_factor or 1,
+                                        binary=(compress == "binary"))
+            eprint(f"[info] Compressed first stage: {compress}"
+                   + (f", rescoring top k x {rescore_factor} at full precision" if use_vectors is not None else ""))
+
+        # Pick and build embedder (or share the one passed in, e.g. across shards)
+        if embedder is not None:
+            chosen_model = embedder.model_name
+            self.embedder = embedder
+        else:
+            chosen_model = pick_embedder_model_name(idx_dim, embedder_name or self.index_meta.get("model"))
+            eprint(f"[info] Using embedder: {chosen_model} (backend: {backend})")
+            self.embedder = Embedder(model_name=chosen_model, backend=backend, onnx=onnx)
+        if torch_threads > 0 and "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(torch_threads)
+
+        # Verify embedder dimension matches index
+        probe_dim = self.embedder.dim
+        if probe_dim != idx_dim:
+            raise RuntimeError(
+                f"Embedder '{chosen_model}' dim={probe_dim} does not match FAISS index dim={idx_dim}. "
+                "Please pass --embedder with the exact model used to build the index. "
+                "Common pairs: 384->all-MiniLM-L6-v2, 768->BAAI/bge-base-en-v1.5, 1024->BAAI/bge-large-en-v1.5."
+            )
+
+        # Query-embedding cache in front of the model (covers variants + HyDE hint)
+        self._cache_embedder(embed_cache)
+
+    def _cache_embedder(self, embed_cache: Optional[EmbeddingCache]) -> None:
+        """
+        Wrap self.embedder in a CachedEmbedder. The result cache keys on the raw
+        query's embedding and retrieve() encodes that query again on a miss, so
+        with a result cache an in-process cache is always used.
+        """
+        if embed_cache is None and self.result_cache is not None:
+            embed_cache = EmbeddingCache()
+        self.embed_cache = embed_cache
+        if embed_cache is not None:
+            self.embedder = CachedEmbedder(self.embedder, embed_cache)
+
+    def _compute_corpus_version(self) -> str:
+        return files_fingerprint(self._version_paths)
+
+    def _init_corpus_version(self) -> None:
+        self._corpus_version = self._compute_corpus_version()
+        self._version_checked = time.monotonic()
+
+    @property
+    def corpus_version(self) -> str:
+        """
+        Stat-based fingerprint of the corpus files (result-cache tag). Re-checked
+        at most every CORPUS_VERSION_CHECK_S, so rebuilt chunks / index files
+        invalidate cached results in a long-running server.
+        """
+        now = time.monotonic()
+        if now - self._version_checked >= CORPUS_VERSION_CHECK_S:
+            self._version_checked = now
+            try:
+                version = self._compute_corpus_version()
+            except OSError:  # a file is missing mid-rebuild: treat as changed
+                version = "unavailable"
+            if version != self._corpus_version:
+                eprint("[warn] Corpus files changed on disk; cached results dropped "
+                       "(restart to load the rebuilt index).")
+                self._corpus_version = version
+        return self._corpus_version
+
+    def _init_runtime(self, reranker_name: str, backend: str, onnx: Optional[OnnxBackend],
+                      rerank_cache_size: int, rerank_batch_size: int, rerank_window_ms: float,
+                      rerank_coalesce: bool, branch_workers: int, max_concurrent: int,
+                      result_cache: Optional[ResultCache] = None, tokenizer: str = "auto") -> None:
+        """Lazy-model slots, caches and pools (everything except the loaded data)."""
+        if result_cache is not None and self.sparse_only:
+            raise ValueError("the semantic result cache needs query embeddings (not available with sparse_only)")
+        self.result_cache = result_cache
+        self.tokenizer = tokenizer
+        self._token_counter: Optional[TokenCounter] = None
+        self.reranker_name = reranker_name
+        self.backend = backend
+        self.onnx = onnx
+        self._lock = threading.Lock()
+        self.rerank_cache_size = rerank_cache_size
+        self.rerank_batch_size = rerank_batch_size
+        self.rerank_window_ms = rerank_window_ms
+        self.rerank_coalesce = rerank_coalesce
+        self._reranker: Optional[CachedReRanker] = None
+        self._bm25: Optional[BM25Index] = None
+        self._meta_index: Optional[MetadataIndex] = None
+        self._filters: "OrderedDict[str, ChunkFilter]" = OrderedDict()
+        self.index = None
+        self.index_meta: Dict[str, Any] = {}
+        self.embedder = None
+        self.embed_cache = None
+        self.vectors: Optional[np.ndarray] = None
+        self.trace_sinks: List[Any] = []
+        self.branch_pool: Optional[ThreadPoolExecutor] = None
+        if branch_workers > 0:
+            self.branch_pool = ThreadPoolExecutor(max_workers=branch_workers, thread_name_prefix="branch")
+        self.max_concurrent = max(1, max_concurrent)
+        self._request_pool: Optional[ThreadPoolExecutor] = None
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "embed_cache": self.embed_cache.stats() if self.embed_cache is not None else None,
+            "rerank_cache": self._reranker.stats() if self._reranker is not None else None,
+            "result_cache": self.result_cache.stats() if self.result_cache is not None else None,
+        }
+
+    def get_reranker(self) -> CachedReRanker:
+        with self._lock:
+            if self._reranker is None:
+                model = ReRanker(model_name=self.reranker_name, batch_size=self.rerank_batch_size,
+                                 backend=self.backend, onnx=self.onnx)
+                batcher = None
+                if self.rerank_coalesce:
+                    batcher = RerankBatcher(model, max_batch=self.rerank_batch_size,
+                                            window_ms=self.rerank_window_ms)
+                self._reranker = CachedReRanker(model, cache_size=self.rerank_cache_size, batcher=batcher)
+            return self._reranker
+
+    def get_bm25_index(self) -> BM25Index:
+        with self._lock:
+            if self._bm25 is None:
+                eprint(f"[info] Loading BM25 index: {self.bm25_dir}")
+                with timed("load:bm25_index"):
+                    self._bm25 = load_or_build_bm25_index(self.chunks, self.chunks_path, self.bm25_dir,
+                                                          rebuild=self.rebuild_bm25, verify=self.verify)
+            return self._bm25
+
+    def get_token_counter(self) -> TokenCounter:
+        with self._lock:
+            if self._token_counter is None:
+                self._token_counter = TokenCounter(self.tokenizer)
+            return self._token_counter
+
+    def packed_payload(self, query: str, contexts: List[Dict[str, Any]], top_ids: List[str],
+                       scores: Dict[str, float], o: Dict[str, Any]) -> Dict[str, Any]:
+        """result_payload() plus, with a token budget, the packed contexts (pack_contexts())."""
+        payload = result_payload(query, contexts, top_ids, scores)
+        if o["token_budget"] > 0:
+            payload["packed"] = pack_contexts(top_ids, scores, self.chunks, o["token_budget"],
+                                              self.get_token_counter())
+        return payload
+
+    def get_metadata_index(self) -> MetadataIndex:
+        with self._lock:
+            if self._meta_index is None:
+                eprint("[info] Building metadata field index")
+                with timed("load:metadata_index"):
+                    self._meta_index = MetadataIndex(self.all_ids or list(self.chunks.keys()), self.chunks)
+            return self._meta_index
+
+    def compile_filter(self, expr: Optional[str]) -> Optional[ChunkFilter]:
+        """Compiled filters are kept in a small LRU (the FAISS selector is built once per filter)."""
+        expr = (expr or "").strip()
+        if not expr:
+            return None
+        meta_index = self.get_metadata_index()
+        with self._lock:
+            flt = self._filters.get(expr)
+            if flt is not None:
+                self._filters.move_to_end(expr)
+                return flt
+        flt = meta_index.compile(expr)
+        with self._lock:
+            self._filters[expr] = flt
+            while len(self._filters) > 256:
+                self._filters.popitem(last=False)
+        return flt
+
+    def retrieve_kwargs(self, o: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(
+            index=self.index,
+            all_ids=self.all_ids,
+            chunks=self.chunks,
+            embedder=self.embedder,
+            k_per_branch=o["k_per_branch"],
+            deliver_to_llm=o["deliver_to_llm"],
+            use_mmr=o["mmr"],
+            mmr_lambda=o["mmr_lambda"],
+            use_rerank=o["rerank"],
+            reranker=self.get_reranker() if o["rerank"] else None,
+            n_variants=max(1, o["multiquery"]),
+            use_hyde=o["hyde"],
+            hybrid=o["hybrid"],
+            bm25_index=self.get_bm25_index() if o["hybrid"] else None,
+            rrf_k=o["rrf_k"],
+            id_to_row=self.id_to_row,
+            vectors=self.vectors,
+            chunk_filter=self.compile_filter(o["filter"]),
+            branch_executor=self.branch_pool,
+        )
+
+    def new_tracer(self, **attrs) -> Tracer:
+        return Tracer(self.trace_sinks, **attrs) if self.trace_sinks else NULL_TRACER
+
+    def run(self, query: str, opts: Dict[str, Any], tracer: Optional[Tracer] = None) -> Dict[str, Any]:
+        """
+        Run retrieve() with CLI-style options (see RETRIEVE_OPTIONS) and return
+        a JSON-serializable result. A tracer passed in is left open for the
+        caller to finish(); otherwise one is created (and finished) if sinks
+        are configured.
+        """
+        o = resolve_options(opts)
+        own_tracer = tracer is None
+        if own_tracer:
+            tracer = self.new_tracer(query=query, options=o)
+        if self.result_cache is not None:
+            options_key = ResultCache.options_key(o)
+            with tracer.stage("result_cache") as span:
+                qvec = self.embedder.encode([query])[0]
+                hit = self.result_cache.get(qvec, options_key, self.corpus_version)
+                span["hit"] = hit is not None
+            if hit is not None:
+                if own_tracer:
+                    tracer.finish()
+                return cached_result_payload(query, hit)
+        scores: Dict[str, float] = {}
+        if self.sparse_only:
+            contexts, top_ids = retrieve_sparse(
+                query, self.chunks, self.get_bm25_index(), deliver_to_llm=o["deliver_to_llm"],
+                use_rerank=o["rerank"], reranker=self.get_reranker() if o["rerank"] else None, scores=scores,
+                tracer=tracer, chunk_filter=self.compile_filter(o["filter"]),
+            )
+        else:
+            contexts, top_ids = retrieve(query=query, scores=scores, tracer=tracer, **self.retrieve_kwargs(o))
+        if own_tracer:
+            tracer.finish()
+        payload = self.packed_payload(query, contexts, top_ids, scores, o)
+        if self.result_cache is not None:
+            self.result_cache.put(qvec, options_key, self.corpus_version, query, payload)
+        return payload
+
+    async def arun(self, query: str, opts: Dict[str, Any]) -> Dict[str, Any]:
+        """asyncio version of run(): at most `max_concurrent` retrievals in flight."""
+        with self._lock:
+            if self._request_pool is None:
+                self._request_pool = ThreadPoolExecutor(max_workers=self.max_concurrent,
+                                                        thread_name_prefix="aretrieve")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._request_pool, self.run, query, opts)
+
+    def close(self) -> None:
+        for pool in (self._request_pool, self.branch_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        if self.embed_cache is not None:
+            self.embed_cache.close()
+
+    def run_batch(self, queries: List[str], opts: Dict[str, Any], batch_size: int = 256,
+                  tracer: Optional[Tracer] = None) -> List[Dict[str, Any]]:
+        if self.sparse_only:
+            return [self.run(q, opts, tracer=tracer) for q in queries]
+        o = resolve_options(opts)
+        own_tracer = tracer is None
+        if own_tracer:
+            tracer = self.new_tracer(queries=len(queries), batch_size=batch_size, options=o)
+        out: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        todo = list(range(len(queries)))
+        if self.result_cache is not None:
+            options_key = ResultCache.options_key(o)
+            with tracer.stage("result_cache", queries=len(queries)) as span:
+                qvecs = self.embedder.encode(queries) if queries else None
+                todo = []
+                for i, q in enumerate(queries):
+                    hit = self.result_cache.get(qvecs[i], options_key, self.corpus_version)
+                    if hit is not None:
+                        out[i] = cached_result_payload(q, hit)
+                    else:
+                        todo.append(i)
+                span["hits"] = len(queries) - len(todo)
+        if todo:
+            results = retrieve_batch([queries[i] for i in todo], batch_size=batch_size, tracer=tracer,
+                                     **self.retrieve_kwargs(o))
+            for i, (contexts, top_ids, scores) in zip(todo, results):
+                out[i] = self.packed_payload(queries[i], contexts, top_ids, scores, o)
+                if self.result_cache is not None:
+                    self.result_cache.put(qvecs[i], options_key, self.corpus_version, queries[i], out[i])
+        if own_tracer:
+            tracer.finish()
+        return out
+
+
+class ShardedResources(RetrievalResources):
+    """
+    RetrievalResources over a shard manifest (load_shard_manifest()): one
+    RetrievalResources per corpus, all sharing a single embedder, behind a
+    ShardedIndex / ShardedBM25 and a merged chunk mapping, so retrieve(),
+    filters, MMR, rerank and the server work unchanged on the union. Adding a
+    corpus adds a parallel search task (`shard_workers` threads, default one
+    per shard) instead of a longer single-threaded scan. Chunk ids must be
+    unique across shards.
+    """
+
+    def __init__(self, manifest_path: Path, shard_workers: int = 0, dense_merge: Optional[str] = None,
+                 embedder_name: Optional[str] = None,
+                 reranker_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                 rebuild_bm25: bool = False, embed_cache: Optional[EmbeddingCache] = None,
+                 rerank_cache_size: int = 100_000, rerank_batch_size: int = 128,
+                 rerank_window_ms: float = 5.0, rerank_coalesce: bool = False,
+                 search_params: Optional[Dict[str, Any]] = None, mmap_index: bool = False,
+                 sparse_only: bool = False, rescore_factor: Optional[int] = None,
+                 backend: str = "sbert", onnx: Optional[OnnxBackend] = None,
+                 branch_workers: int = 0, max_concurrent: int = 4,
+                 torch_threads: int = 0, faiss_threads: int = 0,
+                 result_cache: Optional[ResultCache] = None, tokenizer: str = "auto", verify: bool = False):
+        manifest = load_shard_manifest(manifest_path)
+        specs = manifest["shards"]
+        if not sparse_only:
+            missing = [spec["name"] for spec in specs if spec["faiss"] is None or spec["ids"] is None]
+            if missing:
+                raise ValueError(f"shards {missing} have no faiss / ids (use --sparse-only)")
+        self.chunks_path = manifest_path
+        self.index_path = None
+        self.ids_path = None
+        self.sparse_only = sparse_only
+        self.bm25_dir = None
+        self.rebuild_bm25 = rebuild_bm25
+        self.verify = verify
+        self._init_runtime(reranker_name=reranker_name, backend=backend, onnx=onnx,
+                           rerank_cache_size=rerank_cache_size, rerank_batch_size=rerank_batch_size,
+                           rerank_window_ms=rerank_window_ms, rerank_coalesce=rerank_coalesce,
+                           branch_workers=branch_workers, max_concurrent=max_concurrent,
+                           result_cache=result_cache, tokenizer=tokenizer)
+
+        self.shards: List[RetrievalResources] = []
+        embedder = None
+        for spec in specs:
+            eprint(f"[info] Loading shard {spec['name']!r}")
+            shard = RetrievalResources(
+                chunks_path=spec["chunks"], index_path=spec["faiss"], ids_path=spec["ids"],
+                embedder_name=embedder_name, bm25_dir=spec["bm25"], rebuild_bm25=rebuild_bm25,
+                vectors_path=spec["vectors"], search_params=search_params, mmap_index=mmap_index,
+                chunk_store_dir=spec["chunk_store"], sparse_only=sparse_only, rescore_factor=rescore_factor,
+                backend=backend, onnx=onnx, torch_threads=torch_threads, faiss_threads=faiss_threads,
+                embedder=embedder, verify=verify,
+            )
+            if embedder is not None and shard.index_meta.get("model") not in (None, embedder.model_name):
+                raise RuntimeError(f"shard {spec['name']!r} was embedded with {shard.index_meta['model']}, "
+                                   f"other shards with {embedder.model_name}; dense scores would not be comparable")
+            embedder = shard.embedder
+            self.shards.append(shard)
+        self.shard_names = [spec["name"] for spec in specs]
+        self._version_paths = [manifest_path]
+        self._init_corpus_version()
+
+        self.chunks = ChainMap(*[shard.chunks for shard in self.shards])
+        n_chunks = sum(len(shard.chunks) for shard in self.shards)
+        if len(self.chunks) != n_chunks:
+            seen: Dict[str, str] = {}
+            dupes = []
+            for name, shard in zip(self.shard_names, self.shards):
+                for cid in shard.chunks:
+                    if cid in seen:
+                        dupes.append(f"{cid} ({seen[cid]}, {name})")
+                    seen.setdefault(cid, name)
+            raise RuntimeError(f"{len(dupes)} chunk ids occur in several shards, e.g. {dupes[:3]}; "
+                               "chunk ids must be unique across the manifest")
+        self.all_ids = [cid for shard in self.shards for cid in shard.all_ids]
+        self.id_to_row = {cid: i for i, cid in enumerate(self.all_ids) if cid is not None}
+
+        workers = shard_workers if shard_workers > 0 else len(self.shards)
+        self.shard_pool: Optional[ThreadPoolExecutor] = None
+        if workers > 1 and len(self.shards) > 1:
+            self.shard_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard")
+        eprint(f"[info] {len(self.shards)} shards, {len(self.chunks)} chunks, "
+               f"fan-out on {workers if self.shard_pool is not None else 1} thread(s)")
+        if sparse_only:
+            return
+        self.index = ShardedIndex([(shard.index, shard.vectors, len(shard.all_ids)) for shard in self.shards],
+                                  executor=self.shard_pool, dense_merge=dense_merge or manifest["dense_merge"])
+        eprint(f"[info] Dense merge: {self.index.dense_merge}")
+        self.embedder = embedder
+        self._cache_embedder(embed_cache)
+
+    def _compute_corpus_version(self) -> str:
+        return hashlib.sha1("\x00".join(
+            [files_fingerprint(self._version_paths)] +
+            [files_fingerprint(shard._version_paths) for shard in self.shards]
+        ).encode("utf-8")).hexdigest()
+
+    def get_bm25_index(self) -> ShardedBM25:
+        indexes = [shard.get_bm25_index() for shard in self.shards]
+        with self._lock:
+            if self._bm25 is None:
+                self._bm25 = ShardedBM25(indexes, executor=self.shard_pool)
+            return self._bm25
+
+    def close(self) -> None:
+        super().close()
+        if self.shard_pool is not None:
+            self.shard_pool.shutdown(wait=True)
+
+
+def result_payload(query: str, contexts: List[Dict[str, Any]], top_ids: List[str],
+                   scores: Dict[str, float]) -> Dict[str, Any]:
+    return {
+        "query": query,
+        "top_ids": top_ids,
+        "scores": [scores.get(cid) for cid in top_ids],
+        "contexts": contexts,
+    }
+
+
+def cached_result_payload(query: str, hit: Tuple[Dict[str, Any], str, float]) -> Dict[str, Any]:
+    """A ResultCache hit as a run() payload, noting which cached query answered it."""
+    payload, cached_query, similarity = hit
+    return {**payload, "query": query,
+            "result_cache": {"query": cached_query, "similarity": round(similarity, 6)}}
+
+
+# Retrieval options shared by the CLI flags, the server payload and the client.
+RETRIEVE_OPTIONS: Dict[str, Any] = {
+    "k_per_branch": 20,
+    "deliver_to_llm": 10,
+    "multiquery": 3,
+    "hyde": False,
+    "hybrid": False,
+    "rrf_k": 60,
+    "mmr": False,
+    "mmr_lambda": 0.5,
+    "rerank": False,
+    "filter": "",
+    "token_budget": 0,
+}
+
+
+TRUE_STRINGS = {"true", "1", "yes", "on"}
+FALSE_STRINGS = {"false", "0", "no", "off"}
+
+
+def parse_bool(value: Any) -> bool:
+    """Strict boolean: bool, 0/1 or true/false, yes/no, on/off strings; anything else is a ValueError."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        v = value.strip().lower()
+        if v in TRUE_STRINGS:
+            return True
+        if v in FALSE_STRINGS:
+            return False
+    raise ValueError(f"expected a boolean, got {value!r}")
+
+
+def resolve_options(opts: Dict[str, Any]) -> Dict[str, Any]:
+    """RETRIEVE_OPTIONS overridden by `opts`; raises ValueError on values of the wrong type."""
+    out = dict(RETRIEVE_OPTIONS)
+    for key, default in RETRIEVE_OPTIONS.items():
+        value = opts.get(key)
+        if value is None:
+            continue
+        try:
+            out[key] = parse_bool(value) if isinstance(default, bool) else type(default)(value)
+        except ValueError as e:
+            raise ValueError(f"invalid '{key}': {e}") from None
+    return out
+
+
+# =========================
+# Server mode (HTTP over TCP or Unix socket)
+# =========================
+class _RetrievalHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health    -> {"status": "ok", ...}
+    GET  /metrics   -> per-stage latency histograms (HistogramSink.snapshot())
+    POST /retrieve  -> body {"query": "...", <RETRIEVE_OPTIONS keys, e.g. "filter": "category=ATHN",
+                       "token_budget": 3000 (adds "packed")>}
+                       or {"queries": [...], ...} -> {"results": [...]}
+                       "trace": true adds the per-stage trace to the response
+    """
+    server_version = "RAGRetriever/1.0"
+
+    def _send_json(self, code: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            res: RetrievalResources = self.server.resources
+            ntotal = len(res.chunks) if res.index is None else int(res.index.ntotal)
+            self._send_json(200, {"status": "ok", "ntotal": ntotal,
+                                  "embedder": getattr(res.embedder, "model_name", None),
+                                  "sparse_only": res.sparse_only, **res.cache_stats()})
+        elif self.path.rstrip("/") == "/metrics":
+            self._send_json(200, {"stages": self.server.metrics.snapshot()})
+        else:
+            self._send_json(404, {"error": f"unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/retrieve":
+            self._send_json(404, {"error": f"unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            query = payload.get("query")
+            queries = payload.get("queries")
+            if not query and not isinstance(queries, list):
+                raise ValueError("missing 'query' (or 'queries' list)")
+            opts = {**self.server.default_options, **payload}
+            resolve_options(opts)
+            self.server.resources.compile_filter(opts.get("filter"))
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            res: RetrievalResources = self.server.resources
+            tracer = Tracer(res.trace_sinks) if payload.get("trace") else None
+            if queries is not None:
+                out = {"results": res.run_batch([str(q) for q in queries], opts, tracer=tracer)}
+            else:
+                out = res.run(query, opts, tracer=tracer)
+            if tracer is not None:
+                out["trace"] = tracer.finish(queries=len(queries) if queries is not None else 1)
+            self._send_json(200, out)
+        except Exception as e:
+            eprint(f"[error] retrieve failed: {e!r}")
+            self._send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        eprint("[serve] " + (format % args))
+
+
+class _PooledServerMixin:
+    """Hand each accepted connection to a fixed-size thread pool."""
+
+    def init_pool(self, workers: int) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="retrieve")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request_pooled, request, client_address)
+
+    def _process_request_pooled(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class PooledHTTPServer(_PooledServerMixin, HTTPServer):
+    pass
+
+
+class PooledUnixHTTPServer(_PooledServerMixin, socketserver.UnixStreamServer):
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port)-like client address
+        return request, ("unix", 0)
+
+
+def remove_stale_socket(path: Path) -> None:
+    """Unlink a leftover Unix socket at `path`; refuse to remove anything that is not a socket."""
+    try:
+        mode = path.lstat().st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"--unix-socket path exists and is not a socket: {path}")
+    path.unlink()
+
+
+def serve(resources: RetrievalResources, default_options: Dict[str, Any],
+          host: str = "127.0.0.1", port: int = 8765,
+          unix_socket: Optional[str] = None, workers: int = 4) -> None:
+    if unix_socket:
+        sock_path = Path(unix_socket)
+        remove_stale_socket(sock_path)
+        httpd = PooledUnixHTTPServer(str(sock_path), _RetrievalHandler)
+        where = f"unix://{sock_path}"
+    else:
+        httpd = PooledHTTPServer((host, port), _RetrievalHandler)
+        where = f"http://{host}:{port}"
+    httpd.init_pool(workers)
+    httpd.resources = resources
+    httpd.default_options = default_options
+    httpd.metrics = HistogramSink()
+    resources.trace_sinks.append(httpd.metrics)
+    eprint(f"[info] Serving on {where} with {workers} workers (Ctrl+C to stop)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        eprint("[info] Shutting down")
+    finally:
+        httpd.server_close()
+        if unix_socket:
+            remove_stale_socket(Path(unix_socket))
+
+
+# =========================
+# Client (forward to a running server)
+# =========================
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = 60.0):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _server_connection(server: str, timeout: float) -> http.client.HTTPConnection:
+    if server.startswith("unix://"):
+        return _UnixHTTPConnection(server[len("unix://"):], timeout=timeout)
+    parsed = urlparse(server if "://" in server else f"http://{server}")
+    return http.client.HTTPConnection(parsed.hostname or "127.0.0.1", parsed.port or 8765, timeout=timeout)
+
+
+def query_server(server: str, query: str, opts: Dict[str, Any], timeout: float = 60.0) -> Optional[Dict[str, Any]]:
+    """
+    POST the query to a running server. Returns None only if no server is
+    listening (connection refused / no socket file) so the caller can fall back
+    to local retrieval; timeouts and other errors are raised, since the server
+    may still be working on the query.
+    """
+    conn = _server_connection(server, timeout)
+    try:
+        body = json.dumps({"query": query, **resolve_options(opts)}).encode("utf-8")
+        conn.request("POST", "/retrieve", body=body, headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        payload = json.loads(resp.read() or b"{}")
+    except (ConnectionRefusedError, FileNotFoundError) as e:
+        eprint(f"[info] No retrieval server at {server} ({e}); running locally.")
+        return None
+    except (socket.timeout, OSError) as e:
+        raise RuntimeError(f"Retrieval server {server} did not answer: {e!r}") from e
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise RuntimeError(f"Retrieval server error {resp.status}: {payload.get('error')}")
+    return payload
 
 
 # =========================
 # CLI
 # =========================
-def main():
+def build_arg_parser() -> argparse.ArgumentParser:
     ap = argparse.ArgumentParser(description="RAG Retriever (UR-ready, hybrid optional)")
-    ap.add_argument("--chunks", required=True, help="Path to chunks JSONL")
-    ap.add_argument("--faiss", required=True, dest="faiss_path", help="Path to FAISS index")
-    ap.add_argument("--ids",   required=True, help="Path to FAISS ids.json")
-
-    ap.add_argument("--backend", default="sbert", choices=["sbert"], help="Embed backend (only sbert supported)")
+    ap.add_argument("--chunks", help="Path to chunks JSONL")
+    ap.add_argument("--faiss", dest="faiss_path", help="Path to FAISS index")
+    ap.add_argument("--ids",   help="Path to FAISS ids.json")
+    ap.add_argument("--shards", default=None,
+                    help="Shard manifest (JSON) listing several corpora, each with its own chunks / index / ids / "
+                         "BM25; searched in parallel and merged into one global top-k (replaces --chunks/--faiss/--ids)")
+    ap.add_argument("--shard-workers", type=int, default=0,
+                    help="Threads for the per-shard fan-out (0 = one per shard)")
+    ap.add_argument("--dense-merge", default=None, choices=DENSE_MERGE_MODES,
+                    help="How dense scores from different shards are merged (default: from the manifest, else auto)")
+
+    ap.add_argument("--backend", default="sbert", choices=["sbert", "onnx"],
+                    help="Embedder / reranker backend: sbert (PyTorch) or onnx (onnxruntime, exported once and cached)")
+    ap.add_argument("--onnx-cache", default=None, help="Directory for exported ONNX models (default: ~/.cache/rag_onnx)")
+    ap.add_argument("--onnx-quantize", default=None, choices=ONNX_QUANT_TARGETS,
+                    help="Dynamic int8 quantization target for the ONNX models")
+    ap.add_argument("--intra-op-threads", type=int, default=0, help="onnxruntime intra-op threads (0 = default)")
+    ap.add_argument("--inter-op-threads", type=int, default=0, help="onnxruntime inter-op threads (0 = default)")
+    ap.add_argument("--onnx-check", action="store_true",
+                    help="Compare the onnx backend against sbert on sample chunks (cosine / score agreement) and exit")
+    ap.add_argument("--onnx-export-check", action="store_true",
+                    help="After exporting / quantizing the embedder, compare it against sbert "
+                         "(loads the sbert model once more)")
     ap.add_argument("--embedder", default=None, help="SentenceTransformer model name (optional, auto if omitted)")
-    ap.add_argument("--query", required=True, help="User query")
+    ap.add_argument("--query", help="User query")
     ap.add_argument("--preset", default="auto", help="Placeholder to keep compatibility")
 
     ap.add_argument("--k-per-branch", type=int, default=20, help="Top-k per query variant")
@@ -439,101 +3244,397 @@ def main():
 
     ap.add_argument("--hybrid", action="store_true", help="Enable sparse BM25 + dense fusion (RRF)")
     ap.add_argument("--rrf-k", type=int, default=60, help="RRF k constant")
+    ap.add_argument("--bm25-index", default=None,
+                    help="BM25 index directory (default: next to --faiss, e.g. wstg_faiss.bm25)")
+    ap.add_argument("--rebuild-bm25", action="store_true", help="Force rebuilding the BM25 index")
+    ap.add_argument("--verify", action="store_true",
+                    help="Hash the chunks / ids files in full to check them against the build manifest, "
+                         "BM25 index and chunk store (default: compare size + mtime)")
 
     ap.add_argument("--mmr", action="store_true", help="Enable MMR diversification")
     ap.add_argument("--mmr-lambda", type=float, default=0.5, help="MMR lambda (0..1)")
+    ap.add_argument("--vectors", default=None,
+                    help="Optional .npy embedding matrix aligned with --ids for MMR "
+                         "(default: reconstruct vectors from the FAISS index)")
 
     ap.add_argument("--rerank", action="store_true", help="Enable Cross-Encoder reranking")
     ap.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2", help="Cross-Encoder name")
-
+    ap.add_argument("--rerank-cache-size", type=int, default=100_000, help="Cached (query, chunk) rerank scores")
+    ap.add_argument("--rerank-batch-size", type=int, default=128, help="Max pairs per CrossEncoder predict call")
+    ap.add_argument("--rerank-window-ms", type=float, default=5.0,
+                    help="Server mode: wait up to this long to coalesce rerank pairs across requests")
+
+    ap.add_argument("--filter", default="",
+                    help="Metadata filter applied inside FAISS / BM25, e.g. 'category=ATHN,SESS and item>=100' "
+                         "(fields: source, section, wstg_id, category, start_item, end_item, item, meta.*; "
+                         "quote values that contain separators, e.g. section=\"Authentication and Session\")")
+
+    ap.add_argument("--token-budget", type=int, default=0,
+                    help="Pack the delivered chunks into this many tokens (parents deduplicated against children, "
+                         "greedy by final score, sentence-boundary trimming) and print the result as JSON "
+                         "(default: 0 = no packing)")
+    ap.add_argument("--tokenizer", default="auto",
+                    help="Tokenizer for --token-budget: tiktoken:<encoding>, hf:<model>, approx, "
+                         "or auto (tiktoken cl100k_base if installed, else approx)")
     ap.add_argument("--print-context", action="store_true", help="Print selected contexts preview")
-
-    # Accept unknown args to stay compatible with older wrappers
-    args, _ = ap.parse_known_args()
-
-    # Resolve paths cross-platform
-    CHUNKS_PATH = Path(args.chunks).expanduser().resolve()
-    INDEX_PATH  = Path(args.faiss_path).expanduser().resolve()
-    IDS_PATH    = Path(args.ids).expanduser().resolve()
-
-    for p, name in [(CHUNKS_PATH, "--chunks"), (INDEX_PATH, "--faiss"), (IDS_PATH, "--ids")]:
-        if not p.exists():
-            raise FileNotFoundError(f"{name} not found: {p}")
-
-    # Load FAISS
-    eprint(f"[info] Loading FAISS index: {INDEX_PATH}")
-    index = faiss.read_index(str(INDEX_PATH))
-    idx_dim = int(index.d)
-    metric_type = getattr(index, "metric_type", faiss.METRIC_INNER_PRODUCT)
-    metric_name = "IP" if metric_type == faiss.METRIC_INNER_PRODUCT else "L2/Other"
-    eprint(f"[info] FAISS index dim: {idx_dim} (metric: {metric_name}), ntotal: {index.ntotal}")
-
-    # Load ids/chunks
-    eprint(f"[info] Loading ids: {IDS_PATH}")
-    all_ids: List[str] = read_json(IDS_PATH)
-    if len(all_ids) != index.ntotal:
-        eprint(f"[warn] ids count ({len(all_ids)}) != index.ntotal ({index.ntotal}). Proceeding, but ensure they match.")
-
-    eprint(f"[info] Loading chunks: {CHUNKS_PATH}")
-    chunks = read_chunks_jsonl(CHUNKS_PATH)
-
-    # Pick and build embedder
-    chosen_model = pick_embedder_model_name(idx_dim, args.embedder)
-    eprint(f"[info] Using embedder: {chosen_model}")
-    embedder = Embedder(model_name=chosen_model)
-
-    # Verify embedder dimension matches index
-    probe_dim = embedder.dim
-    if probe_dim != idx_dim:
-        raise RuntimeError(
-            f"Embedder '{chosen_model}' dim={probe_dim} does not match FAISS index dim={idx_dim}. "
-            "Please pass --embedder with the exact model used to build the index. "
-            "Common pairs: 384->all-MiniLM-L6-v2, 768->BAAI/bge-base-en-v1.5, 1024->BAAI/bge-large-en-v1.5."
+    ap.add_argument("--sparse-only", action="store_true",
+                    help="BM25-only retrieval: no FAISS / embedder (faiss and torch are never imported)")
+    ap.add_argument("--startup-report", nargs="?", const="", default=None,
+                    help="Report import / load / query timings (to stderr, or appended as JSONL to the given path)")
+    ap.add_argument("--profile", nargs="?", const="", default=None,
+                    help="Emit a per-stage trace (wall / CPU ms, candidate counts, batch sizes) for every query "
+                         "or batch (to stderr, or appended as JSONL to the given path)")
+    ap.add_argument("--cprofile", default=None,
+                    help="Run the query / batch under cProfile and dump stats to this file "
+                         "(pstats format, e.g. for snakeviz or flameprof)")
+
+    ap.add_argument("--mmap-index", action="store_true",
+                    help="Memory-map the FAISS index where the index type allows it")
+    ap.add_argument("--chunk-store", nargs="?", const="", default=None,
+                    help="Serve chunks from an mmap'd store instead of loading the JSONL into memory "
+                         "(optional directory; default: next to --chunks, e.g. wstg_chunks.from_knowledge.store)")
+    ap.add_argument("--nprobe", type=int, default=None, help="IVF nprobe (default: from index metadata)")
+    ap.add_argument("--ef-search", type=int, default=None, help="HNSW efSearch (default: from index metadata)")
+    ap.add_argument("--rescore-factor", type=int, default=None,
+                    help="Compressed indexes: rescore k * factor candidates with the full-precision vectors "
+                         "(default: from index metadata; 0 = first-stage scores only)")
+
+    # Query-embedding cache
+    ap.add_argument("--embed-cache", default=None,
+                    help="SQLite file for the persistent query-embedding cache (default: in-memory only)")
+    ap.add_argument("--embed-cache-mem", type=int, default=4096, help="In-process LRU size (entries, 0 = off)")
+    ap.add_argument("--embed-cache-disk", type=int, default=200_000, help="Max entries kept on disk")
+    ap.add_argument("--prewarm", default=None,
+                    help="Query log (same format as --queries-file) to prewarm the embedding cache with")
+
+    # Semantic result cache
+    ap.add_argument("--result-cache", type=float, default=0.0, metavar="THRESHOLD",
+                    help="Reuse the full result of a cached query whose embedding is within this cosine similarity "
+                         "(same options, same corpus), e.g. 0.97 (default: 0 = off)")
+    ap.add_argument("--result-cache-size", type=int, default=1024, help="Max cached results (LRU beyond that)")
+    ap.add_argument("--result-cache-ttl", type=float, default=3600.0,
+                    help="Seconds a cached result stays valid (0 = until evicted)")
+
+    # Batch mode
+    ap.add_argument("--queries-file", default=None,
+                    help="Batch mode: file with one query per line (or JSONL with a 'query' field)")
+    ap.add_argument("--output", default=None, help="Batch mode output JSONL (default: stdout)")
+    ap.add_argument("--batch-size", type=int, default=256, help="Queries per embedding/search batch")
+
+    # Server / client
+    ap.add_argument("--serve", action="store_true", help="Run as a long-lived retrieval server")
+    ap.add_argument("--host", default="127.0.0.1", help="Server bind host (with --serve)")
+    ap.add_argument("--port", type=int, default=8765, help="Server port (with --serve)")
+    ap.add_argument("--unix-socket", default=None, help="Serve on a Unix socket path instead of TCP")
+    ap.add_argument("--workers", type=int, default=4, help="Server worker threads")
+    ap.add_argument("--branch-workers", type=int, default=0,
+                    help="Threads for concurrent retrieval branches (BM25 alongside dense search, chunk prefetch); "
+                         "0 = sequential")
+    ap.add_argument("--torch-threads", type=int, default=0, help="torch intra-op threads (0 = default)")
+    ap.add_argument("--faiss-threads", type=int, default=0, help="FAISS OpenMP threads (0 = default)")
+    ap.add_argument("--server", default=None,
+                    help="Forward the query to a running server (http://host:port or unix:///path); "
+                         "falls back to local retrieval if none is reachable")
+    return ap
+
+
+def validate_args(ap: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Cheap argument checks, done before any model or index is loaded."""
+    if args.onnx_check and args.backend != "onnx":
+        ap.error("--onnx-check needs --backend onnx")
+    if not (args.serve or args.queries_file or args.query or args.onnx_check):
+        ap.error("--query is required (unless --serve, --queries-file or --onnx-check)")
+    if args.k_per_branch < 1 or args.deliver_to_llm < 1:
+        ap.error("--k-per-branch and --deliver-to-llm must be >= 1")
+    if args.token_budget < 0:
+        ap.error("--token-budget must be >= 0")
+    if not 0.0 <= args.mmr_lambda <= 1.0:
+        ap.error("--mmr-lambda must be in [0, 1]")
+    if args.sparse_only:
+        if args.mmr:
+            ap.error("--mmr needs dense vectors and cannot be combined with --sparse-only")
+        if args.prewarm:
+            ap.error("--prewarm warms the embedding cache and is useless with --sparse-only")
+        if args.hyde:
+            eprint("[info] --sparse-only: the HyDE hint is not used by BM25")
+    if args.result_cache and not 0.0 < args.result_cache <= 1.0:
+        ap.error("--result-cache must be a cosine threshold in (0, 1]")
+    if args.result_cache and args.sparse_only:
+        ap.error("--result-cache keys on query embeddings and cannot be combined with --sparse-only")
+    if args.cprofile and args.serve:
+        ap.error("--cprofile only sees the main thread; use --profile (or py-spy) with --serve")
+    if args.server and not (args.serve or args.queries_file):
+        return  # the local paths are only needed if the server is down
+    if args.shards:
+        clashing = [flag for flag, value in [("--chunks", args.chunks), ("--faiss", args.faiss_path),
+                                             ("--ids", args.ids), ("--vectors", args.vectors),
+                                             ("--bm25-index", args.bm25_index),
+                                             ("--chunk-store", args.chunk_store)] if value is not None]
+        if clashing:
+            ap.error(f"{', '.join(clashing)} cannot be combined with --shards (set them per shard in the manifest)")
+        return
+    if not args.chunks:
+        ap.error("--chunks (or --shards) is required for local retrieval / --serve")
+    if not args.sparse_only and not (args.faiss_path and args.ids):
+        ap.error("--faiss and --ids are required (unless --sparse-only)")
+
+
+def load_resources(ap: argparse.ArgumentParser, args: argparse.Namespace) -> RetrievalResources:
+    if not args.shards and (not args.chunks or (not args.sparse_only and not (args.faiss_path and args.ids))):
+        ap.error("--chunks (plus --faiss and --ids unless --sparse-only) or --shards are required "
+                 "for local retrieval")
+
+    embed_cache = None
+    if args.embed_cache or args.embed_cache_mem > 0:
+        embed_cache = EmbeddingCache(
+            path=Path(args.embed_cache).expanduser().resolve() if args.embed_cache else None,
+            mem_size=args.embed_cache_mem,
+            disk_size=args.embed_cache_disk,
         )
-
-    # Optional reranker
-    reranker = None
-    if args.rerank:
-        reranker = ReRanker(model_name=args.reranker)
-
-    # Optional BM25 stats
-    bm25_stats = None
-    if args.hybrid:
-        eprint("[info] Building BM25 stats...")
-        bm25_stats = build_bm25_stats(chunks)
-
-    # Retrieve
-    contexts, top_ids = retrieve(
-        query=args.query,
-        index=index,
-        all_ids=all_ids,
-        chunks=chunks,
-        embedder=embedder,
-        k_per_branch=args.k_per_branch,
-        deliver_to_llm=args.deliver_to_llm,
-        use_mmr=args.mmr,
-        mmr_lambda=args.mmr_lambda,
-        use_rerank=args.rerank,
-        reranker=reranker,
-        n_variants=max(1, args.multiquery),
-        use_hyde=args.hyde,
-        hybrid=args.hybrid,
-        bm25_stats=bm25_stats,
-        rrf_k=args.rrf_k,
+    common = dict(
+        tokenizer=args.tokenizer,
+        result_cache=ResultCache(threshold=args.result_cache, max_entries=args.result_cache_size,
+                                 ttl_s=args.result_cache_ttl) if args.result_cache else None,
+        embedder_name=args.embedder,
+        reranker_name=args.reranker,
+        rebuild_bm25=args.rebuild_bm25,
+        verify=args.verify,
+        embed_cache=embed_cache,
+        rerank_cache_size=args.rerank_cache_size,
+        rerank_batch_size=args.rerank_batch_size,
+        rerank_window_ms=args.rerank_window_ms,
+        rerank_coalesce=args.serve,
+        search_params={"nprobe": args.nprobe, "efSearch": args.ef_search},
+        mmap_index=args.mmap_index,
+        sparse_only=args.sparse_only,
+        rescore_factor=args.rescore_factor,
+        branch_workers=args.branch_workers,
+        max_concurrent=args.workers,
+        torch_threads=args.torch_threads,
+        faiss_threads=args.faiss_threads,
+        backend=args.backend,
+        onnx=OnnxBackend(
+            cache_dir=Path(args.onnx_cache).expanduser().resolve() if args.onnx_cache else None,
+            quantize=args.onnx_quantize,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads,
+            check_export=args.onnx_export_check,
+        ) if args.backend == "onnx" else None,
     )
-
-    # Output
+    if args.shards:
+        manifest_path = Path(args.shards).expanduser().resolve()
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"--shards not found: {manifest_path}")
+        try:
+            res = ShardedResources(manifest_path, shard_workers=args.shard_workers,
+                                   dense_merge=args.dense_merge, **common)
+        except ValueError as e:
+            ap.error(f"--shards: {e}")
+    else:
+        # Resolve paths cross-platform
+        CHUNKS_PATH = Path(args.chunks).expanduser().resolve()
+        INDEX_PATH  = Path(args.faiss_path).expanduser().resolve() if args.faiss_path else None
+        IDS_PATH    = Path(args.ids).expanduser().resolve() if args.ids else None
+
+        for p, name in [(CHUNKS_PATH, "--chunks"), (INDEX_PATH, "--faiss"), (IDS_PATH, "--ids")]:
+            if p is not None and not p.exists():
+                raise FileNotFoundError(f"{name} not found: {p}")
+
+        chunk_store_dir = None
+        if args.chunk_store is not None:
+            chunk_store_dir = (Path(args.chunk_store).expanduser().resolve() if args.chunk_store
+                               else CHUNKS_PATH.with_suffix(".store"))
+
+        res = RetrievalResources(
+            chunks_path=CHUNKS_PATH,
+            index_path=INDEX_PATH,
+            ids_path=IDS_PATH,
+            bm25_dir=Path(args.bm25_index).expanduser().resolve() if args.bm25_index else None,
+            vectors_path=Path(args.vectors).expanduser().resolve() if args.vectors else None,
+            chunk_store_dir=chunk_store_dir,
+            **common,
+        )
+    if args.profile is not None:
+        res.trace_sinks.append(JsonlTraceSink(Path(args.profile).expanduser() if args.profile else None))
+    # Warm optional components up front so the first query does not pay for them
+    if args.rerank:
+        res.get_reranker()
+    if args.hybrid or args.sparse_only:
+        res.get_bm25_index()
+    if args.filter or args.serve:
+        try:
+            res.compile_filter(args.filter)
+        except ValueError as e:
+            ap.error(f"--filter: {e}")
+    if args.token_budget > 0:
+        try:
+            res.get_token_counter()
+        except (ValueError, ImportError) as e:
+            ap.error(f"--tokenizer: {e}")
+    if args.prewarm and isinstance(res.embedder, CachedEmbedder):
+        queries = [it["query"] for it in read_queries_file(Path(args.prewarm).expanduser().resolve())]
+        n = res.embedder.prewarm(queries, n_variants=max(1, args.multiquery), use_hyde=args.hyde, with_query=args.mmr)
+        eprint(f"[info] Prewarmed embedding cache with {n} texts from {len(queries)} queries")
+    return res
+
+
+def print_results(result: Dict[str, Any], print_context: bool = False) -> None:
+    if "packed" in result:
+        # Packed output is meant for the LLM prompt builder: structured JSON, not a preview
+        out = {key: result[key] for key in ("query", "top_ids", "scores", "packed", "result_cache") if key in result}
+        if print_context:
+            out["contexts"] = result["contexts"]
+        print(json.dumps(out, ensure_ascii=False, indent=2))
+        return
     print("==== Top Chunk IDs ====")
-    for cid in top_ids:
+    for cid in result["top_ids"]:
         print(cid)
 
-    if args.print_context:
+    if print_context:
         print("\n==== Context Preview ====")
-        for i, obj in enumerate(contexts, 1):
+        for i, obj in enumerate(result["contexts"], 1):
             cid = obj.get("id", f"ctx-{i}")
             text = (obj.get("text") or "")[:500].replace("\n", " ")
             print(f"[{i}] {cid}: {text}")
 
 
+def read_queries_file(path: Path) -> List[Dict[str, Any]]:
+    """
+    One query per line. Lines that parse as a JSON object are taken as
+    {"query": ..., ...extra fields echoed into the output}.
+    """
+    items: List[Dict[str, Any]] = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                obj = json.loads(line)
+                if obj.get("query"):
+                    items.append(obj)
+            else:
+                items.append({"query": line})
+    return items
+
+
+def run_queries_file(res: RetrievalResources, args: argparse.Namespace, opts: Dict[str, Any]) -> None:
+    items = read_queries_file(Path(args.queries_file).expanduser().resolve())
+    eprint(f"[info] Batch mode: {len(items)} queries (batch size {args.batch_size})")
+    t0 = time.perf_counter()
+    results = res.run_batch([it["query"] for it in items], opts, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - t0
+    eprint(f"[info] Batch done in {elapsed:.2f}s ({len(items) / max(elapsed, 1e-9):.1f} queries/s)")
+    eprint(f"[info] Caches: {res.cache_stats()}")
+
+    out = Path(args.output).expanduser().open("w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for item, result in zip(items, results):
+            if not args.print_context:
+                result.pop("contexts")
+            out.write(json.dumps({**item, **result}, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def run_onnx_check(res: RetrievalResources, args: argparse.Namespace, n_samples: int = 64) -> bool:
+    """--onnx-check: agreement of the onnx backend with sbert on sample chunks (+ the query)."""
+    docs = [(obj.get("text") or "")[:ReRanker.max_chars] for _, obj in zip(range(n_samples), res.chunks.values())]
+    queries = query_texts(args.query, n_variants=max(1, args.multiquery))[0] if args.query else AGREEMENT_PROBE_TEXTS[:2]
+    report: Dict[str, Any] = {"backend": res.onnx.tag}
+    ok = True
+    if res.embedder is not None:
+        embedder = getattr(res.embedder, "embedder", res.embedder)  # skip the embedding cache
+        report["embedder"] = embedder_agreement(embedder, queries + docs)
+        ok = report["embedder"]["min_cosine"] >= ONNX_MIN_COSINE
+    if args.rerank:
+        reranker = res.get_reranker().reranker
+        report["reranker"] = reranker_agreement(reranker, [(q, d) for q in queries[:1] for d in docs])
+    print(json.dumps(report, indent=2))
+    if not ok:
+        eprint(f"[warn] ONNX embeddings below min cosine {ONNX_MIN_COSINE}")
+    return ok
+
+
+@contextmanager
+def cprofiled(path: Optional[str]):
+    """cProfile the enclosed block and dump pstats to `path` (no-op if None)."""
+    if not path:
+        yield
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(Path(path).expanduser()))
+        eprint(f"[info] cProfile stats written to {path}")
+
+
+def write_startup_report(args: argparse.Namespace) -> None:
+    STARTUP_TIMINGS["total"] = time.perf_counter() - _T_MODULE_START
+    record = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "mode": ("serve" if args.serve else "batch" if args.queries_file else
+                 "sparse-only" if args.sparse_only else "dense"),
+        "flags": {k: getattr(args, k) for k in ("hybrid", "mmr", "rerank", "hyde", "multiquery")},
+        "modules_loaded": sorted(m for m in ("faiss", "torch", "sentence_transformers") if m in sys.modules),
+        "timings_s": {k: round(v, 6) for k, v in STARTUP_TIMINGS.items()},
+    }
+    if args.startup_report:
+        with Path(args.startup_report).expanduser().open("a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    else:
+        eprint("[startup] " + json.dumps(record))
+
+
+def main():
+    ap = build_arg_parser()
+    # Accept unknown args to stay compatible with older wrappers
+    args, _ = ap.parse_known_args()
+    validate_args(ap, args)
+    opts = {key: getattr(args, key) for key in RETRIEVE_OPTIONS}
+
+    if args.serve:
+        res = load_resources(ap, args)
+        if args.startup_report is not None:
+            write_startup_report(args)
+        serve(res, opts, host=args.host, port=args.port,
+              unix_socket=args.unix_socket, workers=args.workers)
+        return
+
+    if args.onnx_check:
+        if not run_onnx_check(load_resources(ap, args), args):
+            sys.exit(1)
+        return
+
+    if args.queries_file:
+        res = load_resources(ap, args)
+        with cprofiled(args.cprofile):
+            run_queries_file(res, args, opts)
+        if args.startup_report is not None:
+            write_startup_report(args)
+        return
+
+    result = None
+    if args.server:
+        result = query_server(args.server, args.query, opts)
+    if result is None:
+        res = load_resources(ap, args)
+        with timed("query"), cprofiled(args.cprofile):
+            result = res.run(args.query, opts)
+        if res.embed_cache is not None:
+            eprint(f"[info] Embedding cache: {res.embed_cache.stats()}")
+            res.embed_cache.close()
+
+    print_results(result, print_context=args.print_context)
+    if args.startup_report is not None:
+        write_startup_report(args)
+
+
 if __name__ == "__main__":
     main()
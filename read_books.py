@@ -2,11 +2,20 @@ from pathlib import Path
 from typing import Dict, Any
 from pydantic import BaseModel
 import json
+import openai
 from openai import OpenAI
 import fitz  # PyMuPDF
 from termcolor import colored
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import random
 import shutil
+import sqlite3
+import threading
+import time
 import re
 import os
 
@@ -19,10 +28,42 @@ SUMMARIES_DIR = BASE_DIR / "summaries"
 IMAGES_DIR = BASE_DIR / "images"
 PDF_PATH = PDF_DIR / PDF_NAME
 OUTPUT_PATH = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '_knowledge.json')}"
+JOURNAL_PATH = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '_journal.jsonl')}"  # append-only, 1 dòng / page
+PAGE_CACHE_PATH = BASE_DIR / "cache" / "page_cache.sqlite"  # không bị xoá khi chạy lại
+PAGE_CACHE_SIZE = 100_000      # số kết quả page tối đa trong cache (LRU)
+PAGE_CACHE_TRIM_SLACK = 0.05   # cache vượt max 5% mới xoá một lượt về đúng max (khỏi COUNT(*) mỗi lần put)
+PAGE_CACHE_COMMIT_EVERY = 32   # commit SQLite mỗi N lần ghi (page mới / last_used của hit)
+JOURNAL_SYNC_PAGES = 10        # fsync journal mỗi N page (mỗi page vẫn flush xuống OS ngay)
 ANALYSIS_INTERVAL = 20
 MODEL = "gpt-4o-mini"          # dùng cho lọc page-by-page
 ANALYSIS_MODEL = "o1-mini"     # dùng cho phân tích cuối cùng
 TEST_PAGES = None  # None = toàn bộ PDF
+CONCURRENCY = 8                # số page gửi LLM cùng lúc (1 = tuần tự)
+IMAGE_WRITERS = 4              # thread ghi ảnh ra đĩa
+REQUESTS_PER_MINUTE = 500      # giới hạn RPM của tài khoản (0 = không giới hạn)
+TOKENS_PER_MINUTE = 200_000    # giới hạn TPM (0 = không giới hạn)
+EXPECTED_OUTPUT_TOKENS = 800   # token output ước lượng / request khi giữ chỗ TPM, chỉnh lại theo usage thật
+RATE_BURST_SECONDS = 1.0       # bucket chỉ giữ ~1s hạn mức: không dồn cả phút vào một lúc (API chia nhỏ theo giây)
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0             # giây, nhân đôi mỗi lần retry (+ jitter), tối đa BACKOFF_MAX
+BACKOFF_MAX = 60.0
+
+PAGE_PROMPT = """Analyze this page as if you're studying from a book. 
+            
+            SKIP if page is only:
+            - TOC, index, copyright, references, acknowledgments, blank
+
+            KEEP if page has:
+            - Preface concepts
+            - Educational content
+            - Definitions, methodologies, frameworks
+            - Payloads, code, tables
+            - Key quotes/statements
+            - Images (references like 'Image: ...')
+
+            Output:
+            - has_content true/false
+            - knowledge: list of important points, keep code in ```code``` and tables in markdown"""
 
 class PageContent(BaseModel):
     has_content: bool
@@ -37,8 +78,81 @@ def load_or_create_knowledge_base() -> Dict[str, Any]:
 def save_knowledge_base(knowledge_base: list[str]):
     output_path = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '')}_knowledge.json"
     print(colored(f"💾 Saving knowledge base ({len(knowledge_base)} items)...", "blue"))
-    with open(output_path, 'w', encoding='utf-8') as f:
+    tmp_path = output_path.with_suffix(".json.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump({"knowledge": knowledge_base}, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, output_path)
+
+class KnowledgeJournal:
+    """
+    Journal JSONL append-only: dòng đầu là header (PDF sha1 + model), sau đó mỗi page một dòng
+    {"page", "knowledge"} theo thứ tự page. Chạy lại sau crash thì đọc lại các page đã có và bỏ qua
+    chúng; dòng cuối ghi dở (crash giữa chừng) bị cắt bỏ, dòng cuối đủ nhưng thiếu "\n" được thêm "\n"
+    để lần append sau không dính vào nó. Header khác (PDF / model đổi) -> journal mới.
+    """
+    def __init__(self, path: Path, header: dict):
+        self.path = path
+        self.pages: dict[int, list[str]] = {}  # page đọc lại từ run trước
+        self.appended = 0                      # page ghi thêm ở run này
+        self.unsynced = 0
+        if path.exists():
+            self._load(header)
+        if not self.pages:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def _load(self, header: dict):
+        good_end = 0
+        newline_missing = False
+        with open(self.path, 'rb') as f:
+            for n, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # dòng ghi dở
+                if n == 0 and entry != header:
+                    print(colored("⚠️  Journal is from another PDF / model, starting over", "yellow"))
+                    return
+                if n > 0:
+                    self.pages[entry["page"]] = entry["knowledge"]
+                good_end += len(line)
+                newline_missing = not line.endswith(b"\n")
+        with open(self.path, 'r+b') as f:
+            f.truncate(good_end)
+            if newline_missing:
+                f.seek(good_end)
+                f.write(b"\n")
+
+    @property
+    def page_count(self) -> int:
+        return len(self.pages) + self.appended
+
+    def append(self, page_num: int, knowledge: list[str]):
+        self.file.write(json.dumps({"page": page_num, "knowledge": knowledge}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.appended += 1
+        self.unsynced += 1
+        if self.unsynced >= JOURNAL_SYNC_PAGES:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self, remove: bool = False):
+        self.file.flush()
+        self.sync()
+        self.file.close()
+        if remove:
+            self.path.unlink()
+
+def journal_header() -> dict:
+    sha1 = hashlib.sha1()
+    with open(PDF_PATH, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return {"pdf": PDF_NAME, "sha1": sha1.hexdigest(), "model": MODEL}
 
 def extract_tables(text: str) -> str:
     """Detect simple tables and convert to markdown format."""
@@ -53,21 +167,52 @@ def extract_tables(text: str) -> str:
         return table
     return text
 
-def extract_images(page, page_num: int, doc) -> list[str]:
-    """Extract images and save to IMAGES_DIR"""
-    results = []
-    images = page.get_images(full=True)
-    for i, img in enumerate(images, start=1):
-        xref = img[0]
-        base_image = doc.extract_image(xref)
-        img_bytes = base_image["image"]
-        ext = base_image["ext"]
-        img_name = f"img_page{page_num+1}_{i}.{ext}"
-        img_path = IMAGES_DIR / img_name
-        with open(img_path, "wb") as f:
-            f.write(img_bytes)
-        results.append(f"Image: {img_name}")
-    return results
+class ImageStore:
+    """
+    Lưu ảnh của PDF vào IMAGES_DIR, mỗi ảnh một file: trùng xref hoặc trùng nội dung (sha1) với ảnh
+    đã gặp (vd. logo lặp mỗi page) thì trỏ về file đầu tiên; file đã có (run trước) thì không ghi lại.
+    Đọc ảnh ở thread chính (PyMuPDF không thread-safe), ghi đĩa ở thread pool.
+    """
+    def __init__(self, doc, writers: int = IMAGE_WRITERS):
+        self.doc = doc
+        self.by_xref: dict[int, str] = {}
+        self.by_hash: dict[str, str] = {}
+        self.pool = ThreadPoolExecutor(max_workers=max(1, writers))
+        self.pending = []
+
+    def page_images(self, page, page_num: int) -> list[str]:
+        """Extract images and save to IMAGES_DIR"""
+        names = []
+        for i, img in enumerate(page.get_images(full=True), start=1):
+            xref = img[0]
+            name = self.by_xref.get(xref)
+            if name is None:
+                base_image = self.doc.extract_image(xref)
+                img_bytes = base_image["image"]
+                digest = hashlib.sha1(img_bytes).hexdigest()
+                name = self.by_hash.get(digest)
+                if name is None:
+                    name = f"img_page{page_num+1}_{i}.{base_image['ext']}"
+                    self.by_hash[digest] = name
+                    if not (IMAGES_DIR / name).exists():
+                        self.pending.append(self.pool.submit(self._write, IMAGES_DIR / name, img_bytes))
+                self.by_xref[xref] = name
+            names.append(name)
+        return [f"Image: {name}" for name in dict.fromkeys(names)]
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """Chờ ghi xong hết (lỗi ghi được raise ở đây)."""
+        self.pool.shutdown(wait=True)
+        for future in self.pending:
+            future.result()
+        self.pending.clear()
 
 def detect_code_blocks(text: str) -> str:
     """Detect payload/code based on special chars/keywords."""
@@ -75,11 +220,12 @@ def detect_code_blocks(text: str) -> str:
         return f"```code\n{text.strip()}\n```"
     return text
 
-def build_page_text(page, page_num: int, doc) -> tuple[str, list[str]]:
+def build_page_text(page, page_num: int, images: ImageStore) -> tuple[str, list[str]]:
     """Tiền xử lý nội dung page thành 1 chuỗi text (text + table + code) và list ảnh."""
     blocks = page.get_text("dict")["blocks"]
     parts = []
     image_refs = []
+    has_images = False
 
     for block in blocks:
         if block["type"] == 0:  # text
@@ -90,80 +236,318 @@ def build_page_text(page, page_num: int, doc) -> tuple[str, list[str]]:
             block_text = detect_code_blocks(block_text)
             parts.append(block_text)
 
-        elif block["type"] == 1:  # image
-            refs = extract_images(page, page_num, doc)
-            image_refs.extend(refs)
+        elif block["type"] == 1 and not has_images:  # image: lấy hết ảnh của page một lần
+            image_refs = images.page_images(page, page_num)
+            has_images = True
 
     return "\n\n".join(parts), image_refs
 
-def process_page(client: OpenAI, page, doc, current_knowledge: list[str], page_num: int) -> list[str]:
-    print(colored(f"\n📖 Processing page {page_num + 1}...", "yellow"))
-
-    page_text, image_refs = build_page_text(page, page_num, doc)
-
-    completion = client.beta.chat.completions.parse(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": """Analyze this page as if you're studying from a book. 
-            
-            SKIP if page is only:
-            - TOC, index, copyright, references, acknowledgments, blank
-
-            KEEP if page has:
-            - Preface concepts
-            - Educational content
-            - Definitions, methodologies, frameworks
-            - Payloads, code, tables
-            - Key quotes/statements
-            - Images (references like 'Image: ...')
-
-            Output:
-            - has_content true/false
-            - knowledge: list of important points, keep code in ```code``` and tables in markdown"""},
-            {"role": "user", "content": f"Page text:\n{page_text}"}
-        ],
-        response_format=PageContent
+class RateLimiter:
+    """
+    Token bucket dùng chung giữa các thread: requests/phút + tokens/phút, sức chứa ~RATE_BURST_SECONDS
+    hạn mức; request lớn hơn sức chứa vẫn đi được (bucket âm, các request sau chờ bù). 429 thì tạm dừng tất cả.
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = rpm, tpm
+        self.max_requests = max(1.0, rpm * RATE_BURST_SECONDS / 60.0)
+        self.max_tokens = max(1.0, tpm * RATE_BURST_SECONDS / 60.0)
+        self.requests, self.tokens = self.max_requests, self.max_tokens
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed, self.updated = now - self.updated, now
+        if self.rpm:
+            self.requests = min(self.max_requests, self.requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self.tokens = min(self.max_tokens, self.tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int):
+        """Chờ tới khi gửi được 1 request ước lượng `tokens` token."""
+        tokens = tokens if self.tpm else 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                waits = [self.paused_until - now]
+                if self.rpm:
+                    waits.append((1 - self.requests) * 60.0 / self.rpm)
+                if self.tpm:
+                    waits.append((min(tokens, self.max_tokens) - self.tokens) * 60.0 / self.tpm)
+                wait = max(waits)
+                if wait <= 0:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+            time.sleep(min(wait, 5.0))
+
+    def adjust(self, tokens: int):
+        """Chỉnh TPM theo usage thật (dương = dùng nhiều hơn ước lượng)."""
+        if self.tpm:
+            with self.lock:
+                self.tokens -= tokens
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class IngestStats:
+    def __init__(self):
+        self.counts = {"pages": 0, "requests": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        c = self.counts
+        return (f"{c['pages']} pages in {elapsed:.1f}s ({c['pages'] / max(elapsed, 1e-9):.2f} pages/s), "
+                f"{c['requests']} requests, {c['retries']} retries, "
+                f"{c['prompt_tokens'] + c['completion_tokens']} tokens")
+
+class PageCache:
+    """
+    Cache kết quả PageContent theo nội dung: key = sha1(model, system prompt, schema, page text, ảnh),
+    nên page giống hệt (chạy lại, PDF bản mới ít thay đổi) không gọi LLM nữa. SQLite, tối đa `max_entries`
+    dòng (LRU theo last_used). Dùng chung giữa các thread; hit/miss trong stats().
+    Số dòng đếm trong bộ nhớ, vượt PAGE_CACHE_TRIM_SLACK mới xoá một lượt; last_used của hit và các
+    dòng mới được commit theo lô (PAGE_CACHE_COMMIT_EVERY) và khi close().
+    """
+    def __init__(self, path: Path, max_entries: int = PAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = self.misses = self.stored = 0
+        self.lock = threading.Lock()
+        self.touched: dict[str, float] = {}  # key -> last_used chưa ghi xuống SQLite
+        self.unsaved = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS page (key TEXT PRIMARY KEY, result TEXT, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS page_last_used ON page(last_used)")
+        self._trim()
+        self.db.commit()
+        self.namespace = json.dumps([MODEL, PAGE_PROMPT, PageContent.model_json_schema()], sort_keys=True)
+
+    def make_key(self, page_text: str, image_refs: list[str]) -> str:
+        h = hashlib.sha1(self.namespace.encode("utf-8"))
+        h.update(json.dumps([page_text, image_refs], ensure_ascii=False).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> PageContent | None:
+        with self.lock:
+            row = self.db.execute("SELECT result FROM page WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.touched[key] = time.time()
+            self.hits += 1
+            self._changed()
+        return PageContent.model_validate_json(row[0])
+
+    def put(self, key: str, result: PageContent):
+        with self.lock:
+            self.touched.pop(key, None)
+            self.db.execute("INSERT OR REPLACE INTO page(key, result, last_used) VALUES (?, ?, ?)",
+                            (key, result.model_dump_json(), time.time()))
+            self.stored += 1
+            self.count += 1  # put chỉ đi sau miss nên key thường là mới; đếm dư thì _trim() đếm lại
+            if self.count > self.max_entries * (1 + PAGE_CACHE_TRIM_SLACK):
+                self._trim()
+            self._changed()
+
+    def _changed(self):
+        self.unsaved += 1
+        if self.unsaved >= PAGE_CACHE_COMMIT_EVERY:
+            self._save()
+
+    def _save(self):
+        if self.touched:
+            self.db.executemany("UPDATE page SET last_used=? WHERE key=?",
+                                [(used, key) for key, used in self.touched.items()])
+            self.touched.clear()
+        self.db.commit()
+        self.unsaved = 0
+
+    def _trim(self):
+        """Xoá các dòng lâu không dùng nhất, còn đúng max_entries (đếm lại số dòng thật)."""
+        if self.touched:
+            self._save()
+        (self.count,) = self.db.execute("SELECT COUNT(*) FROM page").fetchone()
+        if self.count > self.max_entries:
+            self.db.execute("DELETE FROM page WHERE key IN (SELECT key FROM page ORDER BY last_used ASC LIMIT ?)",
+                            (self.count - self.max_entries,))
+            self.count = self.max_entries
+
+    def stats(self) -> str:
+        with self.lock:
+            lookups = self.hits + self.misses
+            count = self.count
+        return (f"page cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hits / lookups if lookups else 0.0:.0%} hit rate), {self.stored} stored, {count} entries")
+
+    def close(self):
+        with self.lock:
+            self._save()
+            self.db.close()
+
+# lỗi tạm thời: 429, 5xx, timeout (APITimeoutError là APIConnectionError), mất kết nối
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def call_llm(request, messages: list[dict], limiter: RateLimiter, stats: IngestStats):
+    """request() với rate limit + retry (exponential backoff, jitter, Retry-After) cho lỗi tạm thời."""
+    estimate = sum(len(m["content"]) for m in messages) // 4 + EXPECTED_OUTPUT_TOKENS
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(estimate)
+        try:
+            completion = request()
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = retry_delay(e, attempt)
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(delay)
+            stats.add(retries=1)
+            print(colored(f"🔁 {type(e).__name__}, retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s", "magenta"))
+            time.sleep(delay)
+            continue
+        stats.add(requests=1)
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            limiter.adjust(usage.total_tokens - estimate)
+            stats.add(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        return completion
+
+def extract_page_knowledge(client: OpenAI, page_text: str, image_refs: list[str], limiter: RateLimiter,
+                           stats: IngestStats, cache: PageCache | None = None) -> PageContent:
+    if cache is not None:
+        key = cache.make_key(page_text, image_refs)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    messages = [
+        {"role": "system", "content": PAGE_PROMPT},
+        {"role": "user", "content": f"Page text:\n{page_text}"}
+    ]
+    completion = call_llm(
+        lambda: client.beta.chat.completions.parse(model=MODEL, messages=messages, response_format=PageContent),
+        messages, limiter, stats
     )
-
     result = completion.choices[0].message.parsed
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+def page_knowledge_points(result: PageContent, image_refs: list[str], page_num: int) -> list[str]:
+    print(colored(f"\n📖 Page {page_num + 1}", "yellow"))
 
     # ép ảnh vào knowledge base
     if result.has_content:
         knowledge_points = result.knowledge + image_refs
         print(colored(f"✅ Found {len(knowledge_points)} knowledge points (including {len(image_refs)} images)", "green"))
-        updated_knowledge = current_knowledge + knowledge_points
-    else:
-        if image_refs:
-            print(colored(f"ℹ️ Page skipped by model, but {len(image_refs)} images kept", "cyan"))
-            updated_knowledge = current_knowledge + image_refs
-        else:
-            print(colored("⏭️  Skipping page (no relevant content)", "yellow"))
-            updated_knowledge = current_knowledge
-
-    save_knowledge_base(updated_knowledge)
-    return updated_knowledge
-
-def load_existing_knowledge() -> list[str]:
-    knowledge_file = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '')}_knowledge.json"
-    if knowledge_file.exists():
-        print(colored("📚 Loading existing knowledge base...", "cyan"))
-        with open(knowledge_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            print(colored(f"✅ Loaded {len(data['knowledge'])} existing knowledge points", "green"))
-            return data['knowledge']
-    print(colored("🆕 Starting with fresh knowledge base", "cyan"))
+        return knowledge_points
+    if image_refs:
+        print(colored(f"ℹ️ Page skipped by model, but {len(image_refs)} images kept", "cyan"))
+        return list(image_refs)
+    print(colored("⏭️  Skipping page (no relevant content)", "yellow"))
     return []
 
-def analyze_knowledge_base(client: OpenAI, knowledge_base: list[str]) -> str:
+def process_pages(client: OpenAI, doc, pages_to_process: int, journal: KnowledgeJournal,
+                  limiter: RateLimiter, stats: IngestStats, concurrency: int = CONCURRENCY,
+                  cache: PageCache | None = None) -> list[str]:
+    """
+    Giữ tối đa `concurrency` page đang gọi LLM (thread pool; PyMuPDF chỉ chạy ở thread chính),
+    ghép kết quả theo đúng thứ tự page nên knowledge base giống hệt chạy tuần tự. Page đã có trong
+    journal (run trước bị ngắt) được dùng lại, không gọi LLM; page mới được append vào journal.
+    """
+    knowledge_base: list[str] = []
+    window = deque()  # (page_num, future, image_refs) theo thứ tự page, tối đa 2 * concurrency page
+
+    def commit_oldest():
+        page_num, future, image_refs = window.popleft()
+        resumed = future is None
+        if resumed:
+            knowledge_base.extend(journal.pages[page_num])
+        else:
+            knowledge_points = page_knowledge_points(future.result(), image_refs, page_num)
+            knowledge_base.extend(knowledge_points)
+            # summary định kỳ trước khi journal page: bị ngắt giữa chừng thì resume làm lại cả page lẫn summary
+            analyze_after_page(client, knowledge_base, page_num, pages_to_process, limiter, stats, final=False)
+            journal.append(page_num, knowledge_points)
+            stats.add(pages=1)
+        analyze_after_page(client, knowledge_base, page_num, pages_to_process, limiter, stats, intervals=False)
+
+    images = ImageStore(doc)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        try:
+            for page_num in range(pages_to_process):
+                if page_num in journal.pages:
+                    # vẫn đăng ký ảnh của page (file đã có, không ghi) để ảnh lặp ở page sau trỏ đúng file đầu;
+                    # page có ảnh thì knowledge trong journal có "Image: ...", khỏi dựng lại text của page
+                    if any(point.startswith("Image: ") for point in journal.pages[page_num]):
+                        images.page_images(doc[page_num], page_num)
+                    window.append((page_num, None, None))
+                else:
+                    page_text, image_refs = build_page_text(doc[page_num], page_num, images)
+                    future = pool.submit(extract_page_knowledge, client, page_text, image_refs, limiter, stats, cache)
+                    window.append((page_num, future, image_refs))
+                while len(window) > 2 * concurrency:
+                    commit_oldest()
+            while window:
+                commit_oldest()
+        except BaseException:
+            for _, future, _ in window:
+                if future is not None:
+                    future.cancel()
+            raise
+        finally:
+            images.close()
+    return knowledge_base
+
+def analyze_after_page(client: OpenAI, knowledge_base: list[str], page_num: int, pages_to_process: int,
+                       limiter: RateLimiter, stats: IngestStats, intervals: bool = True, final: bool = True):
+    """Summary định kỳ (page đã journal thì summary của nó đã lưu ở run trước) + summary cuối."""
+    if ANALYSIS_INTERVAL and intervals:
+        is_interval = (page_num + 1) % ANALYSIS_INTERVAL == 0
+        is_final = (page_num + 1 == pages_to_process)
+        if is_interval and not is_final:
+            interval_summary = analyze_knowledge_base(client, knowledge_base, limiter, stats)
+            save_summary(interval_summary, is_final=False)
+
+    if final and page_num + 1 == pages_to_process:
+        final_summary = analyze_knowledge_base(client, knowledge_base, limiter, stats)
+        save_summary(final_summary, is_final=True)
+
+def open_journal(fresh: bool = False) -> KnowledgeJournal:
+    if fresh and JOURNAL_PATH.exists():
+        JOURNAL_PATH.unlink()
+    journal = KnowledgeJournal(JOURNAL_PATH, journal_header())
+    if journal.pages:
+        points = sum(len(k) for k in journal.pages.values())
+        print(colored(f"📚 Resuming: {len(journal.pages)} pages ({points} knowledge points) already in the journal", "cyan"))
+    else:
+        clear_previous_outputs()
+        print(colored("🆕 Starting with fresh knowledge base", "cyan"))
+    return journal
+
+def analyze_knowledge_base(client: OpenAI, knowledge_base: list[str], limiter: RateLimiter, stats: IngestStats) -> str:
     if not knowledge_base:
         print(colored("\n⚠️  Skipping analysis: No knowledge points collected", "yellow"))
         return ""
         
     print(colored("\n🤔 Generating final book analysis...", "cyan"))
-    completion = client.chat.completions.create(
-        model=ANALYSIS_MODEL,
-        messages=[
-            {"role": "user", "content": """Summarize the following knowledge in markdown.
+    messages = [
+        {"role": "user", "content": """Summarize the following knowledge in markdown.
 - ## for main sections
 - ### for subsections
 - Bullet lists for items
@@ -174,16 +558,22 @@ def analyze_knowledge_base(client: OpenAI, knowledge_base: list[str]) -> str:
 
 Content:
 """ + "\n".join(knowledge_base)}
-        ]
+    ]
+    completion = call_llm(
+        lambda: client.chat.completions.create(model=ANALYSIS_MODEL, messages=messages),
+        messages, limiter, stats
     )
     print(colored("✨ Analysis generated successfully!", "green"))
     return completion.choices[0].message.content
 
-def setup_directories():
+def clear_previous_outputs():
+    """Run mới (không resume): xoá knowledge / summaries / images của run trước, giữ journal."""
     for directory in [KNOWLEDGE_DIR, SUMMARIES_DIR, IMAGES_DIR]:
-        if directory.exists():
-            for file in directory.glob("*"):
+        for file in directory.glob("*"):
+            if file != JOURNAL_PATH:
                 file.unlink()
+
+def setup_directories():
     for directory in [PDF_DIR, KNOWLEDGE_DIR, SUMMARIES_DIR, IMAGES_DIR]:
         directory.mkdir(parents=True, exist_ok=True)
 
@@ -220,6 +610,19 @@ Generated on: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
     print(colored(f"✅ Saved analysis to: {summary_path}", "green"))
 
 def main():
+    ap = argparse.ArgumentParser(description="Extract a knowledge base from the PDF, page by page, with an LLM")
+    ap.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Page requests in flight (1 = sequential)")
+    ap.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE, help="Requests per minute limit (0 = off)")
+    ap.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE, help="Tokens per minute limit (0 = off)")
+    ap.add_argument("--base-url", default=os.environ.get("OPENAI_BASE_URL"),
+                    help="OpenAI-compatible endpoint, e.g. http://127.0.0.1:8000/v1 for mock_openai_server.py")
+    ap.add_argument("--pages", type=int, default=TEST_PAGES, help="Only the first N pages (default: all)")
+    ap.add_argument("--fresh", action="store_true", help="Ignore the journal of an interrupted run and start over")
+    ap.add_argument("--page-cache", type=Path, default=PAGE_CACHE_PATH, help="SQLite cache of per-page LLM results")
+    ap.add_argument("--page-cache-size", type=int, default=PAGE_CACHE_SIZE, help="Max cached pages (LRU)")
+    ap.add_argument("--no-page-cache", action="store_true", help="Always call the LLM for every page")
+    args = ap.parse_args()
+
     try:
         print(colored("📚 Starting PDF Analysis Tool", "cyan"))
     except KeyboardInterrupt:
@@ -227,27 +630,34 @@ def main():
         return
 
     setup_directories()
-    client = OpenAI()
-    knowledge_base = load_existing_knowledge()
+    # retry do call_llm lo (backoff chung với rate limiter), client không tự retry thêm
+    api_key = os.environ.get("OPENAI_API_KEY") or ("local" if args.base_url else None)
+    client = OpenAI(base_url=args.base_url, api_key=api_key, max_retries=0)
+    journal = open_journal(fresh=args.fresh)
     doc = fitz.open(PDF_PATH)
-    pages_to_process = TEST_PAGES if TEST_PAGES else doc.page_count
-
-    print(colored(f"\n📚 Processing {pages_to_process} pages...", "cyan"))
-    for page_num in range(min(pages_to_process, doc.page_count)):
-        page = doc[page_num]
-        knowledge_base = process_page(client, page, doc, knowledge_base, page_num)
-
-        if ANALYSIS_INTERVAL:
-            is_interval = (page_num + 1) % ANALYSIS_INTERVAL == 0
-            is_final = (page_num + 1 == pages_to_process)
-            if is_interval and not is_final:
-                interval_summary = analyze_knowledge_base(client, knowledge_base)
-                save_summary(interval_summary, is_final=False)
-
-        if page_num + 1 == pages_to_process:
-            final_summary = analyze_knowledge_base(client, knowledge_base)
-            save_summary(final_summary, is_final=True)
+    pages_to_process = min(args.pages or doc.page_count, doc.page_count)
+    limiter = RateLimiter(args.rpm, args.tpm)
+    stats = IngestStats()
+    cache = None if args.no_page_cache else PageCache(args.page_cache, args.page_cache_size)
 
+    print(colored(f"\n📚 Processing {pages_to_process} pages ({args.concurrency} in flight)...", "cyan"))
+    try:
+        knowledge_base = process_pages(client, doc, pages_to_process, journal, limiter, stats,
+                                       concurrency=args.concurrency, cache=cache)
+    except BaseException:
+        journal.close()
+        if cache is not None:
+            cache.close()  # commit các kết quả page chưa ghi
+        print(colored(f"\n❌ Stopped; {journal.page_count} pages are in the journal, re-run to resume", "red"))
+        raise
+    # compact journal -> knowledge JSON một lần ở cuối, rồi bỏ journal
+    save_knowledge_base(knowledge_base)
+    journal.close(remove=True)
+
+    print(colored(f"\n⏱️  {stats.summary()}", "cyan"))
+    if cache is not None:
+        print(colored(f"🗃️  {cache.stats()}", "cyan"))
+        cache.close()
     print(colored("\n✨ Processing complete! ✨", "green", attrs=['bold']))
 
 if __name__ == "__main__":
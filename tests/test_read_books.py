@@ -0,0 +1,130 @@
+"""
+read_books.py against mock_openai_server.py with injected 429 / 500 errors:
+page order, retries and the client-side RPM limit.
+"""
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+import fitz
+import pytest
+from openai import OpenAI
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import read_books  # noqa: E402
+
+PAGES = 12
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/stats", timeout=5) as resp:
+        return json.load(resp)
+
+
+@pytest.fixture
+def mock_server():
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, str(ROOT / "mock_openai_server.py"), "--port", str(port),
+         "--latency-ms", "20", "--jitter-ms", "10", "--error-rate", "0.3", "--retry-after", "0", "--seed", "7"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}/v1"
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            server_stats(base_url)
+            break
+        except OSError:
+            if time.monotonic() > deadline or proc.poll() is not None:
+                proc.kill()
+                raise RuntimeError("mock_openai_server.py did not start")
+            time.sleep(0.05)
+    yield base_url
+    proc.terminate()
+    proc.wait(timeout=10)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # summaries / images go to book_analysis/ under the cwd
+    for directory in (read_books.SUMMARIES_DIR, read_books.IMAGES_DIR):
+        directory.mkdir(parents=True)
+    monkeypatch.setattr(read_books, "BACKOFF_BASE", 0.01)
+    return tmp_path
+
+
+def make_pdf(pages: int):
+    doc = fitz.open()
+    for page_num in range(pages):
+        doc.new_page().insert_text((72, 72), f"Marker for page {page_num}")
+    return doc
+
+
+def test_pages_commit_in_order_with_retries(mock_server, workdir, monkeypatch):
+    finished = []
+    extract = read_books.extract_page_knowledge
+
+    def slow_early_pages(client, page_text, *args, **kwargs):
+        # the first pages finish last, so completion order is the reverse of page order
+        page_num = int(page_text.split("Marker for page ")[1].split()[0])
+        time.sleep(0.03 * (PAGES - page_num))
+        result = extract(client, page_text, *args, **kwargs)
+        finished.append(page_num)
+        return result
+
+    monkeypatch.setattr(read_books, "extract_page_knowledge", slow_early_pages)
+    client = OpenAI(base_url=mock_server, api_key="local", max_retries=0)
+    journal = read_books.KnowledgeJournal(workdir / "journal.jsonl", {"pdf": "test"})
+    stats = read_books.IngestStats()
+    knowledge_base = read_books.process_pages(client, make_pdf(PAGES), PAGES, journal,
+                                              read_books.RateLimiter(0, 0), stats, concurrency=8)
+    journal.close()
+
+    assert finished != sorted(finished)
+    assert knowledge_base == [f"Marker for page {page_num}" for page_num in range(PAGES)]
+    server = server_stats(mock_server)
+    errors = server["rate_limited"] + server["server_errors"]
+    assert errors > 0
+    assert stats.counts["retries"] == errors
+    assert stats.counts["requests"] == server["ok"] == PAGES + 1  # pages + final summary
+
+
+def test_rate_limiter_stays_within_rpm():
+    rpm, calls = 1200, 50
+    limiter = read_books.RateLimiter(rpm, 0)
+    stamps = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(calls // 5):
+            limiter.acquire(0)
+            with lock:
+                stamps.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stamps.sort()
+    rate = rpm / 60.0
+    # token bucket: any n consecutive grants need (n - burst) / rate seconds
+    for i in range(len(stamps)):
+        for j in range(i + 1, len(stamps)):
+            assert j - i + 1 <= limiter.max_requests + rate * (stamps[j] - stamps[i]) + 1
+    assert stamps[-1] - stamps[0] >= (calls - limiter.max_requests) / rate - 0.05